@@ -3,28 +3,526 @@ __author__ = 'arthurvandermerwe'
 
 import struct
 import binascii
+import hmac
 import string
+import threading
+from collections import OrderedDict
 
 from Data_Structures.AS2805_Structs.AS2805Errors import *
 from Shared.ByteUtils import HexToByte, ByteToHex
 
 
+################################################################################################
+# Compiled field plan
+#
+# Every codec path used to re-read _DEF for each field of each message (counting the dots of the
+# length, comparing the type against a chain of strings, ...). _compilePlan() does that work once
+# at import and leaves a _FieldPlan per bit holding the prefix width, the maximum length, the
+# encoding and the functions used to encode, measure and decode the field.
+# Fields are held in _VALUES exactly as they travel on the wire (length prefix included) and the
+# widths below are in bytes.
+################################################################################################
+
+_BCD_TYPES = ('n', 'z')
+
+
+class _FieldPlan:
+    """Encoding rules of a single bit, compiled from its _DEF entry.
+    @param: bit -> bit number
+    @param: definition -> the _DEF entry of the bit
+    """
+
+    def __init__(self, bit, definition):
+        self.bit = bit
+        self.dataType = definition[2]
+
+        length = str(definition[3])
+        self.prefixDigits = length.count('.')
+        self.maxLength = int(length.lstrip('.'))
+        self.variable = self.prefixDigits > 0
+        self.prefixBCD = self.dataType in _BCD_TYPES or self.prefixDigits == 4
+
+        if not self.variable:
+            self.prefixWidth = 0
+        elif self.prefixBCD:
+            self.prefixWidth = (self.prefixDigits + 1) / 2
+        else:
+            self.prefixWidth = self.prefixDigits
+
+        if self.dataType in _BCD_TYPES:
+            self.encoding = 'bcd'
+        elif self.dataType == 'x+n':
+            self.encoding = 'signed'
+        elif self.dataType == 'b':
+            self.encoding = 'binary'
+        else:
+            self.encoding = 'ascii'
+
+        if self.variable:
+            self.width = None
+            self.encode, self.decode, self.measure = _variableCodec(self)
+        else:
+            self.width = _fixedWidth(self.encoding, self.maxLength)
+            self.encode, self.decode, self.measure = _fixedCodec(self)
+
+    def lengthType(self):
+        """Return the length indicator of the bit: F, LL, LLL or LLLL"""
+        if self.variable:
+            return 'L' * self.prefixDigits
+        return 'F'
+
+
+def _fixedWidth(encoding, size):
+    """Width of a fixed length field in bytes"""
+    if encoding == 'bcd' or encoding == 'binary':
+        return (size + 1) / 2
+    if encoding == 'signed':
+        return 1 + size / 2
+    return size
+
+
+def _tooLarge(plan, value):
+    return ValueToLarge('Error: value up to size! Bit[%s] of type %s limit size = %s' % (
+        plan.bit, plan.lengthType(), plan.maxLength))
+
+
+def _packHex(plan, value):
+    """Pack a string of hex digits (BCD or binary data given in hex) into bytes"""
+    try:
+        return binascii.unhexlify(value)
+    except TypeError:
+        raise InvalidValueType('Error: Bit[%s] of type %s only takes hex digits, not [%s]' % (
+            plan.bit, plan.dataType, value))
+
+
+def _fixedCodec(plan):
+    """Build the (encode, decode, measure) functions of a fixed length bit"""
+    size = plan.maxLength
+    width = plan.width
+
+    def measure(data, offset):
+        return width
+
+    if plan.encoding == 'bcd' or plan.encoding == 'binary':
+        digits = width * 2
+
+        def encode(value):
+            value = str(value)
+            if len(value) > size:
+                raise _tooLarge(plan, value)
+            return _packHex(plan, value.rjust(digits, '0'))
+
+        def decode(data):
+            return binascii.hexlify(data)[digits - size:].upper()
+
+    elif plan.encoding == 'signed':
+        digits = (width - 1) * 2
+
+        def encode(value):
+            value = str(value)
+            if len(value) > size:
+                raise _tooLarge(plan, value)
+            return value[0] + _packHex(plan, value[1:].rjust(digits, '0'))
+
+        def decode(data):
+            return data[0] + binascii.hexlify(data[1:])[digits - size + 1:].upper()
+
+    else:
+        def encode(value):
+            value = str(value)
+            if len(value) > size:
+                raise _tooLarge(plan, value)
+            return value.ljust(size)
+
+        def decode(data):
+            return data
+
+    return encode, decode, measure
+
+
+def _variableCodec(plan):
+    """Build the (encode, decode, measure) functions of a LL, LLL or LLLL bit"""
+    size = plan.maxLength
+    digits = plan.prefixDigits
+    prefixWidth = plan.prefixWidth
+
+    if plan.prefixBCD:
+        def prefix(length):
+            return binascii.unhexlify(str(length).zfill(prefixWidth * 2))
+
+        def readLength(data, offset):
+            return int(binascii.hexlify(data[offset:offset + prefixWidth]))
+    else:
+        def prefix(length):
+            return str(length).zfill(digits)
+
+        def readLength(data, offset):
+            return int(data[offset:offset + prefixWidth])
+
+    if plan.encoding == 'bcd':
+        def encode(value):
+            value = str(value)
+            length = len(value)
+            if length > size:
+                raise _tooLarge(plan, value)
+            if length % 2:
+                value += 'F'
+            return prefix(length) + _packHex(plan, value)
+
+        def decode(data):
+            return binascii.hexlify(data[prefixWidth:])[:readLength(data, 0)].upper()
+
+        def contentWidth(length):
+            return (length + 1) / 2
+
+    elif plan.encoding == 'binary':
+        def encode(value):
+            value = str(value)
+            if len(value) % 2:
+                value = '0' + value
+            length = len(value) / 2
+            if length > size:
+                raise _tooLarge(plan, value)
+            return prefix(length) + _packHex(plan, value)
+
+        def decode(data):
+            return binascii.hexlify(data[prefixWidth:]).upper()
+
+        def contentWidth(length):
+            return length
+
+    else:
+        def encode(value):
+            value = str(value)
+            length = len(value)
+            if length > size:
+                raise _tooLarge(plan, value)
+            return prefix(length) + value
+
+        def decode(data):
+            return data[prefixWidth:]
+
+        def contentWidth(length):
+            return length
+
+    def measure(data, offset):
+        length = readLength(data, offset)
+        if length > size:
+            raise ValueToLarge("This bit is larger than the specification!")
+        return prefixWidth + contentWidth(length)
+
+    return encode, decode, measure
+
+
+def _compilePlan(definitions):
+    """Compile _DEF into a list indexed by bit number, None for bits that are not defined"""
+    plan = [None] * 129
+    for bit, definition in definitions.items():
+        if bit > 1:
+            plan[bit] = _FieldPlan(bit, definition)
+    return plan
+
+
+def _measureField(plan, bit, data, offset):
+    """Return the length on the wire of one bit that starts at offset in a binary message
+    @raise: InvalidAS2805 Exception, ValueToLarge Exception
+    """
+    field = plan[bit]
+    if field is None:
+        raise InvalidAS2805('Bit %s is present but not defined!' % bit)
+
+    length = field.measure(data, offset)
+    if offset + length > len(data):
+        raise InvalidAS2805('This is not a valid iso!! Bit %s is truncated' % bit)
+    return length
+
+
+################################################################################################
+# Bitmaps
+#
+# The primary and the secondary bitmaps are each held as one 64 bit integer, bit N of a bitmap
+# being 1 << (64 - N) like on the wire. Present bits are enumerated by peeling off the lowest set
+# bit, so the cost is proportional to the number of bits present instead of 128.
+################################################################################################
+
+_BITMAP_SECONDARY = 1 << 63  # bit 1, a secondary bitmap follows
+
+
+def _bitMask(bit):
+    """Return (secondary, mask) of a bit number, 1..128"""
+    if bit > 64:
+        return True, 1 << (128 - bit)
+    return False, 1 << (64 - bit)
+
+
+def _bitsFromBitmap(bitmap, first):
+    """Return the bits present in a 64 bit bitmap in ascending order
+    @param: bitmap -> the bitmap as an integer
+    @param: first -> number of the first bit of this bitmap, 1 or 65
+    """
+    bits = []
+    while bitmap:
+        lowest = bitmap & -bitmap
+        bits.append(first + 64 - lowest.bit_length())
+        bitmap ^= lowest
+    bits.reverse()
+    return bits
+
+
+def _presentBits(primary, secondary):
+    """Return the data bits present in the bitmaps in ascending order, without the bit 1 indicator"""
+    return _bitsFromBitmap(primary & ~_BITMAP_SECONDARY, 1) + _bitsFromBitmap(secondary, 65)
+
+
+def _bitmapFromBytes(data):
+    """Return (primary, secondary, size in bytes) of the bitmap at the start of data
+    @raise: InvalidAS2805 Exception when the bitmaps are truncated
+    """
+    if len(data) < 8:
+        raise InvalidAS2805('This is not a valid iso!! The primary bitmap is truncated')
+    primary, = struct.unpack('!Q', data[0:8])
+    if primary & _BITMAP_SECONDARY:
+        if len(data) < 16:
+            raise InvalidAS2805('This is not a valid iso!! The secondary bitmap is truncated')
+        secondary, = struct.unpack('!Q', data[8:16])
+        return primary, secondary, 16
+    return primary, 0, 8
+
+
+def _bitmapToBytes(primary, secondary):
+    """Return the wire representation of the bitmaps, the secondary one only if it is used"""
+    if secondary:
+        return struct.pack('!QQ', primary | _BITMAP_SECONDARY, secondary)
+    return struct.pack('!Q', primary & ~_BITMAP_SECONDARY)
+
+
+def _toBytes(data):
+    """Return data as a str, a memoryview, bytearray or buffer is copied once"""
+    if isinstance(data, str):
+        return data
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return str(data)
+
+
+def _checkFrameSize(iso, bigEndian):
+    """Check the 4 bytes size at the start of a network frame against the length of the message after it
+    @param: iso -> the frame, str, bytearray, memoryview or buffer
+    @raise: InvalidAS2805 Exception
+    """
+    size, = struct.unpack_from('!I' if bigEndian else '<I', iso)
+    if size != len(iso) - 4:
+        raise InvalidAS2805('This is not a valid iso!!The AS2805 message is %d bytes, not the size %d!' % (len(iso) - 4, size))
+
+
+def _writeFrame(buf, offset, message, bigEndian):
+    """Write the 4 bytes size and then the binary message into buf at offset
+    @param: buf -> bytearray or writable memoryview, it is never resized
+    @return: number of bytes written
+    @raise: ValueToLarge Exception
+    """
+    size = len(message)
+    if offset + 4 + size > len(buf):
+        raise ValueToLarge('The buffer is too small! %d bytes are needed at %d' % (4 + size, offset))
+
+    buf[offset:offset + 4] = struct.pack('!I' if bigEndian else '<I', size)
+    buf[offset + 4:offset + 4 + size] = message
+    return 4 + size
+
+
+################################################################################################
+# Bitmap shapes
+#
+# A handful of bitmap shapes (0200 purchase, 0420 reversal, 0800 echo, 0820 key change, ...) carry
+# nearly all the traffic. A _ShapePlan is the layout of the bits of one shape: when every bit is fixed
+# length the slices are computed once, otherwise only the length prefixes of the variable bits are
+# read. The plans are kept in a bounded LRU keyed by the bitmap bytes.
+# Once a shape is hot, its plan generates straight line Python functions that slice the bits out of a
+# message and join them back together, without any loop or per bit test. Shapes seen less often than
+# that keep using the generic loops.
+################################################################################################
+
+class _ShapePlan:
+    """Layout of the bits present in one bitmap shape, offsets are from the start of the binary message.
+    @param: plan -> the compiled field plan
+    @param: bitmap -> the bitmap bytes, primary and secondary
+    @raise: InvalidAS2805 Exception
+    """
+
+    def __init__(self, plan, bitmap):
+        primary, secondary, size = _bitmapFromBytes(bitmap)
+        self.bitmap = bitmap
+        self.bits = _presentBits(primary, secondary)
+        self.offset = 2 + size
+
+        self.uses = 0
+        self.decoder = None
+        self.encoder = None
+
+        self.steps = []
+        for bit in self.bits:
+            field = plan[bit]
+            if field is None:
+                raise InvalidAS2805('Bit %s is present but not defined!' % bit)
+            self.steps.append((bit, field.width, field.measure))
+
+        # all fixed, the spans never change
+        self.spans = None
+        self.end = self.offset
+        if None not in [width for bit, width, measure in self.steps]:
+            self.spans = []
+            for bit, width, measure in self.steps:
+                self.spans.append((bit, self.end, width))
+                self.end += width
+
+    def locate(self, data, last=128):
+        """Lay the bits out in a binary message of this shape, nothing after bit last is read
+        @return: list of (bit, offset, length), one per bit
+        @raise: InvalidAS2805 Exception, ValueToLarge Exception
+        """
+        end = len(data)
+        if self.spans is not None and self.end <= end:
+            return self.spans
+
+        spans = []
+        offset = self.offset
+        for bit, width, measure in self.steps:
+            if bit > last:
+                break
+            length = width or measure(data, offset)
+            if offset + length > end:
+                raise InvalidAS2805('This is not a valid iso!! Bit %s is truncated' % bit)
+            spans.append((bit, offset, length))
+            offset += length
+        return spans
+
+    def decode(self, data, values):
+        """Slice the bits of a binary message of this shape into values, a list indexed by bit number
+        @raise: InvalidAS2805 Exception, ValueToLarge Exception
+        """
+        if self.decoder is not None:
+            if self.decoder(data, values) <= len(data):
+                return
+            # short message, the generic path tells which bit is truncated
+            self.locate(data)
+
+        for bit, offset, length in self.locate(data):
+            values[bit] = data[offset:offset + length]
+
+    def encode(self, mti, bitmap, values):
+        """Return the binary message of this shape, the bits are taken from values as they are held"""
+        if self.encoder is not None:
+            return self.encoder(mti, bitmap, values)
+        return ''.join([mti, bitmap] + [values[bit] for bit in self.bits])
+
+    def compile(self):
+        """Generate the straight line decoder and encoder of this shape"""
+        namespace = {}
+        lines = ['def decoder(data, values):']
+
+        # constant offsets up to the first variable bit, then relative to the end of the last one
+        fixed = self.offset
+        relative = 0
+        for bit, width, measure in self.steps:
+            if fixed is not None and width:
+                lines.append('    values[%d] = data[%d:%d]' % (bit, fixed, fixed + width))
+                fixed += width
+                continue
+
+            if fixed is not None:
+                lines.append('    offset = %d' % fixed)
+                fixed = None
+
+            if width:
+                lines.append('    values[%d] = data[offset + %d:offset + %d]' % (bit, relative, relative + width))
+                relative += width
+            else:
+                if relative:
+                    lines.append('    offset += %d' % relative)
+                    relative = 0
+                namespace['measure%d' % bit] = measure
+                lines.append('    end = offset + measure%d(data, offset)' % bit)
+                lines.append('    values[%d] = data[offset:end]' % bit)
+                lines.append('    offset = end')
+
+        if fixed is not None:
+            lines.append('    return %d' % fixed)
+        else:
+            lines.append('    return offset + %d' % relative)
+
+        lines.append('def encoder(mti, bitmap, values):')
+        lines.append('    return "".join((mti, bitmap%s))' % ''.join([', values[%d]' % bit for bit in self.bits]))
+
+        source = '\n'.join(lines) + '\n'
+        exec(compile(source, '<AS2805 shape %s>' % binascii.hexlify(self.bitmap), 'exec'), namespace)
+        self.source = source
+        self.decoder = namespace['decoder']
+        self.encoder = namespace['encoder']
+
+
+class ShapePlanCache:
+    """Bounded LRU of the bitmap shape plans, keyed by the bitmap bytes.
+    @param: plan -> the compiled field plan the shapes are built from
+    @param: maxsize -> number of shapes kept, the least recently used one is dropped first
+    @param: hot -> number of hits after which a shape gets its generated decoder and encoder,
+            0 to generate them straight away, None to always use the generic path
+    """
+
+    def __init__(self, plan, maxsize=64, hot=2):
+        self.PLAN = plan
+        self.MAXSIZE = maxsize
+        self.HOT = hot
+        self.HITS = 0
+        self.MISSES = 0
+        self._SHAPES = OrderedDict()
+        self._LOCK = threading.Lock()
+
+    def get(self, bitmap):
+        """Return the _ShapePlan of a bitmap, building it on a miss
+        @param: bitmap -> the bitmap bytes, primary and secondary, str or a buffer object such as a memoryview
+        @raise: InvalidAS2805 Exception
+        """
+        bitmap = _toBytes(bitmap)
+        with self._LOCK:
+            shape = self._SHAPES.pop(bitmap, None)
+            if shape is not None:
+                self.HITS += 1
+                self._SHAPES[bitmap] = shape
+            else:
+                self.MISSES += 1
+
+        if shape is not None:
+            shape.uses += 1
+            if shape.uses == self.HOT:
+                shape.compile()
+            return shape
+
+        shape = _ShapePlan(self.PLAN, bitmap)
+        if self.HOT == 0:
+            shape.compile()
+        with self._LOCK:
+            self._SHAPES[bitmap] = shape
+            while len(self._SHAPES) > self.MAXSIZE:
+                self._SHAPES.popitem(last=False)
+        return shape
+
+    def stats(self):
+        """Return a dict with the hits, misses, size and maxsize of the cache"""
+        with self._LOCK:
+            return {'hits': self.HITS, 'misses': self.MISSES, 'size': len(self._SHAPES), 'maxsize': self.MAXSIZE}
+
+    def clear(self):
+        """Drop every shape and reset the counters"""
+        with self._LOCK:
+            self._SHAPES.clear()
+            self.HITS = 0
+            self.MISSES = 0
+
+
 class AS2805:
     #Attributes
-    # Bits to be set 00000000 -> _BIT_POSITION_1 ... _BIT_POSITION_8
-    _BIT_POSITION_1 = 128 # 10 00 00 00
-    _BIT_POSITION_2 = 64 # 01 00 00 00
-    _BIT_POSITION_3 = 32 # 00 10 00 00
-    _BIT_POSITION_4 = 16 # 00 01 00 00
-    _BIT_POSITION_5 = 8 # 00 00 10 00
-    _BIT_POSITION_6 = 4 # 00 00 01 00
-    _BIT_POSITION_7 = 2 # 00 00 00 10
-    _BIT_POSITION_8 = 1 # 00 00 00 01
-
-    #Array to translate bit to position
-    _TMP = [0, _BIT_POSITION_8, _BIT_POSITION_1, _BIT_POSITION_2, _BIT_POSITION_3, _BIT_POSITION_4, _BIT_POSITION_5,
-            _BIT_POSITION_6, _BIT_POSITION_7]
     _EMPTY_VALUE = 0
+    _EMPTY_VALUES = [_EMPTY_VALUE] * 129
 
 
     #2805 contants
@@ -37,6 +535,10 @@ class AS2805:
     # Z = length indicator of the bit (F, LL, LLL, LLLL, LLLLL, LLLLLL)
     # W = size of the information
     # K = type of values a, an, ans, as, b, ns, s, x, z, this is also the type of the length indicator
+    #
+    # In the table below K comes third and Z/W are folded into the last column: every leading dot
+    # is a digit of the length indicator, so '..19' is LL, '...999' is LLL and '....999' is 0LLL.
+    # Numeric (n, z) and 0LLL indicators are BCD, the others are ASCII digits.
     # P = format of the message
     """
     Type	Meaning
@@ -61,7 +563,7 @@ class AS2805:
     _DEF[8] = ['8', 'Amount Cardholder Billing Fee',             'n',    '8']
     _DEF[9] = ['9', 'Conversion Rate, Settlement',               'n',    '8']
     _DEF[10] = ['10', 'Conversion Rate, Cardholder Billing',     'n',    '8']
-    _DEF[11] = ['11', 'Systems Trace Audit Number',              'n',    '8']
+    _DEF[11] = ['11', 'Systems Trace Audit Number',              'n',    '6']
     _DEF[12] = ['12', 'Time, Local Transaction',                 'n',    '6']
     _DEF[13] = ['13', 'Date, Local Transaction',                 'n',    '4']
     _DEF[14] = ['14', 'Date, Expiration',                        'n',    '4']
@@ -84,7 +586,7 @@ class AS2805:
     _DEF[31] = ['31', 'Amount, Settlement Processing Fee',     'x+n',    '9']
     _DEF[32] = ['32', 'Acquiring Institution ID Code',          'n',  '..11']
     _DEF[33] = ['33', 'Forwarding Institution ID Code',         'n',  '..11']
-    _DEF[34] = ['34', 'PAN Extended'                            'ns', '..28']
+    _DEF[34] = ['34', 'PAN Extended',                           'ns', '..28']
     _DEF[35] = ['35', 'Track 2 Data',                           'z',  '..37']
     _DEF[36] = ['36', 'Track 3 Data',                           'z','...104']
     _DEF[37] = ['37', 'Retrieval Reference Number',            'an',    '12']
@@ -98,14 +600,14 @@ class AS2805:
     _DEF[45] = ['45', 'Track 1 Data',                          'ans', '..76']
     _DEF[46] = ['46', 'Additional  Data ISO ',                'ans','...999']
     _DEF[47] = ['47', 'Additional Data National',             'ans','...999']
-    _DEF[48] = ['48', 'Additional Data Private',              'ans','...999']
+    _DEF[48] = ['48', 'Additional Data Private',                'b','...999']
     _DEF[49] = ['49', 'Currency Code, Transaction',              'n',    '3']
     _DEF[50] = ['50', 'Currency Code, Settlement',               'n',    '3']
     _DEF[51] = ['51', 'Currency Code, Billing',                  'n',    '3']
     _DEF[52] = ['52', 'PIN Data',                                'b',   '16']
     _DEF[53] = ['53', 'Security Related Control Information',    'n',   '16']
     _DEF[54] = ['54', 'Additional Amounts',                    'an','...120']
-    _DEF[55] = ['55', 'ICC Data',                               'b','...999']
+    _DEF[55] = ['55', 'ICC Data',                              'b','....999']
     _DEF[57] = ['57', 'Amount Cash',                            'n',    '12']
     _DEF[58] = ['58', 'Ledger Balance',                         'n',    '12']
     _DEF[59] = ['59', 'Account Balance',                        'n',    '12']
@@ -142,34 +644,53 @@ class AS2805:
     _DEF[95] = ['95', 'Replacement Amounts',                     'an',  '42']
     _DEF[96] = ['96', 'Message Security Code',                   'b',   '64']
     _DEF[97] = ['97', 'Amount, Net Settlement',                  'x+n', '16']
-    _DEF[98] = ['98', 'Payee'                                   'ans','..25']
+    _DEF[98] = ['98', 'Payee',                                  'ans','..25']
     _DEF[99] = ['99', 'Settlement Institution ID Code',          'n', '..11']
     _DEF[100] = ['100', 'Receiving Institution ID Code',         'n', '..11']
     _DEF[101] = ['101', 'File Name',                            'ans','..17']
     _DEF[102] = ['102', 'Account Identification 1',             'ans','..28']
     _DEF[103] = ['103', 'Account Identification 2',             'ans','..28']
     _DEF[104] = ['104', 'Transaction Description',            'ans','...100']
-    _DEF[112] = ['112', 'Key Management Data',                 'b', '...999']
+    _DEF[112] = ['112', 'Key Management Data',                 'b','....999']
     _DEF[117] = ['117', 'Card Status Update Code',              'an',    '2']
     _DEF[118] = ['118', 'Cash Total Number',                     'n',   '10']
     _DEF[119] = ['119', 'Cash Total Amount',                     'n',   '16']
     _DEF[128] = ['128',  'MAC Extended',                         'b',   '16']
 
+    # _DEF compiled once, indexed by bit number (see _compilePlan)
+    _PLAN = _compilePlan(_DEF)
+    _SHAPES = ShapePlanCache(_PLAN)
+
+    # AS2805.4: the MAC is the left 4 bytes of the retail MAC, zero filled to the 8 bytes of bit 64 and 128
+    _MAC_SIZE = 4
+    _MAC_FILL = '\0' * 4
 
-    def __init__(self, iso="", debug=False):
+
+    def __init__(self, iso="", debug=False, lazy=False):
         """Default Constructor of AS2805 Package.
         It initialize a "brand new" AS2805 package
         Example: To Enable debug you can use:
         pack = AS2895(debug=True)
         @param: iso a String that represents the ASCII of the package. The same that you need to pass to setIsoContent() method.
         @param: debug (True or False) default False -> Used to print some debug infos. Only use if want that messages!
+        @param: lazy (True or False) default False -> When parsing, only the MTI and the bitmaps are read. The bits
+                are located in the received message up to the one that getBit() asks for, and sliced out then.
         """
-        #Bitmap internal representation
-        self.BITMAP = []
+        #Bitmap internal representation, bits 1..64 and 65..128
+        self.PRIMARY_BITMAP = 0
+        self.SECONDARY_BITMAP = 0
 
         #Values
         self._VALUES = []
 
+        #Lazy decoding, the received message, the bits not walked yet (descending, next one last), where the
+        #next one starts and the {bit: (offset, length)} of the bits walked but not read yet
+        self.LAZY = lazy
+        self._BUFFER = ''
+        self._PENDING = []
+        self._CURSOR = 0
+        self._SPANS = {}
+
         #Bitmap ASCII representantion
         self.BITMAP_HEX = ''
 
@@ -186,12 +707,36 @@ class AS2805:
 
     ################################################################################################
 
+    def reset(self):
+        """Method that clear the package so it can hold another message, the bitmaps and the bit slots are reused.
+        DEBUG and LAZY are kept.
+        Example: pack.reset(); pack.setNetworkISO(frame)
+        """
+        self.__initializeBitmap()
+        self.__initializeValues()
+        self.MESSAGE_TYPE_INDICATION = ''
+        self._BUFFER = ''
+        del self._PENDING[:]
+        self._CURSOR = 0
+        self._SPANS.clear()
+
+    ################################################################################################
+
     def getLengthType(self, bit):
         """Method that return the bit Type
         @param: bit -> Bit that will be searched and whose type will be returned
-        @return: str that represents the type of the bit
+        @return: str that represents the type of the bit (F, LL, LLL or LLLL)
         """
-        return self._DEF[bit][2]
+        return self._PLAN[bit].lengthType()
+
+    ################################################################################################
+
+    def getDataType(self, bit):
+        """Method that return the bit value type
+        @param: bit -> Bit that will be searched and whose value type will be returned
+        @return: str that indicate the value type of the bit (n, an, ans, b, z ...)
+        """
+        return self._PLAN[bit].dataType
 
     ################################################################################################
 
@@ -200,7 +745,7 @@ class AS2805:
         @param: bit -> Bit that will be searched and whose limit will be returned
         @return: int that indicate the limit of the bit
         """
-        return self._DEF[bit][3]
+        return self._PLAN[bit].maxLength
 
     ################################################################################################
 
@@ -240,12 +785,9 @@ class AS2805:
         if self.DEBUG:
             print 'Init bitmap'
 
-        if len(self.BITMAP) == 16:
-            for cont in range(0, 16):
-                self.BITMAP[cont] = self._EMPTY_VALUE
-        else:
-            for cont in range(0, 16):
-                self.BITMAP.append(self._EMPTY_VALUE)
+        self.PRIMARY_BITMAP = 0
+        self.SECONDARY_BITMAP = 0
+        self.BITMAP_HEX = ''
 
 
                 ################################################################################################
@@ -258,23 +800,9 @@ class AS2805:
             print 'Init bitmap_values'
 
         if len(self._VALUES) == 129:
-            for cont in range(0, 129):
-                self._VALUES[cont] = self._EMPTY_VALUE
+            self._VALUES[:] = self._EMPTY_VALUES
         else:
-            for cont in range(0, 129):
-                self._VALUES.append(self._EMPTY_VALUE)
-
-
-
-    def __get_AS2805_Valiable_Length_Prefix(self, bit):
-
-        Length_Indicator = str(self._DEF[bit][3])
-
-
-
-
-
-
+            self._VALUES = self._EMPTY_VALUES[:]
 
 
 
@@ -289,38 +817,25 @@ class AS2805:
         @raise: BitInexistent Exception, ValueToLarge Exception
         """
 
-
-
-        if bit < 1 or bit > 129:
+        if bit < 1 or bit > 128 or self._PLAN[bit] is None:
             raise BitInexistent("Bit number %s dosen't exist!" % bit)
 
         if self.DEBUG:
-            print 'Setting Bit %s (%s) = [%s]' % (bit, self.getBitName(bit), ReadableAscii(value))
+            print 'Setting Bit %s (%s) = [%s]' % (bit, self.getBitName(bit), ReadableAscii(str(value)))
 
-        Length_Indicator = str(self._DEF[bit][3]).count('.')
-
-        if Length_Indicator == 0:
-            self.__setBitFixedLength(bit, value)
-        else:
-            self.__setBitVariableLength(bit, value)
+        self._VALUES[bit] = self._PLAN[bit].encode(value)
 
         if self.DEBUG:
-            print 'Bit was set to %s (%s) = [%s]' % (bit, self.getBitName(bit), str(self._VALUES[bit]))
-
+            print 'Bit was set to %s (%s) = [%s]' % (bit, self.getBitName(bit), binascii.hexlify(self._VALUES[bit]))
 
 
-        #Continuation bit?
-        if bit > 64:
-            self.BITMAP[0] |= self._TMP[2]  # need to set bit 1 of first "bit" in bitmap
 
-        if (bit % 8) == 0:
-            pos = (bit / 8) - 1
+        secondary, mask = _bitMask(bit)
+        if secondary:
+            self.SECONDARY_BITMAP |= mask
         else:
-            pos = (bit / 8)
-
-        #need to check if the value can be there .. AN , N ... etc ... and the size
-
-        self.BITMAP[pos] |= self._TMP[(bit % 8) + 1]
+            self.PRIMARY_BITMAP |= mask
+        self.BITMAP_HEX = ''
 
         return True
 
@@ -343,63 +858,26 @@ class AS2805:
         It's a internal method, so don't call!
         """
 
-        self.BITMAP_HEX = ''
-        self.BITMAP_BIN = ''
-
-        for c in range(0, 16):
-            if (self.BITMAP[0] & self._BIT_POSITION_1) != self._BIT_POSITION_1:
-            # Only has the first bitmap
-            #				if self.DEBUG == True:
-            #					print '%d Bitmap = %d(Decimal) = %s (hexa) ' %(c, self.BITMAP[c], hex(self.BITMAP[c]))
-
-                tm = hex(self.BITMAP[c])[2:]
-                if len(tm) != 2:
-                    tm = '0' + tm
-                self.BITMAP_HEX += tm
-                self.BITMAP_BIN += chr(self.BITMAP[c])
-                if c == 7:
-                    break
-            else: # second bitmap
-            #				if self.DEBUG == True:
-            #					print '%d Bitmap = %d(Decimal) = %s (hexa) ' %(c, self.BITMAP[c], hex(self.BITMAP[c]))
-
-                tm = hex(self.BITMAP[c])[2:]
-                if len(tm) != 2:
-                    tm = '0' + tm
-                self.BITMAP_HEX += tm
-                self.BITMAP_BIN += chr(self.BITMAP[c])
-
-
-    ################################################################################################
-
-    def __getBitmapFromStr(self, bitmap):
-            """Method that receive a bitmap str and transfor it to ISO8583 object readable.
-            @param: bitmap -> bitmap str to be readable
-            It's a internal method, so don't call!
-            """
-            #Need to check if the size is correct etc...
-            cont = 0
-
-            if self.BITMAP_HEX != '':
-                    self.BITMAP_HEX = ''
+        self.BITMAP_BIN = _bitmapToBytes(self.PRIMARY_BITMAP, self.SECONDARY_BITMAP)
+        self.BITMAP_HEX = binascii.hexlify(self.BITMAP_BIN)
 
-            for x in range(0,32,2):
-                    if (int(bitmap[0:2],16) & self._BIT_POSITION_1) != self._BIT_POSITION_1: # Only 1 bitmap
-                            if self.DEBUG:
-                                    print 'Token[%d] %s converted to int is = %s' %(x, bitmap[x:x+2], int(bitmap[x:x+2],16))
+    ################################################################################################
 
-                            self.BITMAP_HEX += bitmap[x:x+2]
-                            self.BITMAP[cont] = int(bitmap[x:x+2],16)
-                            if x == 14:
-                                    break
-                    else: # Second bitmap
-                            if self.DEBUG:
-                                    print 'Token[%d] %s converted to int is = %s' %(x, bitmap[x:x+2], int(bitmap[x:x+2],16))
+    def __getBitmapFromBytes(self, data, offset):
+        """Method that receive the binary message and read the bitmaps that start at offset.
+        @param: data -> binary message
+        @param: offset -> where the bitmap starts
+        @return: size of the bitmaps in bytes
+        It's a internal method, so don't call!
+        """
+        self.PRIMARY_BITMAP, self.SECONDARY_BITMAP, size = _bitmapFromBytes(data[offset:offset + 16])
+        self.BITMAP_BIN = data[offset:offset + size]
+        self.BITMAP_HEX = binascii.hexlify(self.BITMAP_BIN)
 
-                            self.BITMAP_HEX += bitmap[x:x+2]
-                            self.BITMAP[cont] = int(bitmap[x:x+2],16)
-                    cont += 1
+        if self.DEBUG:
+            print 'Bitmap %s = %s' % (self.BITMAP_HEX, self.__getBitsFromBitmap())
 
+        return size
 
     ################################################################################################
 
@@ -408,120 +886,31 @@ class AS2805:
         Usualy is used to debug things.
         @param: bitmap -> bitmap str to be analized and translated to "bits"
         """
-        bits = self.__initializeBitsFromBitmapStr()
+        primary, secondary, size = _bitmapFromBytes(binascii.unhexlify(bitmap[0:32]))
+        bits = _bitsFromBitmap(primary, 1) + _bitsFromBitmap(secondary, 65)
         print 'Bits inside %s  = %s' % (bitmap, bits)
 
     ################################################################################################
 
-    def __initializeBitsFromBitmapStr(self):
-        """Method that receive a bitmap str, process it, and prepare AS2805 object to understand and "see" the bits and values inside the ISO ASCII package.
-        It's a internal method, so don't call!
-        @param: bitmap -> bitmap str to be analized and translated to "bits"
-        """
-        bits = []
-        for c in range(0, 16):
-            for d in range(1, 9):
-                #if self.DEBUG == True:
-                #print 'Value (%d)-> %s & %s = %s' % (d,self.BITMAP[c] , self._TMP[d], (self.BITMAP[c] & self._TMP[d]) )
-                if (self.BITMAP[c] & self._TMP[d]) == self._TMP[d]:
-                    if d == 1: #  e o 8 bit
-                        if self.DEBUG:
-                            print 'Bit %s is present !!!' % ((c + 1) * 8)
-                        bits.append((c + 1) * 8)
-                        self._VALUES[(c + 1) * 8] = 'X'
-                    else:
-                        if (c == 0) & (d == 2): # Continuation bit
-                            if self.DEBUG:
-                                print 'Bit 1 is present !!!'
-
-                            bits.append(1)
-
-                        else:
-                            if self.DEBUG:
-                                print 'Bit %s is present !!!' % (c * 8 + d - 1)
-
-                            bits.append(c * 8 + d - 1)
-                            self._VALUES[c * 8 + d - 1] = 'X'
-
-        bits.sort()
-
-        return bits
-
-    ################################################################################################
-
     def __getBitsFromBitmap(self):
         """Method that process the bitmap and return a array with the bits presents inside it.
         It's a internal method, so don't call!
         """
-        bits = []
-        for c in range(0, 16):
-            for d in range(1, 9):
-            #				if self.DEBUG == True:
-            #					print 'Value (%d)-> %s & %s = %s' % (d,self.BITMAP[c] , self._TMP[d], (self.BITMAP[c] & self._TMP[d]) )
-                if (self.BITMAP[c] & self._TMP[d]) == self._TMP[d]:
-                    if d == 1: #  e o 8 bit
-                        if self.DEBUG:
-                            print 'Bit %s is present !!!' % ((c + 1) * 8)
-
-                        bits.append((c + 1) * 8)
-                    else:
-                        if (c == 0) & (d == 2): # Continuation bit
-                            if self.DEBUG:
-                                print 'Bit 1 is present !!!'
-
-                            bits.append(1)
-
-                        else:
-                            if self.DEBUG:
-                                print 'Bit %s is present !!!' % (c * 8 + d - 1)
-
-                            bits.append(c * 8 + d - 1)
-
-        bits.sort()
+        primary = self.PRIMARY_BITMAP
+        if self.SECONDARY_BITMAP:
+            primary |= _BITMAP_SECONDARY
+        else:
+            primary &= ~_BITMAP_SECONDARY
 
-        return bits
+        return _bitsFromBitmap(primary, 1) + _bitsFromBitmap(self.SECONDARY_BITMAP, 65)
 
     ################################################################################################
 
-    def __setBitVariableLength(self, bit, value):
-
-        value_data = self.__set_Octet_Data(value)
-        length_data = self.__setLengthIndicator(bit, len(value_data))
-
-        self._VALUES[bit] = "%s%s" % (length_data, value_data)
-        #print "Setting Bits: " + self._VALUES[bit] + " type: " + type + " Variable"
-
-
-
-    def __setLengthIndicator(self, bit, length):
-        if (str(self._DEF[bit][3]).count('.') == 3) and  (self._DEF[bit][2] == 'b'):#0LLL 2 octets
-            return str(length).zfill(2).encode('hex')
-
-        elif (str(self._DEF[bit][3]).count('.') == 3) and  (self._DEF[bit][2] == 'n' or self._DEF[bit][2] == 'z'): #0LLL 2 octets
-            return str(length).zfill(2).encode('hex')
-
-        elif (str(self._DEF[bit][3]).count('.') == 3) and (self._DEF[bit][2] == 'a' or self._DEF[bit][2] == 'ans' or self._DEF[bit][2] == 'ns' or self._DEF[bit][2] == 'x'): #LLL 3 octets
-            return str(length).zfill(3).encode('hex')
-
-        elif (str(self._DEF[bit][3]).count('.') == 2) and  (self._DEF[bit][2] == 'n' or self._DEF[bit][2] == 'z'): #LL 2 octets
-            return str(length).zfill(2).encode('hex')
-
-        elif (str(self._DEF[bit][3]).count('.') == 2) and (self._DEF[bit][2] == 'a' or self._DEF[bit][2] == 'ans' or self._DEF[bit][2] == 'ns' or self._DEF[bit][2] == 'x'): #LL 2 octets
-            return str(length).zfill(2).encode('hex')
-
-
-    def __set_Octet_Data(self, value):
-        return str(value).encode('hex')
-
-
-
-
-
-    def __setBitFixedLength(self, bit, value):
-        result = self.__set_Octet_Data(value)
-        #bit_limit = int(self.getMaxLength(bit))
-        self._VALUES[bit] = result
-
+    def __getPresentFields(self):
+        """Method that return the data bits present in the bitmap, without the bit 1 indicator.
+        It's a internal method, so don't call!
+        """
+        return _presentBits(self.PRIMARY_BITMAP, self.SECONDARY_BITMAP)
 
     ################################################################################################
 
@@ -540,16 +929,12 @@ class AS2805:
         """
         res = '\n%s:\n' % self.MESSAGE_TYPE_INDICATION
 
-        for bit in range(0, 129):
-            if self._VALUES[bit] <> self._EMPTY_VALUE:
-
-                res += " [%s] " % bit
-                res += " [%s%s ] " % (self._DEF[bit][2], self._DEF[bit][3])
-                res += " [%s] " % ReadableAscii(self.getBit(bit))
-                res += self.getBitName(bit)
-                res += '\n'
-
-                #print res
+        for bit in self.__getPresentFields():
+            res += " [%s] " % bit
+            res += " [%s%s ] " % (self._DEF[bit][2], self._DEF[bit][3])
+            res += " [%s] " % ReadableAscii(self.getBit(bit))
+            res += self.getBitName(bit)
+            res += '\n'
 
         return res
 
@@ -593,33 +978,58 @@ class AS2805:
         @raise: InvalidMTI Exception
         """
 
+        return binascii.hexlify(self.__getBinaryIso())
+
+    ################################################################################################
+
+    def __getBinaryIso(self):
+        """Method that return the binary AS2805 message, MTI, bitmaps and the bits as they are held.
+        It's a internal method, so don't call!
+        @raise: InvalidMTI Exception
+        """
+
+        mti = self.__prepareEncoding()
+        return self._SHAPES.get(self.BITMAP_BIN).encode(mti, self.BITMAP_BIN, self._VALUES)
+
+    ################################################################################################
+
+    def __prepareEncoding(self):
+        """Method that build the bitmap, check the MTI and slice out the lazily decoded bits before encoding.
+        It's a internal method, so don't call!
+        @return: the binary MTI
+        @raise: InvalidMTI Exception
+        """
         self.__buildBitmap()
 
-        if self.MESSAGE_TYPE_INDICATION == '':
+        if len(self.MESSAGE_TYPE_INDICATION) != 4 or not self.MESSAGE_TYPE_INDICATION.isdigit():
             raise InvalidMTI('Check MTI! Do you set it?')
 
-        resp = ""
+        if self._BUFFER:
+            self.__sliceAll()
 
-        resp += self.MESSAGE_TYPE_INDICATION
-        resp += binascii.hexlify(self.BITMAP_BIN)
+        return binascii.unhexlify(self.MESSAGE_TYPE_INDICATION)
 
-        for cont in range(0, 129):
-            if self._VALUES[cont] <> self._EMPTY_VALUE:
-                resp = "%s%s" % (resp, self._VALUES[cont])
+    ################################################################################################
 
-        return resp
+    def encodeInto(self, buf, offset=0, bigEndian=True):
+        """Method that write the package, in the getNetworkISO() form, straight into a buffer
+        Example: size = iso.encodeInto(sendBuffer); connection.send(memoryview(sendBuffer)[:size])
+        @param: buf -> bytearray or writable memoryview, it is never resized
+        @param: offset -> where the 4 bytes size is written
+        @param: bigEndian (True|False) -> how the size is represented
+        @return: int -> number of bytes written
+        @raise: InvalidMTI Exception, ValueToLarge Exception
+        """
+        return _writeFrame(buf, offset, self.__getBinaryIso(), bigEndian)
 
     ################################################################################################
 
 
-    def __setMTIFromStr(self, iso):
-        """Method that get the first 4 characters to be the MTI.
+    def __setMTIFromBytes(self, data):
+        """Method that get the first 2 bytes (BCD) to be the MTI.
          It's a internal method, so don't call!
          """
-        if self.DEBUG:
-            print '__setMTIFromStr(%s)' % ReadableAscii(iso)
-
-        self.MESSAGE_TYPE_INDICATION = iso[0:4]
+        self.MESSAGE_TYPE_INDICATION = binascii.hexlify(data[0:2])
 
         if self.DEBUG:
             print 'MTI found was [%s]' % self.MESSAGE_TYPE_INDICATION
@@ -651,168 +1061,347 @@ class AS2805:
         """Method that return an internal array of the package
         @return: array -> with all bits, presents or not in the bitmap
         """
+        if self._BUFFER:
+            self.__sliceAll()
+
         return self._VALUES
 
     ################################################################################################
 
-    def __getBitFromStr(self, strWithoutMtiBitmap):
-        """Method that receive a string (ASCII) without MTI and Bitmaps (first and second), understand it and remove the bits values
-        @param: str -> with all bits presents whithout MTI and bitmap
+    def __getBitFromBytes(self, data, offset):
+        """Method that receive the binary message and slice the bits values, that start at offset, out of it
+        @param: data -> binary message
+        @param: offset -> where the first bit after the bitmaps starts
         It's a internal method, so don't call!
         """
 
-        if self.DEBUG:
-            print '__getBitFromStr(%s)' % ReadableAscii(strWithoutMtiBitmap)
-
-
+        self._SPANS.clear()
+        if self.LAZY:
+            self._BUFFER = data
+            self._PENDING = self.__getPresentFields()[::-1]
+            self._CURSOR = offset
+            return
 
+        shape = self._SHAPES.get(self.BITMAP_BIN)
 
+        self._BUFFER = ''
+        self._PENDING = []
+        if not self.DEBUG:
+            shape.decode(data, self._VALUES)
+            return
 
-        offset = 0
-        # jump bit 1 because it was alread defined in the "__initializeBitsFromBitmapStr"
-        for cont in range(2, 129):
-            if self._VALUES[cont] <> self._EMPTY_VALUE:
-                if self.DEBUG:
-                    print 'String = %s offset = %s bit = %s' % (strWithoutMtiBitmap[offset:], offset, cont)
+        for cont, start, length in shape.locate(data):
+            self._VALUES[cont] = data[start:start + length]
 
-                if cont == 55:
-                    pass
-
-                #valiable length field
-                if str(self._DEF[cont][3]).count('.') > 0:
-                    valueSize = 0
-
-                    if (str(self._DEF[cont][3]).count('.') == 3)   and  (self._DEF[cont][2] == 'b'):#0LLL 2 octets
-                        lengthIndicator = 4
-
-                    elif (str(self._DEF[cont][3]).count('.') == 3) and  (self._DEF[cont][2] == 'n' or self._DEF[cont][2] == 'z'): #0LLL 2 octets
-                        lengthIndicator = 4
-
-                    elif (str(self._DEF[cont][3]).count('.') == 3) and (self._DEF[cont][2] == 'a' or self._DEF[cont][2] == 'ans' or self._DEF[cont][2] == 'ns' or self._DEF[cont][2] == 'x'): #LLL 3 octets
-                        lengthIndicator = 6
+            if self.DEBUG:
+                print '%s Length Field Size = [%s]' % (self._PLAN[cont].lengthType(), length)
+                print '\tSetting bit [%s] Value=[%s]' % (cont, ReadableAscii(self._VALUES[cont]))
 
-                    elif (str(self._DEF[cont][3]).count('.') == 2) and  (self._DEF[cont][2] == 'n' or self._DEF[cont][2] == 'z'): #LL 2 octets
-                        lengthIndicator = 4
+                    ################################################################################################
 
-                    elif (str(self._DEF[cont][3]).count('.') == 2) and (self._DEF[cont][2] == 'a' or self._DEF[cont][2] == 'ans' or self._DEF[cont][2] == 'ns' or self._DEF[cont][2] == 'x'): #LL 2 octets
-                        lengthIndicator = 4
+    def setIsoContent(self, iso):
+        """Method that receive a complete AS2805 message in hex (the getRawIso() form) and remove the bits values
+        @param: iso -> hex str of the MTI, bitmaps and bits
+        @raise: InvalidAS2805 Exception
+        """
 
+        if len(iso) < 20:
+            raise InvalidAS2805('This is not a valid iso!!')
+        if self.DEBUG:
+            print 'ASCII to process <%s>' % iso
 
+        self.__setBinaryContent(binascii.unhexlify(iso))
 
+    ################################################################################################
 
-                    if valueSize > self.getMaxLength(cont):
-                        raise ValueToLarge("This bit is larger than the specification!")
+    def __setBinaryContent(self, data):
+        """Method that parse a binary AS2805 message, the bits are kept as slices of it
+        It's a internal method, so don't call!
+        """
+        self.__setMTIFromBytes(data)
+        if self.DEBUG:
+            print 'MTI found was [%s]' % self.MESSAGE_TYPE_INDICATION
 
-                    valueSize = int(binascii.unhexlify(strWithoutMtiBitmap[offset:offset + lengthIndicator]))
-                    #valueSize *= 2
+        size = self.__getBitmapFromBytes(data, 2)
+        self.__getBitFromBytes(data, 2 + size)
 
-                    if self.DEBUG:
-                        print 'Variable Length Field (%s) Size = [%s]' % ('L' * lengthIndicator, valueSize / 2)
+            ################################################################################################
 
+    def decodeFields(self, frame, bits=(2, 4, 11, 41)):
+        """Method that pick some bits out of a binary message without parsing the rest of it.
+        The bits in between are skipped using only their length prefixes, and nothing after the last wanted
+        bit is read. The offsets come from the same shape plans as setIsoContent(), so both always agree.
+        The package itself is left untouched.
+        Example: iso.decodeFields(frame[4:], (2, 4, 11, 41)) -> {2: '5188680100002932', 4: '000000002000', ...}
+        @param: frame -> binary message, MTI first, like getNetworkISO() without the 4 bytes header
+        @param: bits -> the bits wanted
+        @return: dict -> {bit: value} of the wanted bits that are present in the message
+        @raise: BitInexistent Exception, InvalidAS2805 Exception
+        """
+        plan = self._PLAN
+        for bit in bits:
+            if bit < 2 or bit > 128 or plan[bit] is None:
+                raise BitInexistent("Bit number %s dosen't exist!" % bit)
+        if not bits:
+            return {}
+
+        if len(frame) < 10:
+            raise InvalidAS2805('This is not a valid iso!!')
 
-                    if valueSize > self.getMaxLength(cont):
-                        raise ValueToLarge("This bit is larger than the specification!")
+        size = 16 if ord(frame[2]) & 0x80 else 8
+        if len(frame) < 2 + size:
+            raise InvalidAS2805('This is not a valid iso!! The secondary bitmap is truncated')
+        shape = self._SHAPES.get(frame[2:2 + size])
+        last = max(bits)
 
+        values = {}
+        for cont, start, length in shape.locate(frame, last):
+            if cont > last:
+                break
+            if cont in bits:
+                values[cont] = plan[cont].decode(frame[start:start + length])
+        return values
 
-                    self._VALUES[cont] = strWithoutMtiBitmap[offset:offset + lengthIndicator] + strWithoutMtiBitmap[offset + lengthIndicator:offset + lengthIndicator + valueSize]
+    ################################################################################################
 
-                    if self.DEBUG:
-                        print '\tSetting bit [%s] Value=[%s]' % (cont, binascii.unhexlify(self._VALUES[cont]))
-                    offset += valueSize + lengthIndicator
+    def deriveResponse(self, frame, bits, mti=None, remove=(), bigEndian=True):
+        """Method that turn a received network frame into its response without parsing it.
+        The MTI is patched, the bitmaps are updated and only the bits given or removed are written into a bytearray,
+        every other bit is echoed as received. Nothing after the last bit given or removed is read.
+        The package itself is left untouched.
+        Example: connection.send(iso.deriveResponse(frame, {39: '00'}))
+        @param: frame -> received frame, 4 bytes size then the message; a bytearray is patched in place
+        @param: bits -> dict {bit: value} of the bits to add or replace, 38, 39 and 44 for instance
+        @param: mti -> MTI of the response, by default the one of the request plus 10 (0800 -> 0810)
+        @param: remove -> bits of the request that must not be echoed, 35 and 52 for instance
+        @param: bigEndian (True|False) -> how the size is represented
+        @return: bytearray -> the response frame, with its size
+        @raise: BitInexistent Exception, InvalidAS2805 Exception, InvalidMTI Exception, ValueToLarge Exception
+        """
+        plan = self._PLAN
+        changes = dict([(bit, None) for bit in remove])
+        for bit, value in bits.items():
+            if bit < 2 or bit > 128 or plan[bit] is None:
+                raise BitInexistent("Bit number %s dosen't exist!" % bit)
+            changes[bit] = plan[bit].encode(value)
+
+        if len(frame) < 14:
+            raise InvalidAS2805('This is not a valid iso!!Invalid Size')
 
-                #fixed length field
+        if mti is None:
+            mti = '%04d' % (int(binascii.hexlify(frame[4:6])) + 10)
+        mti = ("0000%s" % mti)[-4:]
+        if not mti.isdigit():
+            raise InvalidMTI('Check MTI! %s is not a valid MTI' % mti)
+
+        response = frame if isinstance(frame, bytearray) else bytearray(frame)
+
+        # the layout of the request, up to the last bit changed, offsets are in the frame
+        message = buffer(frame, 4)
+        size = 16 if ord(message[2]) & 0x80 else 8
+        primary, secondary, size = _bitmapFromBytes(message[2:2 + size])
+        spans = self._SHAPES.get(message[2:2 + size]).locate(message, max(changes or [0]))
+
+        # from the last bit to the first one, so the offsets of the bits before stay right
+        for bit in sorted(changes, reverse=True):
+            start = end = 6 + size
+            for cont, offset, length in spans:
+                if cont < bit:
+                    start = end = 4 + offset + length
+                elif cont == bit:
+                    start, end = 4 + offset, 4 + offset + length
+
+            inSecondary, mask = _bitMask(bit)
+            if changes[bit] is None:
+                del response[start:end]
+                if inSecondary:
+                    secondary &= ~mask
                 else:
+                    primary &= ~mask
+            else:
+                response[start:end] = changes[bit]
+                if inSecondary:
+                    secondary |= mask
+                else:
+                    primary |= mask
 
-                    length = int(self.getMaxLength(cont))
-
-                    length *= 2
-                    new_offset = length + offset
-
-                    self._VALUES[cont] = strWithoutMtiBitmap[offset: new_offset]
-                    offset += length
-
-
-                    if self.DEBUG:
-                        print 'Fixed Length Field Size = [%s]' % (length / 2)
-                        print '\tSetting bit [%s] Value=[%s]' % (cont, binascii.unhexlify(str(self._VALUES[cont])))
+        response[4:6] = binascii.unhexlify(mti)
+        response[6:6 + size] = _bitmapToBytes(primary, secondary)
+        struct.pack_into('!I' if bigEndian else '<I', response, 0, len(response) - 4)
+        return response
 
+    ################################################################################################
 
-                    ################################################################################################
+    def deriveReversal(self, frame, stan, transmission, mti='0420', bits=None, remove=(35, 45, 52, 55, 64, 128),
+                       bigEndian=True):
+        """Method that build the reversal advice of a request that was sent, a 0200 that timed out for instance.
+        Bit 90, Original Data Elements, is filled from the MTI, STAN, transmission date and time and acquiring and
+        forwarding institution IDs of the request; the other bits are echoed as with deriveResponse().
+        Example: link.send(iso.deriveReversal(request, '000507', '0107234821'))
+        @param: frame -> network frame of the request, 4 bytes size then the message, it is left untouched
+        @param: stan -> bit 11 of the advice
+        @param: transmission -> bit 7 of the advice, MMDDhhmmss
+        @param: mti -> MTI of the advice, 0420 or 0400
+        @param: bits -> dict {bit: value} of other bits to add or replace, 39 for instance
+        @param: remove -> bits of the request an advice does not carry, the card data, PIN block and MAC by default
+        @param: bigEndian (True|False) -> how the size is represented
+        @return: bytearray -> the advice frame, with its size
+        @raise: BitInexistent Exception, InvalidAS2805 Exception, InvalidMTI Exception, ValueToLarge Exception
+        """
+        if len(frame) < 14:
+            raise InvalidAS2805('This is not a valid iso!!Invalid Size')
 
-    def setIsoContent(self, iso):
+        original = self.decodeFields(str(frame[4:]), (7, 11, 32, 33))
+        elements = '%s%s%s%011d%011d' % (binascii.hexlify(frame[4:6]), original.get(11, '000000'),
+                                         original.get(7, '0000000000'), int(original.get(32) or 0),
+                                         int(original.get(33) or 0))
 
-        if len(iso) < 20:
-            raise InvalidAS2805('This is not a valid iso!!')
-        if self.DEBUG:
-            print 'ASCII to process <%s>' % iso
+        changes = dict(bits or {})
+        changes.update({7: transmission, 11: stan, 90: elements})
+        return self.deriveResponse(str(frame), changes, mti, remove, bigEndian)
 
-        self.__setMTIFromStr(iso)
-        isoT = iso[4:]
-        self.__getBitmapFromStr(isoT)
-        self.__initializeBitsFromBitmapStr()
-        if self.DEBUG:
-            print 'This is the array of bits (before) %s ' % self._VALUES
+    ################################################################################################
 
-        self.__getBitFromStr(iso[4+len(self.BITMAP_HEX):])
-        if self.DEBUG:
-            print 'This is the array of bits (after) %s ' % self._VALUES
+    def getShapeCacheStats(self):
+        """Method that return the counters of the bitmap shape plans cache, shared by every package
+        @return: dict -> with the hits, misses, size and maxsize of the cache
+        """
+        return self._SHAPES.stats()
 
-            ################################################################################################
+    ################################################################################################
 
     def getBitsAndValues(self):
 
         ret = []
-        for cont in range(2, 126):
-            if self._VALUES[cont] != self._EMPTY_VALUE:
+        for cont in self.__getPresentFields():
+            if cont < 126:
                 _TMP = {'bit': "%d" % cont, 'type': self.getLengthType(cont), 'value': self.getBit(cont), 'format': self.getDataType(cont)}
-                #print _TMP
                 ret.append(_TMP)
         return ret
 
     ################################################################################################
 
     def getBit(self, bit):
-
+        """Return the value of the bit
+        @param: bit -> the number of the bit that you want the value
+        @raise: BitInexistent Exception, BitNotSet Exception
+        """
 
         if bit < 1 or bit > 128:
             raise BitInexistent("Bit number %s dosen't exist!" % bit)
 
-        if self._VALUES[bit] == self._EMPTY_VALUE:
-            raise BitNotSet("Bit number %s was not set!" % bit)
+        value = self._VALUES[bit]
+        if value == self._EMPTY_VALUE:
+            if self._BUFFER:
+                self.__locateBit(bit)
+                value = self._VALUES[bit]
+            if value == self._EMPTY_VALUE:
+                raise BitNotSet("Bit number %s was not set!" % bit)
 
-        if (str(self._DEF[bit][3]).count('.') == 3) and  (self._DEF[bit][2] == 'b'):#0LLL 2 octets
-            value = binascii.unhexlify(self._VALUES[bit][4:])
+        return self._PLAN[bit].decode(value)
 
-        elif (str(self._DEF[bit][3]).count('.') == 3) and  (self._DEF[bit][2] == 'n' or self._DEF[bit][2] == 'z'): #0LLL 2 octets
-            value = binascii.unhexlify(self._VALUES[bit][4:])
+    ################################################################################################
 
-        elif (str(self._DEF[bit][3]).count('.') == 3) and (self._DEF[bit][2] == 'a' or self._DEF[bit][2] == 'ans' or self._DEF[bit][2] == 'ns' or self._DEF[bit][2] == 'x'): #LLL 3 octets
-            value = binascii.unhexlify(self._VALUES[bit][6:])
+    def __locateBit(self, bit):
+        """Method that slice one lazily decoded bit out of the received message. The bits before it that were not
+        walked yet only get their (offset, length) recorded, none of them is copied.
+        A bit that was set since the message was parsed keeps its new value.
+        It's a internal method, so don't call!
+        @raise: InvalidAS2805 Exception, ValueToLarge Exception
+        """
+        pending = self._PENDING
+        spans = self._SPANS
+        data = self._BUFFER
+        offset = self._CURSOR
+        while pending and pending[-1] <= bit:
+            cont = pending.pop()
+            length = _measureField(self._PLAN, cont, data, offset)
+            spans[cont] = (offset, length)
+            offset += length
+        self._CURSOR = offset
+
+        span = spans.pop(bit, None)
+        if span is not None and self._VALUES[bit] == self._EMPTY_VALUE:
+            self._VALUES[bit] = data[span[0]:span[0] + span[1]]
+        if not pending and not spans:
+            self._BUFFER = ''
 
-        elif (str(self._DEF[bit][3]).count('.') == 2) and  (self._DEF[bit][2] == 'n' or self._DEF[bit][2] == 'z'): #LL 2 octets
-            value = binascii.unhexlify(self._VALUES[bit][4:])
+    ################################################################################################
 
-        elif (str(self._DEF[bit][3]).count('.') == 2) and (self._DEF[bit][2] == 'a' or self._DEF[bit][2] == 'ans' or self._DEF[bit][2] == 'ns' or self._DEF[bit][2] == 'x'): #LL 2 octets
-            value = binascii.unhexlify(self._VALUES[bit][4:])
+    def __sliceAll(self):
+        """Method that slice every lazily decoded bit not read yet out of the received message, before encoding
+        It's a internal method, so don't call!
+        @raise: InvalidAS2805 Exception, ValueToLarge Exception
+        """
+        if self._PENDING:
+            self.__locateBit(128)
+        values = self._VALUES
+        data = self._BUFFER
+        for bit, (offset, length) in self._SPANS.items():
+            if values[bit] == self._EMPTY_VALUE:
+                values[bit] = data[offset:offset + length]
+        self._SPANS.clear()
+        self._BUFFER = ''
 
-        else:
-            value =   binascii.unhexlify(self._VALUES[bit])
+    ################################################################################################
 
-        return value
+    def __getMACBit(self):
+        """Method that return the bit holding the MAC: 128 when the secondary bitmap is used, 64 otherwise.
+        Either way it is the last bit of the message.
+        It's a internal method, so don't call!
+        """
+        return 128 if self.SECONDARY_BITMAP else 64
 
     ################################################################################################
 
-    def getNetworkISO(self, bigEndian=True):
+    def __getMAC(self, data, macKey):
+        """Method that return the 8 bytes MAC field of data, as AS2805.4 the left 4 bytes of the retail MAC
+        followed by zeros.
+        It's a internal method, so don't call!
+        """
+        from Shared.MAC import RetailMAC
 
+        return RetailMAC(data, macKey)[:self._MAC_SIZE] + self._MAC_FILL
 
-        asciiIso = self.getRawIso()
+    ################################################################################################
+
+    def getNetworkISO(self, bigEndian=True, macKey=None):
+        """Method that return the AS2805 binary package with the size in the beginning
+        By default, it return the package with the 4 byte size represented with big-endian.
+        @param: bigEndian (True|False) -> if you want that the size be represented in this way.
+        @param: macKey -> MAC key, bytes or Shared.CipherCache.KeyHandle. When given, bit 64 (bit 128 with a
+                secondary bitmap) is set to the MAC of the message, computed over the encoded bytes before it.
+        @return: size + binary AS2805 package ready to go to the network!
+        @raise: InvalidMTI Exception
+        """
+
+        if macKey is None:
+            asciiIso = self.__getBinaryIso()
+        else:
+            # the bitmap carries the MAC bit, its value is left out of the encoding and appended once computed
+            if self._BUFFER:
+                self.__sliceAll()
+            bit = self.__getMACBit()
+            previous = (self.PRIMARY_BITMAP, self.SECONDARY_BITMAP, self._VALUES[bit])
+            mac = None
+            try:
+                self.setBit(bit, '0')
+                self._VALUES[bit] = ''
+                asciiIso = self.__getBinaryIso()
+                self._VALUES[bit] = mac = self.__getMAC(asciiIso, macKey)
+            finally:
+                if mac is None:
+                    # not encoded, the package is left as it was
+                    self.PRIMARY_BITMAP, self.SECONDARY_BITMAP, self._VALUES[bit] = previous
+                    self.BITMAP_HEX = ''
+            asciiIso += mac
 
         if bigEndian:
-            netIso = struct.pack('!H', len(asciiIso))
+            netIso = struct.pack('!I', len(asciiIso))
             if self.DEBUG:
                 print 'Pack Big-endian'
         else:
-            netIso = struct.pack('<H', len(asciiIso))
+            netIso = struct.pack('<I', len(asciiIso))
             if self.DEBUG:
                 print 'Pack Little-endian'
 
@@ -830,12 +1419,20 @@ class AS2805:
         return all(c in string.hexdigits for c in s)
 
     ################################################################################################
-    def setNetworkISO(self, iso, bigEndian=True):
+    def setNetworkISO(self, iso, bigEndian=True, macKey=None):
+        """Method that parse an AS2805 binary package with the size in the beginning, the getNetworkISO() form
+        @param: iso -> the package, str or a buffer object such as the memoryview frames of Shared.Framer; it is
+                copied once, so the buffer can be reused as soon as this returns
+        @param: bigEndian (True|False) -> how the size is represented
+        @param: macKey -> MAC key, bytes or Shared.CipherCache.KeyHandle. When given, the MAC of bit 64 (bit 128
+                with a secondary bitmap) is checked over the received bytes before it.
+        @raise: InvalidAS2805 Exception, InvalidMAC Exception
+        """
 
+        iso = _toBytes(iso)
         if len(iso) < 24:
             raise InvalidAS2805('This is not a valid iso!!Invalid Size')
 
-        size = iso[0:2]
         if bigEndian:
             if self.DEBUG:
                 print 'Unpack Big-endian'
@@ -843,10 +1440,399 @@ class AS2805:
             if self.DEBUG:
                 print 'Unpack Little-endian'
 
-        #if len(iso) != (size[0] + 2):
-        #    raise InvalidAS2805('This is not a valid iso!!The AS2805 ASCII(%s) is less than the size %s!' % (len(iso[2:]), size[0]))
+        _checkFrameSize(iso, bigEndian)
+
+        self.__setBinaryContent(iso[4:])
+
+        if macKey is not None:
+            bit = self.__getMACBit()
+            secondary, mask = _bitMask(bit)
+            if not (self.SECONDARY_BITMAP if secondary else self.PRIMARY_BITMAP) & mask:
+                raise InvalidMAC('Bit %s, the MAC, is not set!' % bit)
+            if not hmac.compare_digest(self.__getMAC(memoryview(iso)[4:-8], macKey), iso[-8:]):
+                raise InvalidMAC('The MAC of bit %s does not match the message!' % bit)
+
+################################################################################################
+# Message pool
+#
+# A server or a client handling thousands of messages a second would otherwise build, and leave to
+# the garbage collector, a package and its 129 bit slots per message. The pool keeps released
+# packages per thread, so checking one out or in never takes a lock.
+################################################################################################
+
+class MessagePool:
+    """Thread local pool of AS2805 packages.
+    Example: pack = pool.acquire(); try: pack.setNetworkISO(frame) ... finally: pool.release(pack)
+    @param: maxsize -> number of released packages kept per thread, the others are left to the garbage collector
+    """
+
+    def __init__(self, maxsize=32):
+        self.MAXSIZE = maxsize
+        self._LOCAL = threading.local()
+
+    def __free(self):
+        """Return the list of released packages of the calling thread
+        It's a internal method, so don't call!
+        """
+        try:
+            return self._LOCAL.free
+        except AttributeError:
+            self._LOCAL.free = []
+            return self._LOCAL.free
+
+    def acquire(self, debug=False, lazy=False):
+        """Check a clean package out of the pool, a new one is built when the pool of this thread is empty
+        @param: debug, lazy -> the same as the AS2805 constructor
+        @return: AS2805 package
+        """
+        free = self.__free()
+        if free:
+            pack = free.pop()
+            pack.DEBUG = debug
+            pack.LAZY = lazy
+            return pack
+        return AS2805(debug=debug, lazy=lazy)
+
+    def release(self, pack):
+        """Check a package back in, it is reset here and must not be used by the caller afterwards
+        @param: pack -> AS2805 package from acquire()
+        """
+        free = self.__free()
+        if len(free) < self.MAXSIZE:
+            pack.reset()
+            free.append(pack)
+
+################################################################################################
+# Compact package
+#
+# An AS2805 package costs a few KB (instance dict, 129 bit slots, hex copies of the bitmap, ...),
+# which adds up when hundreds of thousands of in flight or pending reversal messages are kept.
+# A CompactAS2805 is a single binary str, the message exactly as on the wire, behind __slots__.
+################################################################################################
+
+_NO_MTI = '\xff\xff'
+
+
+class CompactAS2805(object):
+    """AS2805 package held as its binary message only: MTI, bitmaps and the bits present.
+    It offers the AS2805 API for the MTI, the bits and the raw and network forms. Bits are located
+    through the bitmap shape plans of AS2805 when they are read, and the message is spliced when
+    one is set.
+    Example: pending = CompactAS2805(); pending.setNetworkISO(frame); pending.getBit(11)
+    @param: iso -> a str that represents the package in hex, the same that you need to pass to setIsoContent()
+    """
+    __slots__ = ('_MESSAGE',)
+
+    _DEF = AS2805._DEF
+    _PLAN = AS2805._PLAN
+    _SHAPES = AS2805._SHAPES
+
+    def __init__(self, iso=""):
+        self._MESSAGE = _NO_MTI + _bitmapToBytes(0, 0)
+
+        if iso != "":
+            self.setIsoContent(iso)
+
+    ################################################################################################
+
+    def setMTI(self, type):
+        """Method that set the MTI
+        @param: type -> MTI to be setted
+        @raise: InvalidMTI Exception
+        """
+        mti = ("0000%s" % type)[-4:]
+        if not mti.isdigit():
+            raise InvalidMTI('Check MTI! %s is not a valid MTI' % type)
+
+        self._MESSAGE = binascii.unhexlify(mti) + self._MESSAGE[2:]
+
+    ################################################################################################
+
+    def getMTI(self):
+        """Method that return the MTI of the package
+        @return: str -> with the MTI, empty if it was not set
+        """
+        if self._MESSAGE[0:2] == _NO_MTI:
+            return ''
+        return binascii.hexlify(self._MESSAGE[0:2])
+
+    ################################################################################################
+
+    def getBitmap(self):
+        """Method that return the ASCII Bitmap of the package
+        @return: str -> with the ASCII Bitmap
+        """
+        return binascii.hexlify(self.__getBitmap())
+
+    ################################################################################################
+
+    def __getBitmap(self):
+        """Method that return the bitmaps as they are in the message
+        It's a internal method, so don't call!
+        """
+        if ord(self._MESSAGE[2]) & 0x80:
+            return self._MESSAGE[2:18]
+        return self._MESSAGE[2:10]
+
+    ################################################################################################
+
+    def __isPresent(self, bit):
+        """Method that tell if a bit is present in the bitmaps
+        It's a internal method, so don't call!
+        """
+        primary, secondary, size = _bitmapFromBytes(self._MESSAGE[2:18])
+        inSecondary, mask = _bitMask(bit)
+        if inSecondary:
+            return bool(secondary & mask)
+        return bit != 1 and bool(primary & mask)
+
+    ################################################################################################
+
+    def setBit(self, bit, value):
+        """Method used to set a bit with a value
+        @param: bit -> bit number that want to be setted
+        @param: value -> the value of the bit
+        @return: True/False default True -> To be used in the future!
+        @raise: BitInexistent Exception, ValueToLarge Exception
+        """
+        if bit < 1 or bit > 128 or self._PLAN[bit] is None:
+            raise BitInexistent("Bit number %s dosen't exist!" % bit)
+
+        value = self._PLAN[bit].encode(value)
+
+        # the bits before this one are measured directly, a package being built goes through shapes
+        # that are not worth a place in the shape plans cache
+        message = self._MESSAGE
+        primary, secondary, size = _bitmapFromBytes(message[2:18])
+        start = offset = 2 + size
+        for cont in _presentBits(primary, secondary):
+            if cont >= bit:
+                break
+            offset += _measureField(self._PLAN, cont, message, offset)
+
+        tail = offset
+        if self.__isPresent(bit):
+            tail += _measureField(self._PLAN, bit, message, offset)
+
+        inSecondary, mask = _bitMask(bit)
+        if inSecondary:
+            secondary |= mask
+        else:
+            primary |= mask
+
+        self._MESSAGE = ''.join((message[0:2], _bitmapToBytes(primary, secondary), message[start:offset], value,
+                                 message[tail:]))
+        return True
+
+    ################################################################################################
+
+    def __getSpans(self, last=128):
+        """Method that return the (bit, offset, length) of the bits present, up to bit last
+        It's a internal method, so don't call!
+        """
+        return self._SHAPES.get(self.__getBitmap()).locate(self._MESSAGE, last)
+
+    ################################################################################################
+
+    def getBit(self, bit):
+        """Return the value of the bit
+        @param: bit -> the number of the bit that you want the value
+        @raise: BitInexistent Exception, BitNotSet Exception
+        """
+        if bit < 1 or bit > 128:
+            raise BitInexistent("Bit number %s dosen't exist!" % bit)
+
+        if not self.__isPresent(bit):
+            raise BitNotSet("Bit number %s was not set!" % bit)
+
+        for cont, offset, length in self.__getSpans(bit):
+            if cont == bit:
+                return self._PLAN[bit].decode(self._MESSAGE[offset:offset + length])
+
+    ################################################################################################
+
+    def getBitsAndValues(self):
+        """Method that return the bits present, the same as AS2805.getBitsAndValues()
+        @return: list of dict -> with the bit, type, value and format of each bit
+        """
+        ret = []
+        for cont, offset, length in self.__getSpans():
+            if cont < 126:
+                plan = self._PLAN[cont]
+                ret.append({'bit': "%d" % cont, 'type': plan.lengthType(),
+                            'value': plan.decode(self._MESSAGE[offset:offset + length]), 'format': plan.dataType})
+        return ret
+
+    ################################################################################################
+
+    def getRawIso(self):
+        """Method that return the package in hex, the same as AS2805.getRawIso()
+        @raise: InvalidMTI Exception
+        """
+        return binascii.hexlify(self.__getBinaryIso())
 
-        self.setIsoContent(iso)
+    ################################################################################################
+
+    def __getBinaryIso(self):
+        """Method that return the binary message
+        It's a internal method, so don't call!
+        @raise: InvalidMTI Exception
+        """
+        if self._MESSAGE[0:2] == _NO_MTI:
+            raise InvalidMTI('Check MTI! Do you set it?')
+        return self._MESSAGE
+
+    ################################################################################################
+
+    def setIsoContent(self, iso):
+        """Method that receive a complete AS2805 message in hex (the getRawIso() form)
+        @raise: InvalidAS2805 Exception
+        """
+        if len(iso) < 20:
+            raise InvalidAS2805('This is not a valid iso!!')
+
+        self.__setBinaryContent(binascii.unhexlify(iso))
+
+    ################################################################################################
+
+    def __setBinaryContent(self, data):
+        """Method that check a binary message and keep it
+        It's a internal method, so don't call!
+        @raise: InvalidAS2805 Exception
+        """
+        if not binascii.hexlify(data[0:2]).isdigit():
+            raise InvalidMTI('This is not a valid MTI %s' % binascii.hexlify(data[0:2]))
+
+        size = 16 if ord(data[2]) & 0x80 else 8
+        self._SHAPES.get(data[2:2 + size]).locate(data)
+        self._MESSAGE = data
+
+    ################################################################################################
+
+    def getNetworkISO(self, bigEndian=True):
+        """Method that return the binary package with the 4 byte size in the beginning, like AS2805.getNetworkISO()
+        @raise: InvalidMTI Exception
+        """
+        message = self.__getBinaryIso()
+        if bigEndian:
+            return struct.pack('!I', len(message)) + message
+        return struct.pack('<I', len(message)) + message
+
+    ################################################################################################
+
+    def setNetworkISO(self, iso, bigEndian=True):
+        """Method that receive the network form of a package, like AS2805.setNetworkISO()
+        @raise: InvalidAS2805 Exception
+        """
+        iso = _toBytes(iso)
+        if len(iso) < 24:
+            raise InvalidAS2805('This is not a valid iso!!Invalid Size')
+        _checkFrameSize(iso, bigEndian)
+
+        self.__setBinaryContent(iso[4:])
+
+################################################################################################
+# Message templates
+#
+# Sign on, echo and key exchange messages, and the merchant constant bits of financial messages,
+# are the same from one message to the next. A MessageTemplate encodes the MTI, the bitmap and the
+# constant bits once; a message is then the constant chunks joined with the bits that vary.
+################################################################################################
+
+class MessageTemplate:
+    """Pre-encoded AS2805 message with some bits left to fill in.
+    Example:
+    echo = MessageTemplate('0800', {70: '301'}, (7, 11))
+    frame = echo.getNetworkISO({7: '0218070354', 11: '000361'})
+    @param: mti -> the MTI of the messages
+    @param: constants -> dict {bit: value} of the bits that are the same in every message
+    @param: variables -> the bits given for every message, a bit also in constants varies
+    @raise: InvalidMTI Exception, BitInexistent Exception, ValueToLarge Exception
+    """
+
+    _PLAN = AS2805._PLAN
+
+    def __init__(self, mti, constants, variables):
+        self.MESSAGE_TYPE_INDICATION = ("0000%s" % mti)[-4:]
+        if not self.MESSAGE_TYPE_INDICATION.isdigit():
+            raise InvalidMTI('Check MTI! %s is not a valid MTI' % mti)
+
+        self.VARIABLES = tuple(sorted(set(variables)))
+
+        primary = secondary = 0
+        encoded = {}
+        for bit in set(constants) | set(self.VARIABLES):
+            if bit < 2 or bit > 128 or self._PLAN[bit] is None:
+                raise BitInexistent("Bit number %s dosen't exist!" % bit)
+            if bit not in self.VARIABLES:
+                encoded[bit] = self._PLAN[bit].encode(constants[bit])
+
+            inSecondary, mask = _bitMask(bit)
+            if inSecondary:
+                secondary |= mask
+            else:
+                primary |= mask
+
+        # _HEAD then, per variable bit, (bit, encode function, constant bits up to the next variable one)
+        chunks = [[binascii.unhexlify(self.MESSAGE_TYPE_INDICATION), _bitmapToBytes(primary, secondary)]]
+        for bit in _presentBits(primary, secondary):
+            if bit in encoded:
+                chunks[-1].append(encoded[bit])
+            else:
+                chunks.append([])
+        self._HEAD = ''.join(chunks[0])
+        self._STEPS = [(bit, self._PLAN[bit].encode, ''.join(chunk)) for bit, chunk in zip(self.VARIABLES, chunks[1:])]
+
+    ################################################################################################
+
+    def __getBinaryIso(self, values):
+        """Method that return the binary message with the variable bits taken from values
+        It's a internal method, so don't call!
+        @raise: BitNotSet Exception, ValueToLarge Exception
+        """
+        parts = [self._HEAD]
+        try:
+            for bit, encode, constant in self._STEPS:
+                parts.append(encode(values[bit]))
+                parts.append(constant)
+        except KeyError, missing:
+            raise BitNotSet("Bit number %s was not set!" % missing)
+        return ''.join(parts)
+
+    ################################################################################################
+
+    def getRawIso(self, values):
+        """Method that return a message in hex, the same as AS2805.getRawIso()
+        @param: values -> dict {bit: value} of every variable bit
+        @raise: BitNotSet Exception, ValueToLarge Exception
+        """
+        return binascii.hexlify(self.__getBinaryIso(values))
+
+    ################################################################################################
+
+    def getNetworkISO(self, values, bigEndian=True):
+        """Method that return a message with the 4 byte size in the beginning, the same as AS2805.getNetworkISO()
+        @param: values -> dict {bit: value} of every variable bit
+        @param: bigEndian (True|False) -> if you want that the size be represented in this way.
+        @raise: BitNotSet Exception, ValueToLarge Exception
+        """
+        message = self.__getBinaryIso(values)
+        if bigEndian:
+            return struct.pack('!I', len(message)) + message
+        return struct.pack('<I', len(message)) + message
+
+    ################################################################################################
+
+    def encodeInto(self, values, buf, offset=0, bigEndian=True):
+        """Method that write a message, in the getNetworkISO() form, straight into a buffer
+        @param: values -> dict {bit: value} of every variable bit
+        @param: buf -> bytearray or writable memoryview, it is never resized
+        @param: offset -> where the 4 bytes size is written
+        @param: bigEndian (True|False) -> how the size is represented
+        @return: int -> number of bytes written
+        @raise: BitNotSet Exception, ValueToLarge Exception
+        """
+        return _writeFrame(buf, offset, self.__getBinaryIso(values), bigEndian)
 
 ################################################################################################
 
@@ -917,7 +1903,7 @@ if __name__ == '__main__':
     iso.setBit(3, '011000')
     iso.setBit(4, '000000002000')
     iso.setBit(7, '0107235144')
-    iso.setBit(11, '00000518')
+    iso.setBit(11, '000518')
     iso.setBit(12, '105144')
     iso.setBit(13, '0108')
     iso.setBit(15, '0108')
@@ -961,11 +1947,11 @@ if __name__ == '__main__':
 
 
     iso_new = AS2805(debug=True)
-    iso_new.setIsoContent(iso.getNetworkISO()[2:])
+    iso_new.setIsoContent(iso.getRawIso())
     print iso_new.dumpFields()
     print iso_new.getNetworkISO()
     another_iso = AS2805(debug=True)
-    print another_iso.setIsoContent(iso_new.getNetworkISO()[2:])
+    print another_iso.setIsoContent(iso_new.getRawIso())
 
     print iso_new.getBit(3)
     print iso_new.getBit(4)
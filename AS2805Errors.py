@@ -86,4 +86,8 @@ class BitNotSet(Exception):
         self.str = value
 
     def __str__(self):
-        return repr(self.str)
\ No newline at end of file
+        return repr(self.str)
+#Exception that indicate that the MAC of a message is missing or wrong.
+class InvalidMAC(InvalidAS2805):
+    """Exception that indicate that the MAC (bit 64 or 128) of a received message does not match its content.
+    """
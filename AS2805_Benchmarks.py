@@ -0,0 +1,475 @@
+__author__ = 'root'
+
+"""
+            Throughput benchmarks for the AS2805 codec
+            Run with: python AS2805_Benchmarks.py [iterations] [messages kept by the memory benchmarks]
+"""
+
+import sys
+import timeit
+
+from AS2805 import AS2805, CompactAS2805, MessagePool, MessageTemplate, _ShapePlan
+from Shared.ByteUtils import HexToByte
+from Shared.TimingWheel import TimingWheel
+from Shared.MAC import DESMAC, DES3MAC, RetailMAC, FullMAC
+from Shared.CipherCache import Ciphers
+from AS2805_SessionKeys import SessionKeyStore, MAC
+
+
+# Key exchange vectors, the same as AS2805_UnitTests.AS2805_0820_TestCases
+Host_0820_Request = "08208220000080010800040000001000000001041021410084400861100016303332aa0dba804fa9f9032432e9e1239eeb4db2260b76f343ccdd90823af354f3f2a00000000000000002010106579944"
+Host_0830_Response = "083082200000820108000400000010000000010410520700036008611000163030303036dee885d32313000000000000000201010861100016"
+
+Network_0820_Request = HexToByte('%08x' % (len(Host_0820_Request) // 2) + Host_0820_Request)
+Network_0830_Response = HexToByte('%08x' % (len(Host_0830_Response) // 2) + Host_0830_Response)
+
+# ICC data of the 0200 EMV purchase in AS2805_UnitTests
+ICC_Data = '9F02060000000020009F03060000000000009F1A020036950500000000005F2A0200369A031501089C01019F37044DFF395282020000' \
+           '9F360200069F3303E0E0809F2701809F2608433B5FDBBC5847FA5F3401009F34030103029F350122'
+
+# The bits a router needs to make a decision
+Routing_Bits = (2, 3, 4, 11, 32, 41)
+
+
+def buildIcc0200():
+    iso = AS2805()
+    iso.setMTI('0200')
+    iso.setBit(2, '5188680100002932')
+    iso.setBit(3, '011000')
+    iso.setBit(4, '000000002000')
+    iso.setBit(7, '0107234721')
+    iso.setBit(11, '000506')
+    iso.setBit(12, '104721')
+    iso.setBit(13, '0108')
+    iso.setBit(32, '560258')
+    iso.setBit(35, '5188680100002932D15122015076719950000')
+    iso.setBit(41, 'S9218163')
+    iso.setBit(42, '437586000      ')
+    iso.setBit(43, '800 LANGDON ST,          MADISON      AU')
+    iso.setBit(48, 'A5' * 400)
+    iso.setBit(55, ICC_Data * 3)
+    iso.setBit(64, '29365A0400000000')
+    iso.setBit(112, '5A' * 600)
+    return iso.getNetworkISO()
+
+Network_0200_Icc = buildIcc0200()
+
+
+def pack0820():
+    iso = AS2805()
+    iso.setMTI('0820')
+    iso.setBit(7, '0104105142')
+    iso.setBit(11, '000360')
+    iso.setBit(33, '579944')
+    iso.setBit(48, '0F5E4728EDE11727AD5DF16ADD5074D820FE8223FD250762E55FAEBB715EF682')
+    iso.setBit(53, '0000000000000002')
+    iso.setBit(70, '101')
+    iso.setBit(100, '61100016')
+    return iso.getNetworkISO()
+
+
+def pack0830():
+    iso = AS2805()
+    iso.setMTI('0830')
+    iso.setBit(7, '0104102141')
+    iso.setBit(11, '008440')
+    iso.setBit(33, '61100016')
+    iso.setBit(39, '00')
+    iso.setBit(48, '5E728F034B20')
+    iso.setBit(53, '0000000000000002')
+    iso.setBit(70, '101')
+    iso.setBit(100, '579944')
+    return iso.getNetworkISO()
+
+
+def unpack0820():
+    iso = AS2805()
+    iso.setNetworkISO(Network_0820_Request)
+    return iso.getBit(48)
+
+
+def unpack0830():
+    iso = AS2805()
+    iso.setNetworkISO(Network_0830_Response)
+    return iso.getBit(48)
+
+
+Pool = MessagePool()
+
+
+def unpack0820Pooled():
+    iso = Pool.acquire()
+    iso.setNetworkISO(Network_0820_Request)
+    value = iso.getBit(48)
+    Pool.release(iso)
+    return value
+
+
+def pack0830Pooled():
+    iso = Pool.acquire()
+    iso.setMTI('0830')
+    iso.setBit(7, '0104102141')
+    iso.setBit(11, '008440')
+    iso.setBit(33, '61100016')
+    iso.setBit(39, '00')
+    iso.setBit(48, '5E728F034B20')
+    iso.setBit(53, '0000000000000002')
+    iso.setBit(70, '101')
+    iso.setBit(100, '579944')
+    message = iso.getNetworkISO()
+    Pool.release(iso)
+    return message
+
+
+def pack0800():
+    iso = AS2805()
+    iso.setMTI('0800')
+    iso.setBit(7, '0218070354')
+    iso.setBit(11, '000361')
+    iso.setBit(12, '070354')
+    iso.setBit(13, '0218')
+    iso.setBit(70, '001')
+    return iso.getNetworkISO()
+
+
+Login_Template = MessageTemplate('0800', {70: '001'}, (7, 11, 12, 13))
+
+
+def pack0800Template():
+    return Login_Template.getNetworkISO({7: '0218070354', 11: '000361', 12: '070354', 13: '0218'})
+
+
+# Merchant constant bits of a purchase, the rest varies per message
+Merchant_Bits = {3: '011000', 18: '5811', 22: '021', 25: '41', 32: '560258', 33: '61100016', 41: 'S9218163',
+                 42: '437586000      ', 43: '800 LANGDON ST,          MADISON      AU', 100: '61100016'}
+Purchase_Bits = {2: '5188680100002932', 4: '000000002000', 7: '0107234721', 11: '000506', 12: '104721',
+                 13: '0108', 64: '29365A0400000000'}
+
+
+def pack0200():
+    iso = AS2805()
+    iso.setMTI('0200')
+    for bit, value in Merchant_Bits.items():
+        iso.setBit(bit, value)
+    for bit, value in Purchase_Bits.items():
+        iso.setBit(bit, value)
+    return iso.getNetworkISO()
+
+
+Purchase_Template = MessageTemplate('0200', Merchant_Bits, Purchase_Bits.keys())
+
+
+def pack0200Template():
+    return Purchase_Template.getNetworkISO(Purchase_Bits)
+
+
+Send_Buffer = bytearray(4096)
+
+
+def pack0200TemplateInto():
+    return Purchase_Template.encodeInto(Purchase_Bits, Send_Buffer)
+
+
+# decodeFields() and deriveResponse() leave the package untouched, so a router keeps one around
+Router = AS2805()
+
+Network_0800_Login = pack0800()
+
+
+def respond0810():
+    iso = AS2805()
+    iso.setNetworkISO(Network_0800_Login)
+    iso.setMTI('0810')
+    iso.setBit(39, '00')
+    return iso.getNetworkISO()
+
+
+def respond0810Derived():
+    return Router.deriveResponse(Network_0800_Login, {39: '00'})
+
+
+def respond0210():
+    iso = AS2805()
+    iso.setNetworkISO(Network_0200_Icc)
+    iso.setMTI('0210')
+    iso.setBit(38, '123456')
+    iso.setBit(39, '00')
+    iso.setBit(44, '1')
+    return iso.getNetworkISO()
+
+
+def respond0210Derived():
+    return Router.deriveResponse(Network_0200_Icc, {38: '123456', 39: '00', 44: '1'})
+
+
+def reverse0200():
+    return Router.deriveReversal(Network_0200_Icc, '000507', '0107234821')
+
+
+MAC_Key = HexToByte('0123456789ABCDEFFEDCBA9876543210')
+Icc_0200_Message = Network_0200_Icc[4:]
+
+
+def macRetail0200():
+    return DESMAC(Icc_0200_Message, MAC_Key, '')
+
+
+def macFull0200():
+    return DES3MAC(Icc_0200_Message, MAC_Key, '')
+
+
+def macRetail0800():
+    return DESMAC(Network_0800_Login[4:], MAC_Key, '')
+
+
+# the same key as a handle, its DES objects are kept by the cipher cache
+MAC_Handle = Ciphers.register('benchmark/ZAK', MAC_Key)
+
+
+def macRetail0800Cached():
+    return RetailMAC(Network_0800_Login[4:], MAC_Handle)
+
+
+def macRetail0200Cached():
+    return RetailMAC(Icc_0200_Message, MAC_Handle)
+
+
+def macFull0200Cached():
+    return FullMAC(Icc_0200_Message, MAC_Handle)
+
+
+Login_MACed = AS2805()
+Login_MACed.setNetworkISO(Network_0800_Login)
+Network_0800_MACed = Login_MACed.getNetworkISO(macKey=MAC_Handle)
+
+
+def pack0800MAC():
+    return Login_MACed.getNetworkISO(macKey=MAC_Handle)
+
+
+def unpack0800MAC():
+    iso = AS2805()
+    iso.setNetworkISO(Network_0800_MACed, macKey=MAC_Handle)
+    return iso
+
+
+Session_Keys = SessionKeyStore('benchmark/link', keys={MAC: MAC_Key})
+Network_0800_SessionMACed = Login_MACed.getNetworkISO(macKey=Session_Keys.getKey(MAC))
+
+
+def sessionKeyLookup():
+    return Session_Keys.getKey(MAC)
+
+
+def unpack0800SessionMAC():
+    return Session_Keys.verifyMAC(Network_0800_SessionMACed)
+
+
+# A wheel holding the timeouts of 100k requests in flight, none of them due during the benchmarks
+Timeouts = TimingWheel(tick=0.01, slots=4096)
+for cont in xrange(100000):
+    Timeouts.schedule(30 + cont % 10, len)
+
+
+def timeoutAnswered():
+    Timeouts.cancel(Timeouts.schedule(30, len))
+
+
+def timeoutExpired(count=100000):
+    """Schedule count timers over one second of a fake clock and return the seconds advance() takes to fire them"""
+    now = [0.0]
+    wheel = TimingWheel(tick=0.01, slots=4096, clock=lambda: now[0])
+    for cont in xrange(count):
+        wheel.schedule(cont % 100 * 0.01, len, '')
+    now[0] = 1.0
+    start = timeit.default_timer()
+    wheel.advance()
+    return timeit.default_timer() - start
+
+
+def routeEager():
+    iso = AS2805()
+    iso.setNetworkISO(Network_0200_Icc)
+    return [iso.getBit(bit) for bit in Routing_Bits]
+
+
+def routeLazy():
+    iso = AS2805(lazy=True)
+    iso.setNetworkISO(Network_0200_Icc)
+    return [iso.getBit(bit) for bit in Routing_Bits]
+
+
+def routeSelective():
+    return Router.decodeFields(Network_0200_Icc[4:], Routing_Bits)
+
+
+def build0420():
+    iso = AS2805()
+    iso.setMTI('0420')
+    iso.setBit(2, '5188680100002932')
+    iso.setBit(3, '011000')
+    iso.setBit(4, '000000002000')
+    iso.setBit(7, '0107234821')
+    iso.setBit(11, '000507')
+    iso.setBit(32, '560258')
+    iso.setBit(41, 'S9218163')
+    iso.setBit(90, '020000050601072347210000056025800000000000')
+    return iso.getNetworkISO()
+
+
+def build0800():
+    iso = AS2805()
+    iso.setMTI('0800')
+    iso.setBit(7, '0218070354')
+    iso.setBit(11, '000361')
+    iso.setBit(70, '301')
+    return iso.getNetworkISO()
+
+
+# One message per shape of the MTIs exchanged with the host, without the 4 bytes header
+Shape_Messages = [
+    ('0200', Network_0200_Icc[4:]),
+    ('0210', HexToByte("02103222001182c008810110000000000020000107234745000506010844000002000656025808611000163030533932313831363334333735383630303020202020202000000000000000010000000000009550fec000000000")),
+    ('0420', build0420()[4:]),
+    ('0800', build0800()[4:]),
+    ('0820', Network_0820_Request[4:]),
+    ('0830', Network_0830_Response[4:]),
+]
+
+Shape_Values = [0] * 129
+
+
+def shapeCodec(shape, message):
+    """Return a function that decodes message through shape and encodes it back"""
+    mti = message[0:2]
+    bitmap = shape.bitmap
+
+    def codec():
+        shape.decode(message, Shape_Values)
+        return shape.encode(mti, bitmap, Shape_Values)
+    return codec
+
+
+def shapeBenchmarks():
+    """A generic and a generated codec benchmark per message shape"""
+    benchmarks = []
+    for name, message in Shape_Messages:
+        bitmap = message[2:18] if ord(message[2]) & 0x80 else message[2:10]
+        generic = _ShapePlan(AS2805._PLAN, bitmap)
+        generated = _ShapePlan(AS2805._PLAN, bitmap)
+        generated.compile()
+        benchmarks.append(('shape %s generic' % name, shapeCodec(generic, message)))
+        benchmarks.append(('shape %s generated' % name, shapeCodec(generated, message)))
+    return benchmarks
+
+
+def report(name, function, iterations):
+    """Run function iterations times, best of 3, and print the messages per second and the cost per message"""
+    elapsed = min(timeit.repeat(function, number=iterations, repeat=3))
+    print '%-32s %10.0f msg/s %10.0f ns/msg' % (name, iterations / elapsed, elapsed * 1e9 / iterations)
+    return elapsed
+
+
+BENCHMARKS = [
+    ('pack 0820', pack0820),
+    ('pack 0830', pack0830),
+    ('unpack 0820', unpack0820),
+    ('unpack 0830', unpack0830),
+    ('pack 0800', pack0800),
+    ('pack 0800 template', pack0800Template),
+    ('pack 0200', pack0200),
+    ('pack 0200 template', pack0200Template),
+    ('pack 0200 template encodeInto', pack0200TemplateInto),
+    ('respond 0810', respond0810),
+    ('respond 0810 derived', respond0810Derived),
+    ('respond 0210 ICC', respond0210),
+    ('respond 0210 ICC derived', respond0210Derived),
+    ('reverse 0200 ICC derived', reverse0200),
+    ('timeout answered, 100k in flight', timeoutAnswered),
+    ('MAC retail 0800', macRetail0800),
+    ('MAC retail 0200 ICC', macRetail0200),
+    ('MAC full 3DES 0200 ICC', macFull0200),
+    ('MAC retail 0800 key handle', macRetail0800Cached),
+    ('MAC retail 0200 ICC key handle', macRetail0200Cached),
+    ('MAC full 3DES 0200 ICC key handle', macFull0200Cached),
+    ('pack 0800 with MAC', pack0800MAC),
+    ('unpack 0800 verify MAC', unpack0800MAC),
+    ('session key lookup', sessionKeyLookup),
+    ('verify 0800 MAC session keys', unpack0800SessionMAC),
+    ('unpack 0820 pooled', unpack0820Pooled),
+    ('pack 0830 pooled', pack0830Pooled),
+    ('route 0200 ICC eager', routeEager),
+    ('route 0200 ICC lazy', routeLazy),
+    ('route 0200 ICC decodeFields', routeSelective),
+] + shapeBenchmarks()
+
+
+def footprint(objects):
+    """Return the sys.getsizeof total of objects and of everything they hold, every object counted once,
+    so what the messages share (interned names, small ints, ...) is nearly free over many messages"""
+    seen = set()
+    total = 0
+    stack = list(objects)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+        else:
+            if hasattr(obj, '__dict__'):
+                stack.append(obj.__dict__)
+            for name in getattr(type(obj), '__slots__', ()):
+                if hasattr(obj, name):
+                    stack.append(getattr(obj, name))
+    return total
+
+
+def reportMemory(name, factory, count):
+    """Keep count messages built by factory and print the bytes they cost each"""
+    messages = [factory() for cont in xrange(count)]
+    print '%-32s %10d messages %7.0f bytes/msg' % (name, count, float(footprint(messages)) / count)
+
+
+def keep(cls, frame):
+    """Return a function that keeps frame as a package of class cls"""
+    def factory():
+        iso = cls()
+        iso.setNetworkISO(frame)
+        return iso
+    return factory
+
+
+MEMORY_BENCHMARKS = [
+    ('memory 0200 ICC AS2805', keep(AS2805, Network_0200_Icc)),
+    ('memory 0200 ICC CompactAS2805', keep(CompactAS2805, Network_0200_Icc)),
+    ('memory 0820 AS2805', keep(AS2805, Network_0820_Request)),
+    ('memory 0820 CompactAS2805', keep(CompactAS2805, Network_0820_Request)),
+]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+    else:
+        iterations = 20000
+
+    if len(sys.argv) > 2:
+        messages = int(sys.argv[2])
+    else:
+        messages = 100000
+
+    for name, function in BENCHMARKS:
+        report(name, function, iterations)
+
+    print '%-32s %10.0f msg/s' % ('timeout expired, 100k in flight', 100000 / timeoutExpired())
+
+    print 'wire size: 0200 ICC %d bytes, 0820 %d bytes' % (len(Network_0200_Icc) - 4, len(Network_0820_Request) - 4)
+    for name, factory in MEMORY_BENCHMARKS:
+        reportMemory(name, factory, messages)
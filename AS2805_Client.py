@@ -3,8 +3,12 @@ import sys
 import time
 from datetime import datetime
 
-from AS2805 import AS2805
+from AS2805 import MessagePool, MessageTemplate
 from AS2805Errors import *
+from AS2805_MultiplexClient import MultiplexedClient, ConnectionClosed
+from AS2805_SessionKeys import SessionKeyStore
+from Shared.ByteUtils import HexToByte
+from Shared.AsyncCall import TimeoutError
 
 
 
@@ -15,47 +19,81 @@ serverIP = "127.0.0.1"
 serverPort = 9002
 numberEcho = 1
 timeBetweenEcho = 5 # in seconds
+responseTimeout = 30 # in seconds
 
 bigEndian = True
 #bigEndian = False
 
-s = None
-for res in socket.getaddrinfo(serverIP, serverPort, socket.AF_UNSPEC, socket.SOCK_STREAM):
-    af, socktype, proto, canonname, sa = res
-    try:
-        s = socket.socket(af, socktype, proto)
-    except socket.error, msg:
-        s = None
-        continue
+# key the session keys of the host's 0820 key change come encrypted under, hex, None when they come in the clear
+zoneMasterKey = None
+
+# session keys of the link to the host, each 0820 key change rolls them over
+sessionKeys = SessionKeyStore('%s:%s' % (serverIP, serverPort))
+
+# Responses are reused from one exchange to the next
+pool = MessagePool()
+
+# Requests only differ by their date, time and STAN, they are written into the same send buffer
+sendBuffer = bytearray(2048)
+loginTemplate = MessageTemplate('0800', {70: '001'}, (7, 11, 12, 13))
+keyExchangeTemplate = MessageTemplate('0800', {70: '101'}, (7, 11, 12, 13))
+
+
+
+def Alaric_KeyChange(client, frame):
+    """Return the 0830 of a key change from the host: bit 48 holds the MAC and PIN keys, they are current
+    once it is sent and the 0830 bit 48 returns their check values"""
     try:
-        s.connect(sa)
-    except socket.error, msg:
-        s.close()
-        s = None
-        continue
-    break
-if s is None:
-    print 'Could not connect :('
+        keys = client.CODEC.decodeFields(frame[4:], (48,)).get(48)
+        if keys is None:
+            raise InvalidAS2805('The key change has no bit 48')
+        checks = sessionKeys.acceptKeyChange(HexToByte(keys), HexToByte(zoneMasterKey) if zoneMasterKey else None)
+    except (InvalidAS2805, ValueError), ii:
+        print "0820 Key Change Failed, %s" % ii
+        return client.CODEC.deriveResponse(frame, {39: '30'}, remove=(48,), bigEndian=bigEndian)
+    print "0820 Key generation %s active, Check = %s" % (sessionKeys.current().GENERATION, checks)
+    return client.CODEC.deriveResponse(frame, {39: '00', 48: checks}, bigEndian=bigEndian)
+
+
+def Unsolicited(client, frame):
+    """Echoes and key changes from the host are answered as they come, whatever is in flight"""
+    print "%s, Unsolicited = %s" % (datetime.now(), frame)
+    if frame[4:6] == '\x08\x20':
+        client.sendFrame(Alaric_KeyChange(client, frame))
+    elif frame[4:6] == '\x08\x00':
+        client.sendFrame(client.CODEC.deriveResponse(frame, {39: '00'}, bigEndian=bigEndian))
+
+
+# requests and responses are matched by STAN, terminal and time, many can be in flight on the link
+try:
+    s = MultiplexedClient(serverIP, serverPort, bigEndian=bigEndian, unsolicited=Unsolicited)
+except socket.error, msg:
+    print 'Could not connect :( %s' % msg
     sys.exit(1)
 
 
+def receiveFrame(message):
+    """Send a request and return its response, None when the connection is closed"""
+    try:
+        return str(s.request(message, responseTimeout))
+    except ConnectionClosed:
+        return None
+
+
 def Alaric_Login():
     res = False
     d = datetime.now()
-    iso = AS2805(debug=False)
-    iso.setMTI('0800')
-    iso.setBit(7, d.strftime("%m%d%H%M%S"))
-    iso.setBit(11, '000001')
-    iso.setBit(12, d.strftime("%H%M%S"))
-    iso.setBit(13, d.strftime("%m%d"))
-    iso.setBit(70, '001')
+    isoAns = pool.acquire()
     try:
-        message = iso.getNetworkISO()
-        s.send(message)
-        print 'Sending ... %s' % message
-        ans = s.recv(2048)
+        values = {7: d.strftime("%m%d%H%M%S"), 11: '000001', 12: d.strftime("%H%M%S"), 13: d.strftime("%m%d")}
+        size = loginTemplate.encodeInto(values, sendBuffer, 0, bigEndian)
+        message = memoryview(sendBuffer)[:size]
+        print 'Sending ... %s' % message.tobytes()
+        ans = receiveFrame(message)
+        if ans is None:
+            print "Connection closed by the host"
+            return res
         print "Response  = %s" % ans
-        isoAns = AS2805()
         isoAns.setNetworkISO(ans)
         v1 = isoAns.getBitsAndValues()
         for v in v1:
@@ -70,8 +108,10 @@ def Alaric_Login():
         else:
             print "Could not login with 0800"
 
-    except InvalidAS2805, ii:
+    except (InvalidAS2805, TimeoutError), ii:
         print ii
+    finally:
+        pool.release(isoAns)
 
     return res
 
@@ -80,20 +120,17 @@ def Alaric_KeyExchange():
     print "PostBridge_KeyExchange()"
     res = False
     d = datetime.now()
-    iso = AS2805(debug=False)
-    iso.setMTI('0800')
-    iso.setBit(7, d.strftime("%m%d%H%M%S"))
-    iso.setBit(11, '000001')
-    iso.setBit(12, d.strftime("%H%M%S"))
-    iso.setBit(13, d.strftime("%m%d"))
-    iso.setBit(70, '101')
+    isoAns = pool.acquire()
     try:
-        message = iso.getNetworkISO()
-        s.send(message)
-        print 'Sending ... %s' % message
-        ans = s.recv(2048)
+        values = {7: d.strftime("%m%d%H%M%S"), 11: '000001', 12: d.strftime("%H%M%S"), 13: d.strftime("%m%d")}
+        size = keyExchangeTemplate.encodeInto(values, sendBuffer, 0, bigEndian)
+        message = memoryview(sendBuffer)[:size]
+        print 'Sending ... %s' % message.tobytes()
+        ans = receiveFrame(message)
+        if ans is None:
+            print "Connection closed by the host"
+            return res
         print "Response  = %s" % ans
-        isoAns = AS2805()
         isoAns.setNetworkISO(ans)
         v1 = isoAns.getBitsAndValues()
         for v in v1:
@@ -101,30 +138,25 @@ def Alaric_KeyExchange():
 
         if isoAns.getMTI() == '0810':
             if isoAns.getBit(39) == '00':
+                # the keys come with the 0820 key change the host sends next, see Alaric_KeyChange()
                 print "0800 Key Exchange sucessful"
-                Value = isoAns.getBit(125)[3:]
-                Key = Value[0:32]
-                Check = Value[32:]
-                print "Key = %s, Check = %s" % (Key, Check,)
                 res = True
             else:
                 print "0800 Response Code = %s, Key Exchange Failed" % (isoAns.getBit(39),)
         else:
             print "Could not key exchange with 0800"
 
-    except InvalidAS2805, ii:
+    except (InvalidAS2805, TimeoutError), ii:
         print ii
+    finally:
+        pool.release(isoAns)
 
 
 if __name__ == '__main__':
     if Alaric_Login():
         Alaric_KeyExchange()
 
-    s.settimeout(5)
-    print "timeout = %s" % (s.gettimeout())
-    while (True):
-        try:
-            ans = s.recv(2048)
-        except socket.error as e:
-            print "%s, Noting Received, Error = %s" % (datetime.now(), e)
+    # what the host sends from now on goes to Unsolicited()
+    while not s.CLOSED:
         time.sleep(10)
+    print "%s, Connection closed by the host" % (datetime.now(),)
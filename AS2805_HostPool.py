@@ -0,0 +1,245 @@
+__author__ = 'root'
+
+"""
+            Pool of signed on links to the AS2805 hosts
+
+Several links are kept to each host, every one a MultiplexedClient that only takes requests once
+it is signed on with a 0800 network management request, bit 70 = 001, approved by the host.
+A request goes to the signed on link with the fewest requests in flight. When a link drops, the
+requests still queued on it are sent on another link, or fail at once when there is none left. A
+request already sent is never sent again, the host may have authorised it: it fails with
+ConnectionClosed so the caller can reverse it. maintain() connects and signs on the links that are down.
+
+Example:
+    pool = HostPool([('196.26.173.115', 50089), ('127.0.0.1', 9002)], linksPerHost=2)
+    pool.start()
+    response = pool.request(frame, timeout=30)
+"""
+
+import logging
+import socket
+import threading
+import time
+from datetime import datetime
+
+from AS2805 import AS2805, MessageTemplate, InvalidAS2805, ValueToLarge
+from AS2805_MultiplexClient import MultiplexedClient, MultiplexError, ConnectionClosed
+from Shared.AsyncCall import TimeoutError
+
+
+Trace = logging.getLogger('AS2805.HostPool')
+
+# states of a link
+DOWN = 'down'
+SIGNING_ON = 'signing on'
+SIGNED_ON = 'signed on'
+
+
+class NoLinkAvailable(MultiplexError):
+    pass
+
+
+class _PoolLink:
+    """One link of the pool, its client and sign on state"""
+
+    def __init__(self, host, port, number):
+        self.HOST = host
+        self.PORT = port
+        self.NUMBER = number
+        self.CLIENT = None
+        self.STATE = DOWN
+        self.SINCE = time.time()
+        self.SIGN_ONS = 0
+
+    def setState(self, state):
+        if state != self.STATE:
+            Trace.info('%s:%s link %d %s', self.HOST, self.PORT, self.NUMBER, state)
+            self.STATE = state
+            self.SINCE = time.time()
+
+
+class HostPool:
+    """Links to several AS2805 hosts, signed on and picked by the fewest requests in flight.
+    @param: endpoints -> [(host, port), ...] of the hosts
+    @param: linksPerHost -> links kept to each host
+    @param: bigEndian (True|False) -> how the size header of the frames is represented
+    @param: unsolicited -> function(client, frame) called with the frames the hosts start
+    @param: timeout -> seconds to connect and to wait for the sign on response
+    @param: interval -> seconds between two maintain() of start()
+    @param: clientOptions -> other MultiplexedClient arguments of the links, {'declineCode': '91', 'target': 0.05}
+    """
+
+    _SIGN_ON = MessageTemplate('0800', {70: '001'}, (7, 11, 12, 13))
+
+    def __init__(self, endpoints, linksPerHost=2, bigEndian=True, unsolicited=None, timeout=10, interval=5,
+                 clientOptions=None):
+        self.BIG_ENDIAN = bigEndian
+        self.UNSOLICITED = unsolicited
+        self.TIMEOUT = timeout
+        self.INTERVAL = interval
+        self.CLIENT_OPTIONS = clientOptions or {}
+        self.CODEC = AS2805()
+        self.RUNNING = False
+        self.METRICS = {'requests': 0, 'failovers': 0, 'signOns': 0, 'signOnFailures': 0}
+
+        self._LINKS = [_PoolLink(host, port, number)
+                       for host, port in endpoints for number in range(linksPerHost)]
+        self._STAN = 0
+        self._LOCK = threading.Lock()
+        self._THREAD = None
+        self._WAKE = threading.Event()
+
+    ################################################################################################
+
+    def nextStan(self):
+        """Method that return the next STAN, bit 11, of the requests the pool starts"""
+        with self._LOCK:
+            self._STAN = self._STAN % 999999 + 1
+            return '%06d' % self._STAN
+
+    ################################################################################################
+
+    def signOn(self, link):
+        """Method that connect a link if it is down and sign it on
+        @return: bool -> True when the host approved the sign on
+        """
+        link.setState(SIGNING_ON)
+        try:
+            if link.CLIENT is None or link.CLIENT.CLOSED:
+                link.CLIENT = MultiplexedClient(link.HOST, link.PORT, bigEndian=self.BIG_ENDIAN,
+                                                unsolicited=self.UNSOLICITED, connectTimeout=self.TIMEOUT,
+                                                **self.CLIENT_OPTIONS)
+
+            d = datetime.now()
+            values = {7: d.strftime("%m%d%H%M%S"), 11: self.nextStan(), 12: d.strftime("%H%M%S"),
+                      13: d.strftime("%m%d")}
+            response = link.CLIENT.request(self._SIGN_ON.getNetworkISO(values, self.BIG_ENDIAN), self.TIMEOUT)
+            approved = self.CODEC.decodeFields(str(response[4:]), (39,)).get(39) == '00'
+        except (socket.error, MultiplexError, TimeoutError, InvalidAS2805, ValueToLarge), e:
+            Trace.warning('%s:%s link %d sign on failed: %s', link.HOST, link.PORT, link.NUMBER, e)
+            approved = False
+
+        if approved:
+            link.SIGN_ONS += 1
+            self.METRICS['signOns'] += 1
+            link.setState(SIGNED_ON)
+        else:
+            self.METRICS['signOnFailures'] += 1
+            if link.CLIENT is not None:
+                link.CLIENT.close()
+            link.setState(DOWN)
+        return approved
+
+    ################################################################################################
+
+    def maintain(self):
+        """Method that mark the links whose connection dropped as down and sign on the links that are down
+        @return: int -> number of links signed on
+        """
+        signedOn = 0
+        for link in self._LINKS:
+            if link.STATE == SIGNED_ON and link.CLIENT.CLOSED:
+                link.setState(DOWN)
+            if link.STATE == DOWN and self.signOn(link):
+                signedOn += 1
+        return signedOn
+
+    ################################################################################################
+
+    def start(self):
+        """Method that sign on the links and keep them signed on from a thread, until stop()"""
+        self.RUNNING = True
+        self._WAKE.clear()
+        self.maintain()
+        self._THREAD = threading.Thread(target=self.__maintainLoop, name='AS2805-pool')
+        self._THREAD.daemon = True
+        self._THREAD.start()
+
+    ################################################################################################
+
+    def stop(self):
+        """Method that stop maintaining the links and close them"""
+        self.RUNNING = False
+        self._WAKE.set()
+        if self._THREAD is not None:
+            self._THREAD.join()
+        for link in self._LINKS:
+            if link.CLIENT is not None:
+                link.CLIENT.close()
+            link.setState(DOWN)
+
+    ################################################################################################
+
+    def pick(self, exclude=()):
+        """Method that return the signed on link with the fewest requests in flight
+        @param: exclude -> links not to pick
+        @raise: NoLinkAvailable
+        """
+        best = None
+        for link in self._LINKS:
+            if link.STATE != SIGNED_ON or link in exclude:
+                continue
+            if link.CLIENT.CLOSED:
+                link.setState(DOWN)
+                continue
+            if best is None or link.CLIENT.outstanding() < best.CLIENT.outstanding():
+                best = link
+        if best is None:
+            raise NoLinkAvailable('No link is signed on')
+        return best
+
+    ################################################################################################
+
+    def request(self, frame, timeout=None, failover=True):
+        """Method that send a request on the least busy link and wait for its response.
+        When the link drops before the request went on the wire, it is sent on another link instead; once sent
+        it is never sent again, the host may have authorised it
+        @param: frame -> network frame of the request
+        @param: timeout -> seconds for the whole request, failovers included
+        @param: failover (True|False) -> False to fail at once when the link drops
+        @return: the response frame, 4 bytes size included
+        @raise: NoLinkAvailable, TimeoutError, ConnectionClosed -> the request may have reached the host when
+                it was sent, to be reversed
+        """
+        self.METRICS['requests'] += 1
+        end = None if timeout is None else time.time() + timeout
+        tried = []
+        while True:
+            link = self.pick(tried)
+            remaining = None if end is None else max(0, end - time.time())
+            pending = None
+            try:
+                pending = link.CLIENT.send(frame, deadline=remaining)
+                return pending.wait(remaining)
+            except TimeoutError:
+                link.CLIENT.cancel(pending)
+                raise
+            except ConnectionClosed:
+                link.setState(DOWN)
+                if not failover or (pending is not None and pending.SENT is not None):
+                    raise
+            tried.append(link)
+            self.METRICS['failovers'] += 1
+            Trace.warning('%s:%s link %d dropped, failing over', link.HOST, link.PORT, link.NUMBER)
+
+    ################################################################################################
+
+    def getLinks(self):
+        """Method that return the state of every link
+        @return: list of dict -> [{'host': ..., 'port': ..., 'link': 0, 'state': 'signed on', 'outstanding': 0, ...}]
+        """
+        return [{'host': link.HOST, 'port': link.PORT, 'link': link.NUMBER, 'state': link.STATE,
+                 'since': link.SINCE, 'signOns': link.SIGN_ONS,
+                 'outstanding': link.CLIENT.outstanding() if link.CLIENT is not None else 0}
+                for link in self._LINKS]
+
+    ################################################################################################
+
+    def __maintainLoop(self):
+        """Body of the thread of start()
+        It's a internal method, so don't call!
+        """
+        while self.RUNNING:
+            self._WAKE.wait(self.INTERVAL)
+            if self.RUNNING:
+                self.maintain()
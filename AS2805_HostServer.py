@@ -0,0 +1,507 @@
+__author__ = 'root'
+
+"""
+            Event driven AS2805 host server
+
+One process serves every terminal and host link: the sockets are non blocking and watched with
+epoll (poll where epoll is missing), each link has its own LengthPrefixFramer and send buffer, and
+every frame is handed to the handler registered for its MTI.
+A link whose send buffer grows past highWater, a peer that sends faster than it reads its responses,
+is not read any more until the buffer is drained back under it.
+A handler is called with the server and the request frame (size header included) and returns the
+response frame, or None to answer nothing.
+Tracing goes to the 'AS2805.HostServer' logger, for a sample of the frames only.
+HostServerCluster runs one server per core, every worker process accepting on the same port.
+
+Example:
+    server = AS2805HostServer('0.0.0.0', 9002, traceRate=0.001)
+    server.setHandler('0200', authorise)
+    server.serveForever()
+"""
+
+import binascii
+import errno
+import logging
+import multiprocessing
+import os
+import random
+import select
+import signal
+import socket
+import time
+
+from AS2805 import AS2805
+from Shared.Framer import LengthPrefixFramer, FramingError
+
+
+Trace = logging.getLogger('AS2805.HostServer')
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# receive buffer of each link, an AS2805 message is far smaller and there can be thousands of links
+_LINK_BUFFER = 8192
+
+# send buffer of a link past which it is not read any more
+_HIGH_WATER = 64 * 1024
+
+
+def answerNetworkManagement(server, frame):
+    """Default 0800 handler: the request echoed back as an approved 0810"""
+    return server.CODEC.deriveResponse(frame, {39: '00'}, bigEndian=server.BIG_ENDIAN)
+
+
+class _Poller:
+    """epoll, or poll where there is no epoll, with the timeout in seconds for both"""
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._POLL = select.epoll()
+            self.READ, self.WRITE = select.EPOLLIN, select.EPOLLOUT
+            self._SCALE = 1
+        else:
+            self._POLL = select.poll()
+            self.READ, self.WRITE = select.POLLIN, select.POLLOUT
+            self._SCALE = 1000
+        self.register = self._POLL.register
+        self.modify = self._POLL.modify
+        self.unregister = self._POLL.unregister
+
+    def poll(self, timeout):
+        try:
+            return self._POLL.poll(timeout * self._SCALE)
+        except (IOError, select.error), e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+
+class _Link:
+    """One accepted connection, its framer and what is still to be sent"""
+
+    def __init__(self, sock, address, bigEndian):
+        self.SOCKET = sock
+        self.FD = sock.fileno()  # a closed socket has no fileno() any more
+        self.ADDRESS = address
+        self.FRAMER = LengthPrefixFramer(capacity=_LINK_BUFFER, bigEndian=bigEndian)
+        self.OUT = bytearray()
+        self.EVENTS = None  # what the poller watches, set once registered
+
+
+class AS2805HostServer:
+    """Event driven AS2805 server, one handler per MTI.
+    @param: host, port -> where to listen, ignored when sock is given
+    @param: bigEndian (True|False) -> how the size header of the frames is represented
+    @param: traceRate -> share of the frames traced, 0 for none and 1 for all
+    @param: backlog -> connections waiting to be accepted
+    @param: sock -> a socket already listening, to share one between processes
+    @param: highWater -> bytes of responses waiting to be sent past which a link is not read
+    """
+
+    def __init__(self, host='127.0.0.1', port=9002, bigEndian=True, traceRate=0.0, backlog=1024, sock=None,
+                 highWater=_HIGH_WATER):
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((host, port))
+            sock.listen(backlog)
+        sock.setblocking(0)
+
+        self.SOCKET = sock
+        self.BIG_ENDIAN = bigEndian
+        self.TRACE_RATE = traceRate
+        self.HIGH_WATER = highWater
+        self.RUNNING = False
+
+        # decodeFields() and deriveResponse() leave the package untouched, the handlers share it
+        self.CODEC = AS2805()
+        self.HANDLERS = {'0800': answerNetworkManagement}
+        self.METRICS = {'connections': 0, 'frames': 0, 'responses': 0, 'unhandled': 0, 'errors': 0, 'throttled': 0}
+
+        self._POLLER = _Poller()
+        self._POLLER.register(sock.fileno(), self._POLLER.READ)
+        self._LINKS = {}
+
+    ################################################################################################
+
+    def setHandler(self, mti, handler):
+        """Method that register the handler of an MTI, None to drop the MTI
+        @param: mti -> MTI of the requests, '0200' for instance
+        @param: handler -> function(server, frame) that return the response frame or None
+        """
+        if handler is None:
+            self.HANDLERS.pop(mti, None)
+        else:
+            self.HANDLERS[mti] = handler
+
+    ################################################################################################
+
+    def getAddress(self):
+        """Method that return the (host, port) the server listens on"""
+        return self.SOCKET.getsockname()
+
+    ################################################################################################
+
+    def serveForever(self, timeout=0.5):
+        """Method that serve until stop() is called
+        @param: timeout -> seconds between two checks of stop()
+        """
+        self.RUNNING = True
+        while self.RUNNING:
+            self.serveOnce(timeout)
+
+    ################################################################################################
+
+    def stop(self):
+        """Method that make serveForever() return, the links stay open until close()"""
+        self.RUNNING = False
+
+    ################################################################################################
+
+    def close(self):
+        """Method that close every link and the listening socket"""
+        for link in self._LINKS.values():
+            self.__close(link)
+        self._POLLER.unregister(self.SOCKET.fileno())
+        self.SOCKET.close()
+
+    ################################################################################################
+
+    def serveOnce(self, timeout):
+        """Method that handle the events that are ready or come within timeout seconds"""
+        listener = self.SOCKET.fileno()
+        for fd, event in self._POLLER.poll(timeout):
+            if fd == listener:
+                self.__accept()
+                continue
+
+            link = self._LINKS.get(fd)
+            if link is None:
+                continue
+            # one link failing is closed, the others go on
+            try:
+                if event & self._POLLER.READ or not event & self._POLLER.WRITE:
+                    self.__read(link)
+                if event & self._POLLER.WRITE and fd in self._LINKS:
+                    self.__write(link)
+            except socket.error, e:
+                Trace.warning('%s:%s %s', link.ADDRESS[0], link.ADDRESS[1], e)
+                self.__close(link)
+
+    ################################################################################################
+
+    def __accept(self):
+        """Method that accept every connection waiting
+        It's a internal method, so don't call!
+        """
+        while True:
+            try:
+                sock, address = self.SOCKET.accept()
+            except socket.error, e:
+                if e.args[0] in _WOULD_BLOCK:
+                    return
+                raise
+            sock.setblocking(0)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            link = _Link(sock, address, self.BIG_ENDIAN)
+            self._LINKS[link.FD] = link
+            link.EVENTS = self._POLLER.READ
+            self._POLLER.register(link.FD, link.EVENTS)
+            self.METRICS['connections'] += 1
+
+    ################################################################################################
+
+    def __close(self, link):
+        """Method that forget and close a link
+        It's a internal method, so don't call!
+        """
+        if self._LINKS.pop(link.FD, None) is not None:
+            self._POLLER.unregister(link.FD)
+        link.SOCKET.close()
+
+    ################################################################################################
+
+    def __read(self, link):
+        """Method that read what a link sent and queue the responses of the complete frames
+        It's a internal method, so don't call!
+        """
+        try:
+            if not link.FRAMER.recvFrom(link.SOCKET):
+                self.__close(link)
+                return
+            frames = link.FRAMER.frames()
+        except socket.error, e:
+            if e.args[0] not in _WOULD_BLOCK:
+                self.__close(link)
+            return
+        except FramingError, fe:
+            Trace.warning('%s:%s %s', link.ADDRESS[0], link.ADDRESS[1], fe)
+            self.__close(link)
+            return
+
+        for frame in frames:
+            response = self.__dispatch(link, frame.tobytes())
+            if response:
+                link.OUT += response
+
+        if link.OUT:
+            self.__write(link)
+
+    ################################################################################################
+
+    def __write(self, link):
+        """Method that send what can be sent of the responses of a link
+        It's a internal method, so don't call!
+        """
+        try:
+            sent = link.SOCKET.send(link.OUT)
+        except socket.error, e:
+            if e.args[0] not in _WOULD_BLOCK:
+                self.__close(link)
+                return
+            sent = 0
+        del link.OUT[:sent]
+
+        # a link with too much left to send is not read until the peer reads
+        events = self._POLLER.WRITE if link.OUT else 0
+        if len(link.OUT) <= self.HIGH_WATER:
+            events |= self._POLLER.READ
+        elif link.EVENTS & self._POLLER.READ:
+            self.METRICS['throttled'] += 1
+        if events != link.EVENTS:
+            link.EVENTS = events
+            self._POLLER.modify(link.FD, events)
+
+    ################################################################################################
+
+    def __dispatch(self, link, frame):
+        """Method that hand a frame to the handler of its MTI and return the response
+        It's a internal method, so don't call!
+        """
+        self.METRICS['frames'] += 1
+        sampled = self.TRACE_RATE and random.random() < self.TRACE_RATE
+        if sampled:
+            self.__trace(link, '>>', frame)
+
+        handler = self.HANDLERS.get(binascii.hexlify(frame[4:6]))
+        if handler is None:
+            self.METRICS['unhandled'] += 1
+            return None
+
+        try:
+            response = handler(self, frame)
+        except Exception:
+            self.METRICS['errors'] += 1
+            Trace.exception('%s:%s handler of %s failed', link.ADDRESS[0], link.ADDRESS[1],
+                            binascii.hexlify(frame[4:6]))
+            return None
+
+        if response:
+            self.METRICS['responses'] += 1
+            if sampled:
+                self.__trace(link, '<<', str(response))
+        return response
+
+    ################################################################################################
+
+    def __trace(self, link, direction, frame):
+        """Method that log the bits of a frame
+        It's a internal method, so don't call!
+        """
+        try:
+            pack = AS2805()
+            pack.setNetworkISO(frame, self.BIG_ENDIAN)
+            bits = ' '.join(['%s=[%s]' % (v['bit'], v['value']) for v in pack.getBitsAndValues()])
+            Trace.info('%s:%s %s %s %s', link.ADDRESS[0], link.ADDRESS[1], direction, pack.getMTI(), bits)
+        except Exception, e:
+            Trace.info('%s:%s %s %s (%s)', link.ADDRESS[0], link.ADDRESS[1], direction, binascii.hexlify(frame), e)
+
+
+################################################################################################
+#                                   Multi-process                                              #
+################################################################################################
+
+# Linux value, the socket module of Python 2 does not always define it
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+_METRICS = ('connections', 'frames', 'responses', 'unhandled', 'errors', 'throttled')
+
+
+def listenSocket(host, port, backlog=1024, reusePort=False):
+    """Return a socket bound to host:port, that other sockets can bind too when reusePort is set
+    @param: backlog -> connections waiting to be accepted, None to bind only
+    @raise: socket.error
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reusePort:
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    if backlog is not None:
+        sock.listen(backlog)
+    return sock
+
+
+def _work(sock, address, handlers, counters, bigEndian, traceRate, interval, ready):
+    """Body of a worker process: serve and publish the metrics every interval seconds"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if sock is None:
+        sock = listenSocket(address[0], address[1], reusePort=True)
+    server = AS2805HostServer(bigEndian=bigEndian, traceRate=traceRate, sock=sock)
+    for mti, handler in handlers.items():
+        server.setHandler(mti, handler)
+    ready.set()
+
+    while True:
+        server.serveOnce(interval)
+        for index, name in enumerate(_METRICS):
+            counters[index] = server.METRICS[name]
+
+
+class _Worker:
+    """One slot of the cluster, the process in it is replaced when it dies"""
+
+    def __init__(self, number):
+        self.NUMBER = number
+        self.PROCESS = None
+        self.READY = multiprocessing.Event()
+        self.COUNTERS = multiprocessing.Array('L', len(_METRICS), lock=False)
+        self.TOTALS = dict.fromkeys(_METRICS, 0)  # what the processes that died had counted
+        self.RESTARTS = 0
+
+
+class HostServerCluster:
+    """Workers processes, each an AS2805HostServer, that share one port.
+    Every worker binds the port with SO_REUSEPORT so the kernel spreads the connections among them;
+    where SO_REUSEPORT is missing they accept on one socket the parent listens on.
+    @param: host, port -> where to listen, port 0 for any port
+    @param: workers -> number of processes, one per core by default
+    @param: handlers -> {mti: handler} registered in every worker, on top of the default 0800 one
+    @param: bigEndian (True|False) -> how the size header of the frames is represented
+    @param: traceRate -> share of the frames traced
+    @param: interval -> seconds between two metrics updates of a worker
+    """
+
+    def __init__(self, host='127.0.0.1', port=9002, workers=None, handlers=None, bigEndian=True, traceRate=0.0,
+                 interval=0.5):
+        self.BIG_ENDIAN = bigEndian
+        self.TRACE_RATE = traceRate
+        self.INTERVAL = interval
+        self.HANDLERS = dict(handlers or {})
+        self.RUNNING = False
+
+        # the parent keeps the port bound, port 0 gets a port that way, but only listens without SO_REUSEPORT
+        try:
+            self.SOCKET = listenSocket(host, port, backlog=None, reusePort=True)
+            self.REUSE_PORT = True
+        except socket.error:
+            self.SOCKET = listenSocket(host, port)
+            self.REUSE_PORT = False
+        self.ADDRESS = self.SOCKET.getsockname()
+
+        self._WORKERS = [_Worker(number) for number in range(workers or multiprocessing.cpu_count())]
+
+    ################################################################################################
+
+    def getAddress(self):
+        """Method that return the (host, port) the workers listen on"""
+        return self.ADDRESS
+
+    ################################################################################################
+
+    def start(self, timeout=10):
+        """Method that start the workers and wait until they are all listening
+        @param: timeout -> seconds to wait for each worker
+        """
+        self.RUNNING = True
+        for worker in self._WORKERS:
+            self.__spawn(worker)
+        for worker in self._WORKERS:
+            worker.READY.wait(timeout)
+
+    ################################################################################################
+
+    def supervise(self):
+        """Method that restart the workers that died
+        @return: int -> number of workers restarted
+        """
+        restarted = 0
+        for worker in self._WORKERS:
+            if self.RUNNING and not worker.PROCESS.is_alive():
+                worker.PROCESS.join()
+                Trace.warning('worker %d (pid %d) died with %s, restarting', worker.NUMBER, worker.PROCESS.pid,
+                              worker.PROCESS.exitcode)
+                for index, name in enumerate(_METRICS):
+                    worker.TOTALS[name] += worker.COUNTERS[index]
+                    worker.COUNTERS[index] = 0
+                worker.RESTARTS += 1
+                self.__spawn(worker)
+                restarted += 1
+        return restarted
+
+    ################################################################################################
+
+    def serveForever(self):
+        """Method that start the workers and supervise them until stop() is called"""
+        self.start()
+        try:
+            while self.RUNNING:
+                time.sleep(self.INTERVAL)
+                self.supervise()
+        finally:
+            self.stop()
+
+    ################################################################################################
+
+    def stop(self):
+        """Method that terminate the workers"""
+        self.RUNNING = False
+        for worker in self._WORKERS:
+            if worker.PROCESS is not None and worker.PROCESS.is_alive():
+                worker.PROCESS.terminate()
+        for worker in self._WORKERS:
+            if worker.PROCESS is not None:
+                worker.PROCESS.join()
+        self.SOCKET.close()
+
+    ################################################################################################
+
+    def getMetrics(self):
+        """Method that return the metrics of each worker, as of their last update, and of the cluster
+        @return: list of dict, the last one the totals -> [{'worker': 0, 'pid': ..., 'restarts': 0, 'frames': ...}, ...]
+        """
+        metrics = []
+        totals = dict.fromkeys(_METRICS, 0)
+        totals.update({'worker': 'all', 'pid': os.getpid(), 'restarts': 0})
+        for worker in self._WORKERS:
+            entry = {'worker': worker.NUMBER, 'pid': worker.PROCESS and worker.PROCESS.pid, 'restarts': worker.RESTARTS}
+            for index, name in enumerate(_METRICS):
+                entry[name] = worker.TOTALS[name] + worker.COUNTERS[index]
+                totals[name] += entry[name]
+            totals['restarts'] += worker.RESTARTS
+            metrics.append(entry)
+        metrics.append(totals)
+        return metrics
+
+    ################################################################################################
+
+    def __spawn(self, worker):
+        """Method that start the process of a worker slot
+        It's a internal method, so don't call!
+        """
+        sock = None if self.REUSE_PORT else self.SOCKET
+        worker.READY.clear()
+        worker.PROCESS = multiprocessing.Process(target=_work, name='AS2805-worker-%d' % worker.NUMBER,
+                                                 args=(sock, self.ADDRESS, self.HANDLERS, worker.COUNTERS,
+                                                       self.BIG_ENDIAN, self.TRACE_RATE, self.INTERVAL, worker.READY))
+        worker.PROCESS.daemon = True
+        worker.PROCESS.start()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    server = AS2805HostServer('127.0.0.1', 9002, traceRate=1.0)
+    try:
+        server.serveForever()
+    except KeyboardInterrupt:
+        pass
+    server.close()
@@ -0,0 +1,149 @@
+__author__ = 'root'
+
+"""
+            Load test of AS2805HostServer
+
+The server runs in a child process, or as a HostServerCluster of that many workers, and as many
+driver processes share the links: each link keeps a window of 0800 echo requests in flight, sends
+the next one as soon as a response comes back, and matches the responses to the requests by STAN.
+Prints the sustained transactions per second, the latency percentiles and the metrics of the workers.
+
+Usage: python AS2805_LoadTest.py [links] [seconds] [window] [workers]
+"""
+
+import errno
+import multiprocessing
+import select
+import socket
+import sys
+import time
+
+from AS2805 import AS2805, MessageTemplate
+from AS2805_HostServer import AS2805HostServer, HostServerCluster
+from Shared.Framer import LengthPrefixFramer
+
+
+Echo = MessageTemplate('0800', {70: '301'}, (7, 11))
+
+
+def serve(sock):
+    server = AS2805HostServer(sock=sock)
+    try:
+        server.serveForever()
+    except KeyboardInterrupt:
+        pass
+
+
+class Link:
+    def __init__(self, address, number):
+        self.SOCKET = socket.create_connection(address)
+        self.SOCKET.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.SOCKET.setblocking(0)
+        self.FRAMER = LengthPrefixFramer(capacity=8192)
+        self.STAN = number * 1000
+        self.SENT = {}
+
+    def send(self, count):
+        out = []
+        now = time.time()
+        for i in range(count):
+            self.STAN = (self.STAN + 1) % 1000000
+            stan = '%06d' % self.STAN
+            out.append(Echo.getNetworkISO({7: time.strftime('%m%d%H%M%S'), 11: stan}))
+            self.SENT[stan] = now
+        self.SOCKET.sendall(''.join(out))
+
+
+def percentile(ordered, share):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+def drive(address, first, links, seconds, window, results):
+    codec = AS2805()
+    latencies = []
+    poller = select.epoll()
+    active = {}
+    for number in range(first, first + links):
+        link = Link(address, number)
+        active[link.SOCKET.fileno()] = link
+        poller.register(link.SOCKET.fileno(), select.EPOLLIN)
+        link.send(window)
+
+    end = time.time() + seconds
+    while time.time() < end:
+        for fd, event in poller.poll(0.5):
+            link = active[fd]
+            try:
+                if not link.FRAMER.recvFrom(link.SOCKET):
+                    raise RuntimeError('Server closed a link')
+            except socket.error, e:
+                if e.args[0] == errno.EAGAIN:
+                    continue
+                raise
+
+            now = time.time()
+            answered = 0
+            for frame in link.FRAMER.frames():
+                stan = codec.decodeFields(frame[4:].tobytes(), (11,))[11]
+                latencies.append(now - link.SENT.pop(stan))
+                answered += 1
+            if answered:
+                link.send(answered)
+    results.put(latencies)
+
+
+def run(links=100, seconds=10, window=4, workers=0):
+    if workers:
+        cluster = HostServerCluster('127.0.0.1', 0, workers=workers)
+        cluster.start()
+        address = cluster.getAddress()
+    else:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1024)
+        server = multiprocessing.Process(target=serve, args=(listener,))
+        server.start()
+        address = listener.getsockname()
+
+    drivers = max(workers, 1)
+    results = multiprocessing.Queue()
+    latencies = []
+    try:
+        shares = [links * number // drivers for number in range(drivers + 1)]
+        processes = [multiprocessing.Process(target=drive, args=(address, shares[number],
+                                                                   shares[number + 1] - shares[number],
+                                                                   seconds, window, results))
+                     for number in range(drivers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            latencies.extend(results.get())
+        for process in processes:
+            process.join()
+        if workers:
+            time.sleep(cluster.INTERVAL * 2)
+            metrics = cluster.getMetrics()
+    finally:
+        if workers:
+            cluster.stop()
+        else:
+            server.terminate()
+            server.join()
+
+    latencies.sort()
+    print '%d links, window %d, %d workers, %d seconds' % (links, window, workers, seconds)
+    print '%10d transactions, %10.0f TPS' % (len(latencies), len(latencies) / float(seconds))
+    for name, share in (('p50', 0.5), ('p99', 0.99), ('p99.9', 0.999)):
+        print '%10s %10.3f ms' % (name, percentile(latencies, share) * 1000)
+    print '%10s %10.3f ms' % ('max', latencies[-1] * 1000)
+    if workers:
+        for entry in metrics:
+            print '%10s pid %-8s %10d frames %10d responses %6d links %3d restarts' % (
+                entry['worker'], entry['pid'], entry['frames'], entry['responses'], entry['connections'],
+                entry['restarts'])
+
+
+if __name__ == '__main__':
+    arguments = [int(argument) for argument in sys.argv[1:5]]
+    run(*arguments)
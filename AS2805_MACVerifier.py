@@ -0,0 +1,339 @@
+__author__ = 'root'
+
+"""
+            Batched MAC verification in worker processes
+
+The MACs of a batch of received frames are checked by a multiprocessing Pool, so the network loop
+only copies the frames and goes on while the DES work runs on the other cores. Neither the frames
+nor the keys are pickled: the frames are copied once into an anonymous shared mmap, the arena, and
+the keys into a second one, the key table, that the workers inherit when they are forked. Each task
+only carries the offsets of its frames and the slots of the keys they need. The batch is split into
+chunks, at least one per worker, and each worker keeps the DES objects of the keys it saw in its own
+CipherCache.
+
+The arena is used as a ring, a batch takes the space after the previous one and gives it back once
+verified. submit() never blocks: a batch that does not fit next to the batches in flight, or whose
+keys find no free slot, is queued and started as soon as the older ones are verified.
+
+The callbacks run on the thread of the pool that hands the results over, the one that also starts
+the queued batches. They may submit() more batches, but must not wait for one: verify() or
+MACBatch.wait() from a callback would never return.
+
+Example:
+    verifier = MACVerifierPool(processes=4)
+    batch = verifier.submit([(frame, handle) for frame in frames], callback=lambda batch: route(batch.Result))
+    ...
+    valid = verifier.verify([(frame, handle)])     # [True]
+"""
+
+import collections
+import logging
+import mmap
+import multiprocessing
+import threading
+
+from AS2805 import AS2805
+from Shared.AsyncCall import TimeoutError
+from Shared.CipherCache import Ciphers, KeyHandle
+
+
+Trace = logging.getLogger('AS2805.MACVerifier')
+
+# a slot of the key table: the length of the key, then up to 24 bytes of it
+_KEY_SLOT = 25
+
+# the arena and the key table of a worker process, inherited from the pool that forked it
+_WORKER_ARENA = None
+_WORKER_KEYS = None
+
+
+def _initWorker(arena, keys):
+    global _WORKER_ARENA, _WORKER_KEYS
+    _WORKER_ARENA = arena
+    _WORKER_KEYS = keys
+
+
+def _verifyChunk(task):
+    """Worker side, return the MAC check of each frame of a chunk. It never raises: the pool hands no
+    error over, the batch would never complete and its region would never be given back
+    @param: task -> (start of the region, [(offset in the region, length, keyId)], {keyId: slot of the key})
+    @return: list of bool
+    """
+    base, frames, slots = task
+    handles = {}
+    for keyId, slot in slots.items():
+        try:
+            start = slot * _KEY_SLOT
+            key = _WORKER_KEYS[start + 1:start + 1 + ord(_WORKER_KEYS[start])]
+            # the same key as last time keeps its handle and its ciphers
+            handles[keyId] = Ciphers.register(keyId, key)
+        except Exception:
+            # a key that is not a DES key fails the checks of its frames, not the batch
+            pass
+    results = []
+    for offset, length, keyId in frames:
+        try:
+            offset += base
+            AS2805(lazy=True).setNetworkISO(_WORKER_ARENA[offset:offset + length], macKey=handles[keyId])
+            results.append(True)
+        except Exception:
+            # a frame that does not even parse from the network fails its check, not the batch
+            results.append(False)
+    return results
+
+
+class MACBatch:
+    """A batch submitted and not verified yet, like the AsyncCall of Shared.AsyncCall
+    @param: size -> number of frames
+    @param: callback -> function(batch) called from the pool once the batch is verified
+    """
+
+    def __init__(self, size, callback=None):
+        self.SIZE = size
+        self.Callback = callback
+        self.Result = None
+        self._EVENT = threading.Event()
+
+    def done(self):
+        """Return True once the batch is verified"""
+        return self._EVENT.isSet()
+
+    def wait(self, timeout=None):
+        """Return the list of the MAC checks, True or False, one per frame in the submitted order
+        @raise: TimeoutError
+        """
+        if not self._EVENT.wait(timeout) and not self._EVENT.isSet():
+            raise TimeoutError('%d frames not verified within %s seconds' % (self.SIZE, timeout))
+        return self.Result
+
+    def complete(self, result):
+        """Method that hand the results over, it's done by the pool"""
+        self.Result = result
+        self._EVENT.set()
+        if self.Callback:
+            self.Callback(self)
+
+
+class MACVerifierPool:
+    """Worker processes verifying the MACs of frames, bit 64 or 128 as AS2805.setNetworkISO(macKey=...).
+    @param: processes -> number of workers, one per core by default
+    @param: arena -> bytes of shared memory for the frames of the batches in flight
+    @param: chunk -> most frames per task
+    @param: keys -> slots of the key table, the most distinct keys of the batches in flight
+    """
+
+    def __init__(self, processes=None, arena=4 * 1024 * 1024, chunk=64, keys=256):
+        self.PROCESSES = processes or multiprocessing.cpu_count()
+        self.ARENA_SIZE = arena
+        self.CHUNK = chunk
+        self.KEYS = keys
+        self.CLOSED = False
+        self.METRICS = {'batches': 0, 'frames': 0, 'invalid': 0, 'queued': 0}
+
+        # created before the pool so the workers are forked with them
+        self._ARENA = mmap.mmap(-1, arena)
+        self._KEY_TABLE = mmap.mmap(-1, keys * _KEY_SLOT)
+        self._REGIONS = collections.deque()  # [start, end, verified] of the batches in flight, oldest first
+        self._SLOTS = collections.OrderedDict()  # {KeyHandle: slot} of the keys in the table, least recently used first
+        self._USERS = [0] * keys  # batches in flight using each slot
+        self._FREE = range(keys)  # slots never used
+        self._BACKLOG = collections.deque()  # batches waiting for space, oldest first
+        self._SPACE = threading.Condition()
+        self._POOL = multiprocessing.Pool(self.PROCESSES, _initWorker, (self._ARENA, self._KEY_TABLE))
+
+    ################################################################################################
+
+    def submit(self, pairs, callback=None):
+        """Method that start the verification of a batch of frames, or queue it when the arena or the key table
+        is full; it never blocks
+        @param: pairs -> list of (network frame, KeyHandle of its MAC key), the frames as setNetworkISO() takes them
+        @param: callback -> function(batch) called from a thread of the pool once the batch is verified, it must
+                not wait for a batch
+        @return: MACBatch
+        @raise: ValueError when a frame has no KeyHandle, the frames or their keys do not fit in the pool at all,
+                or the pool is closed
+        """
+        batch = MACBatch(len(pairs), callback)
+        if not pairs:
+            batch.complete([])
+            return batch
+
+        # all that can fail is done before the arena is taken, the layout is relative to the region
+        frames = []
+        layout = []
+        handles = set()
+        size = max(1, min(self.CHUNK, -(-len(pairs) // self.PROCESSES)))
+        offset = 0
+        for first in xrange(0, len(pairs), size):
+            chunk = []
+            keys = {}
+            for frame, handle in pairs[first:first + size]:
+                if not isinstance(handle, KeyHandle):
+                    raise ValueError('Frame %d has no KeyHandle but %r' % (len(frames), handle))
+                frame = str(frame)
+                frames.append(frame)
+                chunk.append((offset, len(frame), handle.ID))
+                keys[handle.ID] = handle
+                handles.add(handle)
+                offset += len(frame)
+            layout.append((chunk, keys))
+        if offset > self.ARENA_SIZE:
+            raise ValueError('%d bytes of frames do not fit in an arena of %d' % (offset, self.ARENA_SIZE))
+        if len(handles) > self.KEYS:
+            raise ValueError('%d keys do not fit in a key table of %d' % (len(handles), self.KEYS))
+
+        work = (batch, frames, layout, offset, handles)
+        with self._SPACE:
+            if self.CLOSED:
+                raise ValueError('The pool is closed')
+            # the queued batches go first, in the order they came
+            space = None if self._BACKLOG else self.__reserve(offset, handles)
+            if space is None:
+                self._BACKLOG.append(work)
+                self.METRICS['queued'] += 1
+                return batch
+        self.__start(work, *space)
+        return batch
+
+    ################################################################################################
+
+    def verify(self, pairs, timeout=None):
+        """Method that verify a batch of frames and wait for it, not from a callback
+        @return: list of bool, one per frame
+        @raise: TimeoutError
+        """
+        return self.submit(pairs).wait(timeout)
+
+    ################################################################################################
+
+    def close(self):
+        """Method that wait for the batches in flight and queued, and stop the workers"""
+        with self._SPACE:
+            self.CLOSED = True
+            while self._REGIONS or self._BACKLOG:
+                self._SPACE.wait()
+        self._POOL.close()
+        self._POOL.join()
+        self._ARENA.close()
+        self._KEY_TABLE.close()
+
+    ################################################################################################
+
+    def __start(self, work, region, slots):
+        """Method that copy a batch into its region and hand its chunks to the workers
+        It's a internal method, so don't call!
+        """
+        batch, frames, layout, size, handles = work
+
+        def verified(results):
+            self.__release(region, slots)
+            results = [valid for chunk in results for valid in chunk]
+            self.METRICS['batches'] += 1
+            self.METRICS['frames'] += len(results)
+            self.METRICS['invalid'] += results.count(False)
+            try:
+                batch.complete(results)
+            except Exception:
+                # raised in the thread of the pool that hands all the results over, it must go on
+                Trace.exception('callback of a batch of %d frames failed', len(results))
+
+        try:
+            offset = region[0]
+            for frame in frames:
+                self._ARENA[offset:offset + len(frame)] = frame
+                offset += len(frame)
+            tasks = [(region[0], chunk, dict([(keyId, slots[handle]) for keyId, handle in keys.items()]))
+                     for chunk, keys in layout]
+            self._POOL.map_async(_verifyChunk, tasks, 1, verified)
+        except Exception:
+            # the batch never started, its space must not stay taken
+            self.__release(region, slots)
+            raise
+
+    ################################################################################################
+
+    def __reserve(self, size, handles):
+        """Method that take size bytes of the arena and a slot of the key table per handle, with _SPACE held
+        It's a internal method, so don't call!
+        @return: (region, {KeyHandle: slot}), None when the batches in flight leave too little of either
+        """
+        start = self.__allocate(size)
+        if start is None:
+            return None
+
+        # a key already in the table keeps its slot, the others take a free one or the least recently used idle one
+        missing = [handle for handle in handles if handle not in self._SLOTS]
+        idle = [handle for handle, slot in self._SLOTS.items() if not self._USERS[slot] and handle not in handles]
+        if len(missing) > len(self._FREE) + len(idle):
+            return None
+
+        slots = {}
+        for handle in handles:
+            if handle in self._SLOTS:
+                slots[handle] = self._SLOTS.pop(handle)
+        for handle in missing:
+            slot = self._FREE.pop() if self._FREE else self._SLOTS.pop(idle.pop(0))
+            key = handle.KEY if len(handle.KEY) < _KEY_SLOT else ''
+            begin = slot * _KEY_SLOT
+            self._KEY_TABLE[begin:begin + 1 + len(key)] = chr(len(key)) + key
+            slots[handle] = slot
+        for handle, slot in slots.items():
+            self._SLOTS[handle] = slot
+            self._USERS[slot] += 1
+
+        region = [start, start + size, False]
+        self._REGIONS.append(region)
+        return region, slots
+
+    ################################################################################################
+
+    def __allocate(self, size):
+        """Method that find size bytes of the arena after the batches in flight, with _SPACE held
+        It's a internal method, so don't call!
+        @return: the start of the space, None when there is not enough of it
+        """
+        if not self._REGIONS:
+            return 0
+        head = self._REGIONS[0][0]
+        tail = self._REGIONS[-1][1]
+        if tail > head:
+            # in use from head to tail, free after tail and before head
+            if tail + size <= self.ARENA_SIZE:
+                return tail
+            if size <= head:
+                return 0
+        elif tail + size <= head:
+            # wrapped around, free between tail and head only
+            return tail
+        return None
+
+    ################################################################################################
+
+    def __release(self, region, slots):
+        """Method that give the space of a verified batch back, in the order it was taken, and start the queued
+        batches that fit in it
+        It's a internal method, so don't call!
+        """
+        ready = []
+        with self._SPACE:
+            region[2] = True
+            while self._REGIONS and self._REGIONS[0][2]:
+                self._REGIONS.popleft()
+            for slot in slots.values():
+                self._USERS[slot] -= 1
+            while self._BACKLOG:
+                work = self._BACKLOG[0]
+                space = self.__reserve(work[3], work[4])
+                if space is None:
+                    break
+                self._BACKLOG.popleft()
+                ready.append((work, space))
+            self._SPACE.notifyAll()
+
+        for work, space in ready:
+            try:
+                self.__start(work, *space)
+            except Exception:
+                # nothing verified, none of its frames is taken as valid
+                Trace.exception('batch of %d frames failed to start', work[0].SIZE)
+                work[0].complete([False] * work[0].SIZE)
@@ -0,0 +1,434 @@
+__author__ = 'root'
+
+"""
+            Multiplexed AS2805 client
+
+Many requests are in flight on one connection at a time. Every request sent gets a PendingRequest,
+and a reader thread completes it when a response with the same bits 11 (STAN), 41 (terminal) and
+7 (transmission date and time) comes back, whatever the order the host answers in.
+Frames that answer nothing sent, the 0800 and 0820 the host starts for instance, are handed to the
+unsolicited callback.
+A writer thread sends what is queued, network management first, then reversals and advices, then
+financial requests, so echoes and key changes are never stuck behind a burst. The financial queue
+is kept short the CoDel way: once its requests have waited longer than the target delay for a whole
+interval, some of them are declined locally, with a response code of ASResponseCodes, instead of
+being sent late; so is any request whose response could no longer come before its deadline.
+
+Example:
+    def unsolicited(client, frame):
+        client.sendFrame(codec.deriveResponse(frame, {39: '00'}))
+
+    client = MultiplexedClient('127.0.0.1', 9002, unsolicited=unsolicited)
+    response = client.request(frame, timeout=5)
+"""
+
+import collections
+import logging
+import math
+import socket
+import threading
+import time
+
+from AS2805 import AS2805, InvalidAS2805, ValueToLarge
+from ASResponseCodes import GetISOResponseText
+from Shared.AsyncCall import TimeoutError
+from Shared.Framer import LengthPrefixFramer, FramingError
+
+
+Trace = logging.getLogger('AS2805.MultiplexClient')
+
+# bits a response echoes from its request, together they tell the requests in flight apart
+MATCH_BITS = (7, 11, 41)
+
+# send priorities, the lower first
+NETWORK_MANAGEMENT = 0
+ADVICE = 1
+FINANCIAL = 2
+PRIORITIES = 3
+
+# frames joined into one send by the writer thread
+_BATCH = 64
+
+
+def getPriority(frame):
+    """Return the send priority of a network frame from its MTI: 08xx are network management,
+    04xx reversals and xx2x to xx5x (advices, notifications and their responses) advices, the rest financial"""
+    mti = frame[4:6]
+    if mti[0] == '\x08':
+        return NETWORK_MANAGEMENT
+    if mti[0] == '\x04' or ord(mti[1]) & 0xe0 in (0x20, 0x40):
+        return ADVICE
+    return FINANCIAL
+
+
+class MultiplexError(Exception):
+    pass
+
+
+class ConnectionClosed(MultiplexError):
+    pass
+
+
+class PendingRequest:
+    """A request sent and not answered yet, like the AsyncCall of Shared.AsyncCall
+    @param: key -> (bit 11, bit 41, bit 7) of the request, None for the bits it does not have
+    @param: callback -> function(pending) called by the reader thread once the request is answered or failed
+    """
+
+    def __init__(self, key, callback=None):
+        self.KEY = key
+        self.Callback = callback
+        self.Result = None
+        self.Error = None
+        self.Declined = False  # the response was made up locally, the request was not sent
+        self.SENT = None
+        self._EVENT = threading.Event()
+
+    def done(self):
+        """Return True once the request is answered or failed"""
+        return self._EVENT.isSet()
+
+    def wait(self, timeout=None):
+        """Return the response frame, 4 bytes size included
+        @raise: TimeoutError, ConnectionClosed
+        """
+        if not self._EVENT.wait(timeout) and not self._EVENT.isSet():
+            raise TimeoutError('No response to %s within %s seconds' % (self.KEY, timeout))
+        if self.Error is not None:
+            raise self.Error
+        return self.Result
+
+    def complete(self, result=None, error=None):
+        """Method that answer or fail the request, it's done by the client"""
+        self.Result = result
+        self.Error = error
+        self._EVENT.set()
+        if self.Callback:
+            self.Callback(self)
+
+
+class MultiplexedClient:
+    """Client of an AS2805 host that keeps many requests in flight on one connection.
+    @param: host, port -> the host, ignored when sock is given
+    @param: bigEndian (True|False) -> how the size header of the frames is represented
+    @param: unsolicited -> function(client, frame) called with the frames that answer nothing sent
+    @param: sock -> a socket already connected
+    @param: connectTimeout -> seconds to connect
+    @param: declineCode -> bit 39 of the responses made up for the financial requests that are shed
+    @param: target -> seconds a financial request may wait to be sent before the queue counts as late, None to never shed
+    @param: interval -> seconds the queue must stay late before requests are shed
+    """
+
+    def __init__(self, host='127.0.0.1', port=9002, bigEndian=True, unsolicited=None, sock=None, connectTimeout=10,
+                 declineCode='91', target=0.05, interval=0.5):
+        if GetISOResponseText(declineCode) == 'Unmapped Response':
+            raise MultiplexError('%s is not an AS2805 response code' % declineCode)
+        if sock is None:
+            sock = socket.create_connection((host, port), connectTimeout)
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self.SOCKET = sock
+        self.BIG_ENDIAN = bigEndian
+        self.UNSOLICITED = unsolicited
+        self.CODEC = AS2805()
+        self.CLOSED = False
+        self.DECLINE_CODE = declineCode
+        self.TARGET = target
+        self.INTERVAL = interval
+        self.METRICS = {'requests': 0, 'responses': 0, 'unsolicited': 0, 'timeouts': 0, 'shed': 0, 'late': 0,
+                        'malformed': 0}
+
+        # CoDel state of the financial queue and the round trip estimate the deadlines are checked with
+        self._DROPPING = False
+        self._FIRST_ABOVE = 0
+        self._DROP_NEXT = 0
+        self._DROP_COUNT = 0
+        self._RTT = 0.0
+
+        self._PENDING = {}
+        self._QUEUES = [collections.deque() for i in range(PRIORITIES)]
+        self._LOCK = threading.Lock()  # guards _PENDING and _QUEUES
+        self._READY = threading.Condition(self._LOCK)
+        self._WRITER = threading.Thread(target=self.__writeLoop, name='AS2805-writer-%s' % sock.fileno())
+        self._WRITER.daemon = True
+        self._WRITER.start()
+        self._READER = threading.Thread(target=self.__readLoop, name='AS2805-reader-%s' % sock.fileno())
+        self._READER.daemon = True
+        self._READER.start()
+
+    ################################################################################################
+
+    def getKey(self, frame):
+        """Method that return the key a request and its response share
+        @param: frame -> network frame, 4 bytes size then the message
+        @return: tuple -> (bit 11, bit 41, bit 7), None for the bits that are not set
+        """
+        message = frame[4:].tobytes() if isinstance(frame, memoryview) else str(frame[4:])
+        values = self.CODEC.decodeFields(message, MATCH_BITS)
+        return values.get(11), values.get(41), values.get(7)
+
+    ################################################################################################
+
+    def send(self, frame, callback=None, priority=None, deadline=None):
+        """Method that queue a request and return without waiting for its response.
+        A financial request may be declined locally, its PendingRequest is then answered with a response
+        with bit 39 = declineCode and Declined set.
+        @param: frame -> network frame, getNetworkISO() or MessageTemplate.getNetworkISO() for instance
+        @param: callback -> function(pending) called once the request is answered or failed
+        @param: priority -> NETWORK_MANAGEMENT, ADVICE or FINANCIAL, from the MTI by default
+        @param: deadline -> seconds from now the response is needed within, None for no deadline
+        @return: PendingRequest
+        @raise: MultiplexError when a request with the same key is in flight, ConnectionClosed
+        """
+        pending = PendingRequest(self.getKey(frame), callback)
+        with self._LOCK:
+            if self.CLOSED:
+                raise ConnectionClosed('The connection is closed')
+            if pending.KEY in self._PENDING:
+                raise MultiplexError('A request with bits 11, 41 and 7 = %s is in flight' % (pending.KEY,))
+            self._PENDING[pending.KEY] = pending
+            self.METRICS['requests'] += 1
+            self.__queue(frame, priority, pending, deadline)
+        return pending
+
+    ################################################################################################
+
+    def request(self, frame, timeout=None):
+        """Method that send a request and wait for its response
+        @return: the response frame, 4 bytes size included
+        @raise: TimeoutError, ConnectionClosed, MultiplexError
+        """
+        pending = self.send(frame, deadline=timeout)
+        try:
+            return pending.wait(timeout)
+        except TimeoutError:
+            self.cancel(pending)
+            raise
+
+    ################################################################################################
+
+    def cancel(self, pending):
+        """Method that stop waiting for the response of a request, a late response goes to the unsolicited callback
+        @return: bool -> False when the request was answered already
+        """
+        with self._LOCK:
+            if self._PENDING.get(pending.KEY) is not pending:
+                return False
+            del self._PENDING[pending.KEY]
+            self.METRICS['timeouts'] += 1
+        return True
+
+    ################################################################################################
+
+    def sendFrame(self, frame, priority=None):
+        """Method that queue a frame no response is expected for, the answer to an unsolicited request for instance
+        @raise: ConnectionClosed
+        """
+        with self._LOCK:
+            if self.CLOSED:
+                raise ConnectionClosed('The connection is closed')
+            self.__queue(frame, priority, None, None)
+
+    ################################################################################################
+
+    def outstanding(self):
+        """Method that return the number of requests in flight"""
+        return len(self._PENDING)
+
+    ################################################################################################
+
+    def queued(self):
+        """Method that return the number of frames waiting to be sent, per priority"""
+        return [len(queue) for queue in self._QUEUES]
+
+    ################################################################################################
+
+    def close(self):
+        """Method that close the connection, the requests in flight fail with ConnectionClosed.
+        From a callback, on the reader or the writer thread, it does not wait: the reader finishes closing
+        once the callback returns.
+        """
+        try:
+            self.SOCKET.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        if threading.currentThread() in (self._READER, self._WRITER):
+            return
+        self._READER.join()
+        self._WRITER.join()
+
+    ################################################################################################
+
+    def __queue(self, frame, priority, pending, deadline):
+        """Method that queue a frame for the writer thread, with the lock held
+        It's a internal method, so don't call!
+        """
+        # the caller may reuse its buffer once this returns
+        frame = frame.tobytes() if isinstance(frame, memoryview) else str(frame)
+        if priority is None:
+            priority = getPriority(frame)
+        now = time.time()
+        self._QUEUES[priority].append((frame, pending, now, None if deadline is None else now + deadline))
+        self._READY.notify()
+
+    ################################################################################################
+
+    def __shed(self, entry, now, backlog):
+        """Method that tell whether a financial request taken out of its queue must be declined, with the lock held
+        It's a internal method, so don't call!
+        """
+        frame, pending, queued, deadline = entry
+        if deadline is not None and now + self._RTT > deadline:
+            self.METRICS['late'] += 1
+            return True
+        if self.TARGET is None:
+            return False
+
+        # CoDel: only a delay that stays above the target for a whole interval is a queue to shed
+        if now - queued < self.TARGET or not backlog:
+            self._FIRST_ABOVE = 0
+            self._DROPPING = False
+            return False
+        if not self._FIRST_ABOVE:
+            self._FIRST_ABOVE = now + self.INTERVAL
+            return False
+
+        if not self._DROPPING:
+            if now < self._FIRST_ABOVE:
+                return False
+            self._DROPPING = True
+            # start again from about where the last dropping state stopped, if it was recent
+            recent = self._DROP_COUNT > 2 and now - self._DROP_NEXT < 16 * self.INTERVAL
+            self._DROP_COUNT = self._DROP_COUNT - 2 if recent else 1
+            self._DROP_NEXT = now + self.INTERVAL / math.sqrt(self._DROP_COUNT)
+        elif now >= self._DROP_NEXT:
+            self._DROP_COUNT += 1
+            self._DROP_NEXT += self.INTERVAL / math.sqrt(self._DROP_COUNT)
+        else:
+            return False
+
+        self.METRICS['shed'] += 1
+        return True
+
+    ################################################################################################
+
+    def __decline(self, frame, pending):
+        """Method that answer a request that is not sent with a response made up locally
+        It's a internal method, so don't call!
+        """
+        pending.Declined = True
+        try:
+            response = str(self.CODEC.deriveResponse(frame, {39: self.DECLINE_CODE}, bigEndian=self.BIG_ENDIAN))
+        except Exception, e:
+            pending.complete(error=MultiplexError('Declined locally, %s' % e))
+            return
+        Trace.info('%s declined locally: %s', pending.KEY, GetISOResponseText(self.DECLINE_CODE))
+        pending.complete(response)
+
+    ################################################################################################
+
+    def __writeLoop(self):
+        """Body of the writer thread, each send takes the queued frames by priority
+        It's a internal method, so don't call!
+        """
+        while True:
+            declined = []
+            with self._LOCK:
+                while not self.CLOSED and not any(self._QUEUES):
+                    self._READY.wait()
+                if self.CLOSED:
+                    return
+                now = time.time()
+                batch = []
+                for priority, queue in enumerate(self._QUEUES):
+                    while queue and len(batch) < _BATCH:
+                        entry = queue.popleft()
+                        frame, pending = entry[:2]
+                        if priority == FINANCIAL and pending is not None and self.__shed(entry, now, queue):
+                            if self._PENDING.get(pending.KEY) is pending:
+                                del self._PENDING[pending.KEY]
+                                declined.append((frame, pending))
+                            continue
+                        if pending is not None:
+                            pending.SENT = now
+                        batch.append(frame)
+
+            for frame, pending in declined:
+                self.__decline(frame, pending)
+            if not batch:
+                continue
+
+            try:
+                self.SOCKET.sendall(''.join(batch))
+            except socket.error, e:
+                # the reader sees the connection go and fails the requests in flight
+                Trace.warning('send failed: %s', e)
+                try:
+                    self.SOCKET.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+                return
+
+    ################################################################################################
+
+    def __readLoop(self):
+        """Body of the reader thread
+        It's a internal method, so don't call!
+        """
+        framer = LengthPrefixFramer(bigEndian=self.BIG_ENDIAN)
+        reason = 'Connection closed by the host'
+        try:
+            while framer.recvFrom(self.SOCKET):
+                for frame in framer.frames():
+                    self.__dispatch(frame.tobytes())
+        except (socket.error, FramingError), e:
+            reason = str(e)
+        finally:
+            with self._LOCK:
+                self.CLOSED = True
+                pending, self._PENDING = self._PENDING.values(), {}
+                for queue in self._QUEUES:
+                    queue.clear()
+                self._READY.notify()
+            # a writer stuck in sendall to a host that stopped reading is woken up by the shutdown
+            try:
+                self.SOCKET.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self._WRITER.join()
+            self.SOCKET.close()
+            for request in pending:
+                request.complete(error=ConnectionClosed(reason))
+
+    ################################################################################################
+
+    def __dispatch(self, frame):
+        """Method that complete the request a frame answers, or hand the frame to the unsolicited callback
+        It's a internal method, so don't call!
+        """
+        pending = None
+        # responses have an odd third MTI digit, 0810 or 0210, requests an even one
+        try:
+            key = self.getKey(frame) if ord(frame[5]) & 0x10 else None
+        except (IndexError, InvalidAS2805, ValueToLarge), e:
+            # the request it answers can't be told, it times out; the link and the other requests go on
+            self.METRICS['malformed'] += 1
+            Trace.warning('malformed frame dropped: %s', e)
+            return
+        if key is not None:
+            with self._LOCK:
+                pending = self._PENDING.pop(key, None)
+
+        if pending is not None:
+            self.METRICS['responses'] += 1
+            if pending.SENT is not None:
+                self._RTT += (time.time() - pending.SENT - self._RTT) / 8
+            pending.complete(frame)
+        else:
+            self.METRICS['unsolicited'] += 1
+            if self.UNSOLICITED:
+                try:
+                    self.UNSOLICITED(self, frame)
+                except Exception:
+                    Trace.exception('unsolicited callback failed')
@@ -0,0 +1,277 @@
+__author__ = 'root'
+
+"""
+            Network management of the links of a HostPool
+
+The timers of a TimingWheel drive every link on their own:
+    - a link that is down is connected and signed on, 0800 bit 70 = 001, again and again with an
+      exponential backoff until the host approves it
+    - a signed on link gets an echo test, 0800 bit 70 = 301, every echo interval; a link whose echo
+      is declined or not answered in time is closed and signed on again
+    - a signed on link gets a key change, 0820 bit 70 = 101, every key change interval, with the
+      bits handed by the keyChange callback
+The echoes and key changes go through the send queues of the links as network management, ahead
+of the financial requests. Sign ons connect and wait, so they run in an AsyncCall thread each.
+
+Example:
+    manager = NetworkManager(pool, echoInterval=60, keyChangeInterval=3600, keyChange=lambda link: {48: kek()})
+    manager.start()
+"""
+
+import logging
+import random
+import threading
+from datetime import datetime
+
+from AS2805 import AS2805, MessageTemplate, InvalidAS2805, ValueToLarge
+from AS2805_HostPool import DOWN, SIGNING_ON, SIGNED_ON
+from AS2805_MultiplexClient import NETWORK_MANAGEMENT, MultiplexError
+from Shared.AsyncCall import AsyncCall
+from Shared.TimingWheel import TimingWheel
+
+
+Trace = logging.getLogger('AS2805.NetworkManager')
+
+
+class _LinkSchedule:
+    """What the manager knows of a link, EPOCH changes with each sign on so older timers are ignored"""
+
+    def __init__(self):
+        self.EPOCH = 0
+        self.FAILURES = 0
+        self.TIMERS = []
+
+
+class NetworkManager:
+    """Sign ons, echo tests and key changes of the links of a HostPool.
+    @param: pool -> the HostPool, whose start() must not be called as well
+    @param: echoInterval -> seconds between two echo tests of a link
+    @param: keyChangeInterval -> seconds between two key changes of a link, None for none
+    @param: keyChange -> function(link) returning the {bit: value} of a key change, 48 and 53 for instance
+    @param: onKeyChange -> function(link, approved, response) called once a key change is answered or failed
+    @param: timeout -> seconds an echo or a key change waits for its response
+    @param: backoff -> (first, longest) seconds between two sign ons of a link
+    @param: wheel -> TimingWheel shared with other timers, one of its own by default
+    """
+
+    _ECHO = MessageTemplate('0800', {70: '301'}, (7, 11))
+
+    def __init__(self, pool, echoInterval=60, keyChangeInterval=None, keyChange=None, onKeyChange=None, timeout=10,
+                 backoff=(1, 60), wheel=None):
+        self.POOL = pool
+        self.ECHO_INTERVAL = echoInterval
+        self.KEY_CHANGE_INTERVAL = keyChangeInterval
+        self.KEY_CHANGE = keyChange
+        self.ON_KEY_CHANGE = onKeyChange
+        self.TIMEOUT = timeout
+        self.BACKOFF = backoff
+        if wheel is None:
+            wheel = TimingWheel(tick=0.1, slots=max(1024, int(max(echoInterval, keyChangeInterval) * 10) + 1))
+        self.WHEEL = wheel
+        self.CODEC = AS2805()
+        self.METRICS = {'echoes': 0, 'echoFailures': 0, 'keyChanges': 0, 'keyChangeFailures': 0, 'signOns': 0,
+                        'signOnFailures': 0}
+
+        self._SCHEDULES = dict([(link, _LinkSchedule()) for link in pool._LINKS])
+        self._LOCK = threading.Lock()
+
+    ################################################################################################
+
+    def start(self):
+        """Method that sign on every link and start the wheel"""
+        for link in self._SCHEDULES:
+            self.__signOn(link, 0)
+        self.WHEEL.start()
+
+    ################################################################################################
+
+    def stop(self):
+        """Method that stop the timers and close the links"""
+        self.WHEEL.stop()
+        with self._LOCK:
+            for schedule in self._SCHEDULES.values():
+                schedule.EPOCH += 1
+        self.POOL.stop()
+
+    ################################################################################################
+
+    def getBackoff(self, failures):
+        """Method that return the seconds to wait before a sign on, after failures sign ons in a row failed"""
+        if not failures:
+            return 0
+        first, longest = self.BACKOFF
+        return min(longest, first * 2 ** (failures - 1)) * random.uniform(0.5, 1.0)
+
+    ################################################################################################
+
+    def __schedule(self, link, epoch, delay, callback, *args):
+        """Method that start a timer of a link, ignored once the link is signed on again
+        It's a internal method, so don't call!
+        """
+        def fire():
+            if self._SCHEDULES[link].EPOCH == epoch:
+                callback(link, epoch, *args)
+        self.WHEEL.schedule(delay, fire)
+
+    ################################################################################################
+
+    def __lost(self, link, epoch, reason):
+        """Method that close a link that failed and sign it on again
+        It's a internal method, so don't call!
+        """
+        with self._LOCK:
+            if self._SCHEDULES[link].EPOCH != epoch:
+                return
+        Trace.warning('%s:%s link %d lost: %s', link.HOST, link.PORT, link.NUMBER, reason)
+        if link.CLIENT is not None:
+            link.CLIENT.close()
+        link.setState(DOWN)
+        self.__signOn(link, epoch)
+
+    ################################################################################################
+
+    def __signOn(self, link, epoch):
+        """Method that start a sign on of a link, after the backoff its failures call for
+        It's a internal method, so don't call!
+        """
+        with self._LOCK:
+            schedule = self._SCHEDULES[link]
+            if schedule.EPOCH != epoch:
+                return
+            schedule.EPOCH += 1
+            epoch = schedule.EPOCH
+            delay = self.getBackoff(schedule.FAILURES)
+
+        link.setState(SIGNING_ON)
+        if delay:
+            self.__schedule(link, epoch, delay, self.__startSignOn)
+        else:
+            self.__startSignOn(link, epoch)
+
+    ################################################################################################
+
+    def __startSignOn(self, link, epoch):
+        """Method that sign on a link from an AsyncCall thread
+        It's a internal method, so don't call!
+        """
+        AsyncCall(self.POOL.signOn, lambda approved: self.__signedOn(link, epoch, approved))(link)
+
+    ################################################################################################
+
+    def __signedOn(self, link, epoch, approved):
+        """Method that schedule the echoes and key changes of a link signed on, or the next sign on
+        It's a internal method, so don't call!
+        """
+        with self._LOCK:
+            schedule = self._SCHEDULES[link]
+            if schedule.EPOCH != epoch:
+                return
+            if approved:
+                schedule.FAILURES = 0
+                self.METRICS['signOns'] += 1
+            else:
+                schedule.FAILURES += 1
+                self.METRICS['signOnFailures'] += 1
+
+        if not approved:
+            self.__signOn(link, epoch)
+            return
+
+        self.__schedule(link, epoch, self.ECHO_INTERVAL, self.__echo)
+        if self.KEY_CHANGE_INTERVAL and self.KEY_CHANGE:
+            self.__schedule(link, epoch, self.KEY_CHANGE_INTERVAL, self.__keyChange)
+
+    ################################################################################################
+
+    def __request(self, link, epoch, frame, answered):
+        """Method that send a network management request on a link, answered(response) is called from the wheel
+        with the response or None when it failed or timed out
+        It's a internal method, so don't call!
+        """
+        if link.STATE != SIGNED_ON or link.CLIENT is None or link.CLIENT.CLOSED:
+            self.__lost(link, epoch, 'link is down')
+            return
+
+        def completed(pending):
+            # called on the reader thread of the client, which answered() may close: hand it to the wheel
+            if timer is not None and self.WHEEL.cancel(timer):
+                self.WHEEL.schedule(0, answered, pending.Result if pending.Error is None else None)
+
+        def timedOut():
+            if link.CLIENT.cancel(pending):
+                answered(None)
+
+        timer = None
+        try:
+            pending = link.CLIENT.send(frame, priority=NETWORK_MANAGEMENT)
+        except MultiplexError, e:
+            self.__lost(link, epoch, e)
+            return
+        timer = self.WHEEL.schedule(self.TIMEOUT, timedOut)
+        pending.Callback = completed
+        if pending.done():
+            completed(pending)
+
+    ################################################################################################
+
+    def __approved(self, link, response):
+        """Method that tell whether a network management response approves its request, a response that
+        does not parse does not
+        It's a internal method, so don't call!
+        """
+        if response is None:
+            return False
+        try:
+            return self.CODEC.decodeFields(response[4:], (39,)).get(39) == '00'
+        except (InvalidAS2805, ValueToLarge), e:
+            Trace.warning('%s:%s link %d malformed response: %s', link.HOST, link.PORT, link.NUMBER, e)
+            return False
+
+    ################################################################################################
+
+    def __echo(self, link, epoch):
+        """Timer callback, the echo test of a link
+        It's a internal method, so don't call!
+        """
+        def answered(response):
+            if self.__approved(link, response):
+                self.METRICS['echoes'] += 1
+                self.__schedule(link, epoch, self.ECHO_INTERVAL, self.__echo)
+            else:
+                self.METRICS['echoFailures'] += 1
+                self.__lost(link, epoch, 'echo test failed')
+
+        values = {7: datetime.utcnow().strftime('%m%d%H%M%S'), 11: self.POOL.nextStan()}
+        self.__request(link, epoch, self._ECHO.getNetworkISO(values, self.POOL.BIG_ENDIAN), answered)
+
+    ################################################################################################
+
+    def __keyChange(self, link, epoch):
+        """Timer callback, the key change of a link
+        It's a internal method, so don't call!
+        """
+        def answered(response):
+            approved = self.__approved(link, response)
+            self.__schedule(link, epoch, self.KEY_CHANGE_INTERVAL, self.__keyChange)
+            if self.ON_KEY_CHANGE:
+                try:
+                    self.ON_KEY_CHANGE(link, approved, response)
+                except Exception:
+                    # the new keys may not be in use, the exchange counts as failed and the next one is due as usual
+                    Trace.exception('%s:%s link %d key change callback failed', link.HOST, link.PORT, link.NUMBER)
+                    approved = False
+            self.METRICS['keyChanges' if approved else 'keyChangeFailures'] += 1
+
+        iso = AS2805()
+        iso.setMTI('0820')
+        iso.setBit(7, datetime.utcnow().strftime('%m%d%H%M%S'))
+        iso.setBit(11, self.POOL.nextStan())
+        iso.setBit(70, '101')
+        try:
+            for bit, value in self.KEY_CHANGE(link).items():
+                iso.setBit(bit, value)
+        except Exception:
+            Trace.exception('%s:%s link %d key change failed', link.HOST, link.PORT, link.NUMBER)
+            answered(None)
+            return
+        self.__request(link, epoch, iso.getNetworkISO(self.POOL.BIG_ENDIAN), answered)
@@ -0,0 +1,145 @@
+__author__ = 'root'
+
+"""
+            Timeouts of the financial requests and their reversal advices
+
+Every 0100 or 0200 sent is tracked by a timer of a TimingWheel, found again by the bits 11, 41 and
+7 its response echoes. When no response comes in time, the 0420 reversal advice of the request is
+built with AS2805.deriveReversal() and handed to the onReversal callback, to be sent or stored and
+forwarded.
+
+Example:
+    reversals = ReversalTimer(lambda advice, request: pool.request(advice), timeout=30, stan=pool.nextStan)
+    reversals.start()
+    key = reversals.track(request)
+    client.send(request, lambda pending: pending.Error is None and reversals.answered(key))
+"""
+
+import logging
+import threading
+from datetime import datetime
+
+from AS2805 import AS2805
+from AS2805_MultiplexClient import MATCH_BITS
+from Shared.TimingWheel import TimingWheel
+
+
+Trace = logging.getLogger('AS2805.Reversals')
+
+
+class ReversalTimer:
+    """Reversal advices of the requests that are not answered in time.
+    @param: onReversal -> function(advice, request) called from the wheel when a request times out
+    @param: timeout -> seconds a request waits for its response
+    @param: wheel -> TimingWheel shared with other timers, one covering the timeout by default
+    @param: stan -> function returning the STAN of the next advice, a counter of its own by default
+    @param: mti -> MTI of the advices
+    @param: bigEndian (True|False) -> how the size header of the frames is represented
+    """
+
+    def __init__(self, onReversal, timeout=30, wheel=None, stan=None, mti='0420', bigEndian=True):
+        self.ON_REVERSAL = onReversal
+        self.TIMEOUT = timeout
+        if wheel is None:
+            wheel = TimingWheel(tick=0.01, slots=max(1024, int(timeout * 100) + 1))
+        self.WHEEL = wheel
+        self.MTI = mti
+        self.BIG_ENDIAN = bigEndian
+        self.CODEC = AS2805()
+        self.METRICS = {'tracked': 0, 'answered': 0, 'reversed': 0}
+
+        self._TIMERS = {}
+        self._STAN = 0
+        self._NEXT_STAN = stan or self.__nextStan
+        self._LOCK = threading.Lock()
+
+    ################################################################################################
+
+    def getKey(self, frame):
+        """Method that return the key a request and its response share, as MultiplexedClient.getKey()"""
+        values = self.CODEC.decodeFields(str(frame[4:]), MATCH_BITS)
+        return values.get(11), values.get(41), values.get(7)
+
+    ################################################################################################
+
+    def track(self, frame, key=None, timeout=None):
+        """Method that start the timer of a request that was sent
+        @param: frame -> network frame of the request, str or bytearray
+        @param: key -> getKey() of the request, when known already
+        @param: timeout -> seconds, TIMEOUT by default
+        @return: the key of the request, for answered()
+        """
+        if key is None:
+            key = self.getKey(frame)
+        frame = str(frame)
+        # the timer fires with its own token, a timer replaced by a later track() of the key must not act
+        token = object()
+        timer = self.WHEEL.schedule(self.TIMEOUT if timeout is None else timeout, self.__expire, key, frame, token)
+        with self._LOCK:
+            previous = self._TIMERS.get(key)
+            self._TIMERS[key] = (timer, token)
+            self.METRICS['tracked'] += 1
+        if previous is not None:
+            self.WHEEL.cancel(previous[0])
+        return key
+
+    ################################################################################################
+
+    def answered(self, key):
+        """Method that stop the timer of a request once its response came
+        @param: key -> the key track() returned, or getKey() of the response
+        @return: bool -> False when the request timed out already or is not tracked
+        """
+        with self._LOCK:
+            entry = self._TIMERS.pop(key, None)
+        if entry is None or not self.WHEEL.cancel(entry[0]):
+            return False
+        self.METRICS['answered'] += 1
+        return True
+
+    ################################################################################################
+
+    def outstanding(self):
+        """Method that return the number of requests waiting for their response"""
+        return len(self._TIMERS)
+
+    ################################################################################################
+
+    def start(self):
+        """Method that advance the wheel from a thread"""
+        self.WHEEL.start()
+
+    ################################################################################################
+
+    def stop(self):
+        self.WHEEL.stop()
+
+    ################################################################################################
+
+    def __nextStan(self):
+        """Default STAN of the advices
+        It's a internal method, so don't call!
+        """
+        with self._LOCK:
+            self._STAN = self._STAN % 999999 + 1
+            return '%06d' % self._STAN
+
+    ################################################################################################
+
+    def __expire(self, key, frame, token):
+        """Timer callback, the request was not answered in time
+        It's a internal method, so don't call!
+        """
+        with self._LOCK:
+            entry = self._TIMERS.get(key)
+            if entry is None or entry[1] is not token:
+                return
+            del self._TIMERS[key]
+            self.METRICS['reversed'] += 1
+
+        try:
+            advice = self.CODEC.deriveReversal(frame, self._NEXT_STAN(), datetime.utcnow().strftime('%m%d%H%M%S'),
+                                               self.MTI, bigEndian=self.BIG_ENDIAN)
+            self.ON_REVERSAL(advice, frame)
+        except Exception:
+            Trace.exception('reversal of %s failed', key)
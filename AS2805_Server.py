@@ -1,7 +1,8 @@
 from socket import *
 
-from AS2805 import AS2805
+from AS2805 import MessagePool
 from AS2805Errors import *
+from Shared.Framer import LengthPrefixFramer, FramingError
 
 
 # Configure the server
@@ -12,6 +13,10 @@ bigEndian = True
 #bigEndian = False
 
 
+# Packages are reused from one frame to the next
+pool = MessagePool()
+
+
 # Create a TCP socket
 s = socket(AF_INET, SOCK_STREAM)
 # bind it to the server port
@@ -20,55 +25,67 @@ s.bind((serverIP, serverPort))
 s.listen(maxConn)
 
 
-# Run forever
-while 1:
-    #wait new Client Connection
-    connection, address = s.accept()
-    while 1:
-        # receive message
-        isoStr = connection.recv(2048)
-        if isoStr:
-            print "\nInput ASCII |%s|" % isoStr
-            pack = AS2805()
-            #parse the iso
-            try:
-                if bigEndian:
-                    pack.setNetworkISO(isoStr)
-                else:
-                    pack.setNetworkISO(isoStr, False)
-
-                v1 = pack.getBitsAndValues()
-                for v in v1:
-                    print 'Bit %s of type %s with value = %s' % (v['bit'], v['type'], v['value'])
-
-                if pack.getMTI() == '0800':
-                    print "\tThat's great !!! The client send a correct message !!!"
-                else:
-                    print "The client dosen't send the correct message!"
-                    break
+def answer(connection, isoStr, sendBuffer):
+    """Parse one request frame and send its answer
+    @return: False when the connection must be closed
+    """
+    print "\nInput ASCII |%s|" % isoStr
+    pack = pool.acquire()
+    try:
+        #parse the iso
+        try:
+            if bigEndian:
+                pack.setNetworkISO(isoStr)
+            else:
+                pack.setNetworkISO(isoStr, False)
 
+            v1 = pack.getBitsAndValues()
+            for v in v1:
+                print 'Bit %s of type %s with value = %s' % (v['bit'], v['type'], v['value'])
 
-            except InvalidAS2805, ii:
-                print ii
-                break
-            except:
-                print 'Error Occured'
-                break
+            if pack.getMTI() == '0800':
+                print "\tThat's great !!! The client send a correct message !!!"
+            else:
+                print "The client dosen't send the correct message!"
+                return False
 
-            #send answer
-            pack.setMTI('0810')
-            pack.setBit(39, '00')  # Successful
-            if bigEndian:
-                ans = pack.getNetworkISO()
 
-            else:
-                ans = pack.getNetworkISO(False)
+        except InvalidAS2805, ii:
+            print ii
+            return False
+        except:
+            print 'Error Occured'
+            return False
+
+        #send answer, the request patched into an 0810
+        sendBuffer[:] = isoStr
+        ans = pack.deriveResponse(sendBuffer, {39: '00'}, bigEndian=bigEndian)  # Successful
 
-            print 'Sending answer %s' % ans
-            connection.send(ans)
+        print 'Sending answer %s' % ans
+        connection.send(ans)
+        return True
+    finally:
+        pool.release(pack)
 
-        else:
-            break
-        # close socket          
+
+# Run forever
+while 1:
+    #wait new Client Connection
+    connection, address = s.accept()
+    # one send buffer per connection, each answer is the request copied into it and patched there
+    sendBuffer = bytearray()
+    # TCP may deliver part of a frame or several frames at once
+    framer = LengthPrefixFramer(bigEndian=bigEndian)
+    keepOpen = True
+    try:
+        # receive messages
+        while keepOpen and framer.recvFrom(connection):
+            for frame in framer.frames():
+                keepOpen = answer(connection, frame.tobytes(), sendBuffer)
+                if not keepOpen:
+                    break
+    except FramingError, fe:
+        print fe
+    # close socket
     connection.close()
-    print "Closing..."
\ No newline at end of file
+    print "Closing..."
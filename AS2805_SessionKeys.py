@@ -0,0 +1,297 @@
+__author__ = 'root'
+
+"""
+            Session keys of a host link, with atomic rollover
+
+The MAC, PIN and data keys of a link come in generations. A key change (0820 bit 48, or bit 125 of
+a PostBridge 0810) stages the next generation as pending, its check values are verified, and once
+the host approves it the pending generation replaces the current one in a single assignment. The
+generation before stays usable for a grace window, so late responses MAC'd with it still verify,
+then its ciphers are dropped from the CipherCache.
+
+Readers never take the lock: current(), getKey() and lookup() read one attribute, a tuple that the
+writers replace as a whole. A request keeps the KeySet it was sent with, so its response is checked
+with the keys of that generation while it is current or in its grace window.
+
+Example, with NetworkManager:
+    keys = SessionKeyStore('host-1', grace=30)
+
+    def keyChange(link):
+        keys.stage({MAC: zak, PIN: zpk})
+        return {48: wrap(zak) + wrap(zpk), 53: '0000000000000002'}
+
+    def onKeyChange(link, approved, response):
+        if approved:
+            checks = codec.decodeFields(response[4:], (48,))[48]
+            keys.activate({MAC: checks[:6], PIN: checks[6:12]})
+        else:
+            keys.discard()
+
+and when it is the host that changes the keys, with an 0820 of its own:
+    checks = keys.acceptKeyChange(HexToByte(codec.decodeFields(frame[4:], (48,))[48]), kek)
+    client.sendFrame(codec.deriveResponse(frame, {39: '00', 48: checks}))
+"""
+
+import binascii
+import logging
+import threading
+import time
+
+from AS2805 import AS2805, InvalidMAC
+from Crypto.Cipher import DES3
+from Shared.CipherCache import Ciphers
+
+
+Trace = logging.getLogger('AS2805.SessionKeys')
+
+# kinds of session keys
+MAC = 'MAC'
+PIN = 'PIN'
+DATA = 'DATA'
+
+
+class KeyCheckError(Exception):
+    """The check value of a key does not match it"""
+
+
+def getCheckValue(key, digits=6):
+    """Return the key check value of a clear key: the left digits of the DES3 encryption of zeros, in hex"""
+    return binascii.hexlify(DES3.new(key, DES3.MODE_ECB).encrypt('\0' * 8))[:digits].upper()
+
+
+class KeySet(object):
+    """The keys of one generation, never changed once built
+    @param: generation -> number of the generation, 0 before the first key change
+    @param: keys -> {kind: KeyHandle}
+    """
+    __slots__ = ('GENERATION', 'KEYS')
+
+    def __init__(self, generation, keys):
+        self.GENERATION = generation
+        self.KEYS = keys
+
+    def getKey(self, kind):
+        """Return the KeyHandle of a kind, None when this generation has none"""
+        return self.KEYS.get(kind)
+
+
+class SessionKeyStore:
+    """Current, pending and previous session keys of one host link.
+    @param: name -> name of the link, the keys are registered in the cache as name/generation/kind
+    @param: grace -> seconds the previous generation stays usable after a rollover
+    @param: keys -> {kind: clear key} of the first generation, none by default
+    @param: cache -> the CipherCache the keys are registered in
+    @param: wheel -> TimingWheel dropping the previous generation once its grace is over, when given;
+            otherwise it is dropped by expire() or the next rollover
+    @param: clock -> function returning the time in seconds
+    """
+
+    def __init__(self, name, grace=30, keys=None, cache=Ciphers, wheel=None, clock=time.time):
+        self.NAME = name
+        self.GRACE = grace
+        self.CACHE = cache
+        self.WHEEL = wheel
+        self.CLOCK = clock
+        self.METRICS = {'rollovers': 0, 'discarded': 0, 'checkFailures': 0, 'graceHits': 0}
+
+        # (current, previous, time the previous one was retired), replaced as a whole
+        self._STATE = (self.__build(0, keys or {}), None, None)
+        self._PENDING = None
+        self._LOCK = threading.Lock()
+
+    ################################################################################################
+
+    def current(self):
+        """Method that return the current KeySet, to be kept with a request for its response"""
+        return self._STATE[0]
+
+    ################################################################################################
+
+    def getKey(self, kind):
+        """Method that return the current KeyHandle of a kind, None when there is none"""
+        return self._STATE[0].KEYS.get(kind)
+
+    ################################################################################################
+
+    def lookup(self, generation, kind):
+        """Method that return the KeyHandle of a kind of a generation, the current one or the previous one
+        while its grace lasts, None otherwise
+        """
+        current, previous, retired = self._STATE
+        if current.GENERATION == generation:
+            return current.KEYS.get(kind)
+        if previous is not None and previous.GENERATION == generation and self.CLOCK() - retired <= self.GRACE:
+            return previous.KEYS.get(kind)
+        return None
+
+    ################################################################################################
+
+    def getPending(self):
+        """Method that return the KeySet staged and not active yet, None when there is none"""
+        return self._PENDING
+
+    ################################################################################################
+
+    def stage(self, keys, checks=None, kek=None):
+        """Method that stage the next generation, active once activate() is called
+        @param: keys -> {kind: key}, 16 or 24 bytes each
+        @param: checks -> {kind: check value in hex} to verify now, the host may send them later instead
+        @param: kek -> key encrypting the keys (DES3 ECB) as they came in the key change, None when clear
+        @return: the pending KeySet
+        @raise: KeyCheckError
+        """
+        if kek is not None:
+            cipher = DES3.new(kek, DES3.MODE_ECB)
+            keys = dict([(kind, cipher.decrypt(key)) for kind, key in keys.items()])
+        self.__check(keys, checks)
+
+        with self._LOCK:
+            generation = max(self._STATE[0].GENERATION, self._PENDING.GENERATION if self._PENDING else 0) + 1
+            pending = self._PENDING = self.__build(generation, keys)
+        Trace.info('%s generation %d staged', self.NAME, generation)
+        return pending
+
+    ################################################################################################
+
+    def activate(self, checks=None):
+        """Method that make the pending generation the current one, the current one becomes the previous one
+        @param: checks -> {kind: check value in hex} the host returned, verified before the swap
+        @return: the new current KeySet
+        @raise: KeyCheckError, the pending generation is discarded; ValueError when nothing is staged
+        """
+        with self._LOCK:
+            pending = self._PENDING
+            if pending is None:
+                raise ValueError('%s has no keys staged' % self.NAME)
+            self._PENDING = None
+            try:
+                self.__check(dict([(kind, handle.KEY) for kind, handle in pending.KEYS.items()]), checks)
+            except KeyCheckError:
+                self.__drop(pending)
+                raise
+
+            current, previous, retired = self._STATE
+            self._STATE = (pending, current, self.CLOCK())
+            self.METRICS['rollovers'] += 1
+
+        if previous is not None:
+            self.__drop(previous)
+        if self.WHEEL is not None:
+            self.WHEEL.schedule(self.GRACE, self.__expire, current)
+        Trace.info('%s generation %d active', self.NAME, pending.GENERATION)
+        return pending
+
+    ################################################################################################
+
+    def acceptKeyChange(self, keys, kek=None):
+        """Method that make the keys of a key change the host sent current, bit 48 of its 0820
+        @param: keys -> bit 48 as bytes, the MAC key then the PIN key, 16 bytes each
+        @param: kek -> key encrypting them (DES3 ECB), None when they come in the clear
+        @return: the check values of the new keys in hex, MAC then PIN, bit 48 of the 0830
+        @raise: ValueError when bit 48 does not hold two keys
+        """
+        if len(keys) != 32:
+            raise ValueError('%s key change holds %d bytes, not two keys of 16' % (self.NAME, len(keys)))
+        pending = self.stage({MAC: keys[:16], PIN: keys[16:]}, kek=kek)
+        self.activate()
+        return getCheckValue(pending.KEYS[MAC].KEY) + getCheckValue(pending.KEYS[PIN].KEY)
+
+    ################################################################################################
+
+    def discard(self):
+        """Method that drop the pending generation, when the host declines the key change"""
+        with self._LOCK:
+            pending = self._PENDING
+            self._PENDING = None
+        if pending is not None:
+            self.METRICS['discarded'] += 1
+            self.__drop(pending)
+
+    ################################################################################################
+
+    def expire(self):
+        """Method that drop the previous generation once its grace is over
+        @return: bool -> True when it was dropped
+        """
+        with self._LOCK:
+            current, previous, retired = self._STATE
+            if previous is None or self.CLOCK() - retired < self.GRACE:
+                return False
+            self._STATE = (current, None, None)
+        self.__drop(previous)
+        return True
+
+    ################################################################################################
+
+    def verifyMAC(self, frame, keySet=None):
+        """Method that check the MAC of a received frame with the current keys, then with the previous ones
+        while their grace lasts
+        @param: frame -> network frame, as AS2805.setNetworkISO() takes it
+        @param: keySet -> the KeySet the request was sent with, tried first while it is current or in its grace
+        @return: the generation whose MAC key matched
+        @raise: InvalidMAC
+        """
+        current, previous, retired = self._STATE
+        candidates = [current]
+        if previous is not None and self.CLOCK() - retired <= self.GRACE:
+            candidates.append(previous)
+            if keySet is previous:
+                candidates.reverse()
+
+        for candidate in candidates:
+            key = candidate.KEYS.get(MAC)
+            if key is None:
+                continue
+            try:
+                AS2805(lazy=True).setNetworkISO(frame, macKey=key)
+            except InvalidMAC:
+                continue
+            if candidate is previous:
+                self.METRICS['graceHits'] += 1
+            return candidate.GENERATION
+        raise InvalidMAC('No MAC key of %s matches the message!' % self.NAME)
+
+    ################################################################################################
+
+    def __expire(self, keySet):
+        """Method the wheel calls once the grace of keySet should be over, called again for the time left
+        when it fires early, until keySet is dropped or is no longer the previous generation
+        It's a internal method, so don't call!
+        """
+        if self.expire():
+            return
+        current, previous, retired = self._STATE
+        if previous is keySet:
+            self.WHEEL.schedule(max(0, self.GRACE - (self.CLOCK() - retired)), self.__expire, keySet)
+
+    ################################################################################################
+
+    def __build(self, generation, keys):
+        """Method that register the keys of a generation in the cache
+        It's a internal method, so don't call!
+        """
+        return KeySet(generation, dict([(kind, self.CACHE.register('%s/%d/%s' % (self.NAME, generation, kind), key))
+                                        for kind, key in keys.items()]))
+
+    ################################################################################################
+
+    def __drop(self, keySet):
+        """Method that drop the ciphers of the keys of a generation from the cache
+        It's a internal method, so don't call!
+        """
+        for handle in keySet.KEYS.values():
+            self.CACHE.invalidate(handle.ID)
+
+    ################################################################################################
+
+    def __check(self, keys, checks):
+        """Method that verify the check values of keys
+        It's a internal method, so don't call!
+        @raise: KeyCheckError
+        """
+        for kind, check in (checks or {}).items():
+            if kind not in keys:
+                raise KeyCheckError('%s has no %s key to check' % (self.NAME, kind))
+            if getCheckValue(keys[kind], len(check)) != check.upper():
+                self.METRICS['checkFailures'] += 1
+                raise KeyCheckError('%s %s key does not match its check value %s' % (self.NAME, kind, check))
@@ -1,7 +1,32 @@
 __author__ = 'root'
 import unittest
-from AS2805 import AS2805
+import socket
+import struct
+import threading
+import os
+import signal
+import time
+from Crypto.Cipher import DES3
+from AS2805 import InvalidMAC, AS2805, CompactAS2805, MessagePool, MessageTemplate, ShapePlanCache, ValueToLarge, BitInexistent, BitNotSet, \
+    InvalidAS2805
 from Shared.ByteUtils import ByteToHex, HexToByte
+from Shared.Framer import LengthPrefixFramer, FramingError
+from AS2805_HostServer import AS2805HostServer, HostServerCluster, answerNetworkManagement
+from AS2805_MultiplexClient import MultiplexedClient, ConnectionClosed, MultiplexError, getPriority, \
+    NETWORK_MANAGEMENT, ADVICE, FINANCIAL
+from AS2805_HostPool import HostPool, NoLinkAvailable, SIGNED_ON, DOWN
+from AS2805_Reversals import ReversalTimer
+from AS2805_NetworkManager import NetworkManager
+from AS2805_MACVerifier import MACVerifierPool
+from AS2805_SessionKeys import SessionKeyStore, KeyCheckError, getCheckValue, MAC, PIN
+from Shared.TimingWheel import TimingWheel
+from Shared.MAC import DESMAC, DES3MAC, RetailMAC, FullMAC, ToHex, EncryptPINBlock, DecryptPINBlock
+from Shared.CipherCache import CipherCache, Ciphers, KeyHandle, RETAIL, FULL
+
+
+def networkFrame(message):
+    """Return a binary message with its big-endian size first, as setNetworkISO() takes it"""
+    return struct.pack('!I', len(message)) + message
 
 
 """
@@ -44,11 +69,19 @@ class Default_0820TestCaseUnPack(AS2805_0820_TestCases):
         print "Switch 0830 Test"
 
         iso_resp = AS2805(debug=False)
-        iso_resp.setNetworkISO(HexToByte('ffffffff' + self.Host_Request))
+        iso_resp.setNetworkISO(networkFrame(HexToByte(self.Host_Request)))
         host_iso = iso_resp.getNetworkISO()
 
         self.assertEqual(host_iso[4:].encode('hex'), self.Host_Request, 'Message is not a Match')
 
+        # the size header must be the length of the message, in the byte order given
+        message = HexToByte(self.Host_Request)
+        self.assertRaises(InvalidAS2805, AS2805().setNetworkISO, HexToByte('ffffffff') + message)
+        self.assertRaises(InvalidAS2805, AS2805().setNetworkISO, networkFrame(message)[:-1])
+        self.assertRaises(InvalidAS2805, AS2805().setNetworkISO, networkFrame(message), False)
+        AS2805().setNetworkISO(struct.pack('<I', len(message)) + message, False)
+        self.assertRaises(InvalidAS2805, CompactAS2805().setNetworkISO, HexToByte('ffffffff') + message)
+
 
 class Default_0830UnTestCasePack(AS2805_0820_TestCases):
     def runTest(self):
@@ -77,12 +110,57 @@ class Default_0830UnTestCaseUnPack(AS2805_0820_TestCases):
         print "Switch 0830 Test"
 
         iso_resp = AS2805(debug=False)
-        iso_resp.setNetworkISO(HexToByte('ffffffff' + self.Host_Response))
+        iso_resp.setNetworkISO(networkFrame(HexToByte(self.Host_Response)))
         host_iso = iso_resp.getNetworkISO()
 
         self.assertEqual(host_iso[4:].encode('hex'), self.Host_Response, 'Message is not a Match')
 
 
+class Default_0820RawIsoTestCase(AS2805_0820_TestCases):
+    def runTest(self):
+
+        print "Switch 0820 Raw Test"
+
+        iso_resp = AS2805(debug=False)
+        iso_resp.setIsoContent(self.Switch_Request)
+        self.assertEqual(iso_resp.getRawIso(), self.Switch_Request, 'Message is not a Match')
+        self.assertEqual(iso_resp.getBit(48), '0F5E4728EDE11727AD5DF16ADD5074D820FE8223FD250762E55FAEBB715EF682', 'Bit 48 is not a Match')
+
+        iso_resp = AS2805(debug=False)
+        iso_resp.setNetworkISO(networkFrame(HexToByte(self.Host_Response)))
+        self.assertEqual(iso_resp.getRawIso(), self.Host_Response, 'Message is not a Match')
+
+
+class Default_0820LazyTestCase(AS2805_0820_TestCases):
+    def runTest(self):
+
+        print "Switch 0820 Lazy Test"
+
+        iso_resp = AS2805(debug=False, lazy=True)
+        iso_resp.setNetworkISO(networkFrame(HexToByte(self.Host_Request)))
+        self.assertEqual(iso_resp.getValuesArray()[48] != 0, True, 'Bit 48 is not sliced out')
+
+        iso_resp = AS2805(debug=False, lazy=True)
+        iso_resp.setNetworkISO(networkFrame(HexToByte(self.Host_Request)))
+        self.assertEqual(iso_resp.getBit(11), '008440', 'Bit 11 is not a Match')
+        self.assertEqual(iso_resp._VALUES[48], 0, 'Bit 48 was decoded before it was read')
+        self.assertEqual(iso_resp.getNetworkISO()[4:].encode('hex'), self.Host_Request, 'Message is not a Match')
+
+        iso_resp.setBit(11, '000361')
+        iso_resp.setMTI('0830')
+        self.assertEqual(iso_resp.getBit(100), '579944', 'Bit 100 is not a Match')
+        self.assertEqual(iso_resp.getRawIso(), '0830' + self.Host_Request[4:46] + '000361' + self.Host_Request[52:], 'Message is not a Match')
+
+        # the bits walked past on the way to a later one are not copied either
+        iso_resp = AS2805(debug=False, lazy=True)
+        iso_resp.setNetworkISO(networkFrame(HexToByte(self.Host_Request)))
+        self.assertEqual(iso_resp.getBit(100), '579944', 'Bit 100 is not a Match')
+        self.assertEqual([iso_resp._VALUES[bit] for bit in (7, 11, 48, 53)], [0] * 4, 'Bits walked past are decoded')
+        self.assertEqual(iso_resp.getBit(48), self.Host_Request[68:132].upper(), 'Bit 48 is not a Match')
+        self.assertEqual(iso_resp.getBit(11), '008440', 'Bit 11 is not a Match')
+        self.assertEqual(iso_resp.getNetworkISO()[4:].encode('hex'), self.Host_Request, 'Message is not a Match')
+
+
 class AS2805_0800_TestCases(unittest.TestCase):
     def setUp(self):
 
@@ -100,14 +178,14 @@ class Default_0810UTestCaseUnPack(AS2805_0800_TestCases):
 
         print "Switch 0810 Test"
         iso_resp = AS2805(debug=False)
-        iso_resp.setNetworkISO(HexToByte('ffffffff' + self.Host_Response))
+        iso_resp.setNetworkISO(networkFrame(HexToByte(self.Host_Response)))
         host_iso = iso_resp.getNetworkISO()
 
         self.assertEqual(host_iso[4:].encode('hex'), self.Host_Response, 'Message is not a Match')
 
         print "Switch 0810 Test"
         iso_resp = AS2805(debug=False)
-        iso_resp.setNetworkISO(HexToByte('ffffffff' + self.Switch_Response))
+        iso_resp.setNetworkISO(networkFrame(HexToByte(self.Switch_Response)))
         host_iso = iso_resp.getNetworkISO()
 
         self.assertEqual(host_iso[4:].encode('hex'), self.Switch_Response, 'Message is not a Match')
@@ -190,18 +268,226 @@ class Default_0200PackTestCase(AS2805_0200_TestCases):
         self.assertEqual(host_iso[4:].encode('hex'), self.Switch_Request, 'Message is not a Match')
 
 
+class Default_0200CompactTestCase(AS2805_0200_TestCases):
+    def runTest(self):
+
+        print "Switch 0200 Compact Test"
+
+        iso = AS2805()
+        iso.setIsoContent(self.Switch_Request)
+
+        compact = CompactAS2805()
+        compact.setMTI('0200')
+        bits = iso.getBitsAndValues()
+        for v in reversed(bits):
+            compact.setBit(int(v['bit']), v['value'])
+        self.assertEqual(compact.getRawIso(), self.Switch_Request, 'Message is not a Match')
+        self.assertEqual(compact.getBitsAndValues(), bits, 'Bits are not a Match')
+        self.assertEqual(compact.getBit(35), iso.getBit(35), 'Bit 35 is not a Match')
+        self.assertEqual(hasattr(compact, '__dict__'), False, 'Package has a __dict__')
+
+        compact.setBit(35, '5188680100002932')
+        compact.setBit(100, '61100016')
+        iso.setBit(35, '5188680100002932')
+        iso.setBit(100, '61100016')
+        self.assertEqual(compact.getNetworkISO(), iso.getNetworkISO(), 'Message is not a Match')
+        self.assertEqual(compact.getBitmap(), iso.getBitmap(), 'Bitmap is not a Match')
+
+        compact = CompactAS2805()
+        compact.setNetworkISO(networkFrame(HexToByte(self.Host_Response)))
+        self.assertEqual(compact.getMTI(), '0210', 'MTI is not a Match')
+        self.assertEqual(compact.getBit(39), '00', 'Bit 39 is not a Match')
+        self.assertRaises(BitNotSet, compact.getBit, 2)
+
+
+class Default_0200TemplateTestCase(AS2805_0200_TestCases):
+    def runTest(self):
+
+        print "Switch 0200 Template Test"
+
+        iso = AS2805()
+        iso.setIsoContent(self.Switch_Request)
+        values = dict([(int(v['bit']), v['value']) for v in iso.getBitsAndValues()])
+
+        variables = (4, 7, 11, 12, 13, 15, 35, 37, 52, 64)
+        constants = dict([(bit, value) for bit, value in values.items() if bit not in variables])
+        template = MessageTemplate('0200', constants, variables)
+        self.assertEqual(template.getRawIso(values), self.Switch_Request, 'Message is not a Match')
+        self.assertEqual(template.getNetworkISO(values, False), iso.getNetworkISO(False), 'Message is not a Match')
+
+        values[4] = '000000012345'
+        values[35] = '5188680100002932D1512'
+        iso.setBit(4, values[4])
+        iso.setBit(35, values[35])
+        self.assertEqual(template.getNetworkISO(values), iso.getNetworkISO(), 'Message is not a Match')
+
+        login = AS2805()
+        login.setMTI('0800')
+        login.setBit(7, '0218070354')
+        login.setBit(11, '000001')
+        login.setBit(12, '070354')
+        login.setBit(13, '0218')
+        login.setBit(70, '001')
+        template = MessageTemplate('0800', {70: '001'}, (7, 11, 12, 13))
+        self.assertEqual(template.getNetworkISO({7: '0218070354', 11: '000001', 12: '070354', 13: '0218'}),
+                         login.getNetworkISO(), 'Message is not a Match')
+
+        del values[11]
+        self.assertRaises(BitNotSet, template.getNetworkISO, values)
+        self.assertRaises(BitInexistent, MessageTemplate, '0200', {56: '1'}, ())
+
+
+class Default_0210DeriveTestCase(AS2805_0200_TestCases):
+    def runTest(self):
+
+        print "Switch 0210 Derive Test"
+
+        frame = networkFrame(HexToByte(self.Switch_Request))
+        iso = AS2805()
+        iso.setNetworkISO(frame)
+        iso.setMTI('0210')
+        iso.setBit(38, '123456')
+        iso.setBit(39, '00')
+        iso.setBit(44, '1')
+        iso.setBit(100, '61100016')
+        response = AS2805().deriveResponse(frame, {38: '123456', 39: '00', 44: '1', 100: '61100016'})
+        self.assertEqual(str(response), iso.getNetworkISO(), 'Response is not a Match')
+
+        iso = AS2805()
+        iso.setMTI('0210')
+        for v in AS2805(self.Switch_Request).getBitsAndValues():
+            if v['bit'] not in ('35', '52'):
+                iso.setBit(int(v['bit']), v['value'])
+        iso.setBit(39, '05')
+        self.assertEqual(str(AS2805().deriveResponse(frame, {39: '05'}, remove=(35, 52, 100))),
+                         iso.getNetworkISO(), 'Response is not a Match')
+
+        request = bytearray(frame)
+        response = AS2805().deriveResponse(request, {39: '00'}, mti='0210', bigEndian=False)
+        self.assertEqual(response is request, True, 'Frame is not patched in place')
+        self.assertEqual(str(response[4:6]), HexToByte('0210'), 'MTI is not a Match')
+
+
+class Default_0200EncodeIntoTestCase(AS2805_0200_TestCases):
+    def runTest(self):
+
+        print "Switch 0200 Encode Into Test"
+
+        iso = AS2805()
+        iso.setIsoContent(self.Switch_Request)
+        frame = iso.getNetworkISO(False)
+
+        buf = bytearray(1024)
+        size = iso.encodeInto(buf, 10, False)
+        self.assertEqual(size, len(frame), 'Size is not a Match')
+        self.assertEqual(str(buf[10:10 + size]), frame, 'Message is not a Match')
+        self.assertEqual(len(buf), 1024, 'Buffer was resized')
+
+        view = memoryview(buf)
+        size = iso.encodeInto(view[100:], 0)
+        self.assertEqual(str(buf[100:100 + size]), iso.getNetworkISO(), 'Message is not a Match')
+
+        values = dict([(int(v['bit']), v['value']) for v in iso.getBitsAndValues()])
+        template = MessageTemplate('0200', {}, values.keys())
+        self.assertEqual(template.encodeInto(values, buf), size, 'Size is not a Match')
+        self.assertEqual(str(buf[:size]), iso.getNetworkISO(), 'Message is not a Match')
+
+        self.assertRaises(ValueToLarge, iso.encodeInto, bytearray(size - 1))
+
+
 class Default_0210UnPackTestCase(AS2805_0200_TestCases):
     def runTest(self):
 
         print "Switch 0810 Test"
 
         iso_resp = AS2805(debug=False)
-        iso_resp.setNetworkISO(HexToByte('ffffffff' + self.Host_Response))
+        iso_resp.setNetworkISO(networkFrame(HexToByte(self.Host_Response)))
         host_iso = iso_resp.getNetworkISO()
 
         self.assertEqual(host_iso[4:].encode('hex'), self.Host_Response, 'Message is not a Match')
 
 
+class Default_0200DecodeFieldsTestCase(AS2805_0200_TestCases):
+    def runTest(self):
+
+        print "Switch 0200 Decode Fields Test"
+
+        frame = HexToByte(self.Switch_Request)
+        iso_resp = AS2805(debug=False)
+        fields = iso_resp.decodeFields(frame, (2, 4, 11, 41))
+        self.assertEqual(fields, {4: '000000002000', 11: '000506', 41: 'S9218163'}, 'Fields are not a Match')
+
+        iso_resp.setIsoContent(self.Switch_Request)
+        for bit, value in iso_resp.decodeFields(frame, (3, 35, 64)).items():
+            self.assertEqual(value, iso_resp.getBit(bit), 'Bit %s is not a Match' % bit)
+
+        self.assertRaises(BitInexistent, iso_resp.decodeFields, frame, (1, 4))
+        self.assertEqual(iso_resp.decodeFields(frame, ()), {}, 'No bits are not an empty dict')
+
+        # a secondary bitmap announced but cut short
+        self.assertRaises(InvalidAS2805, iso_resp.decodeFields, '\x02\x00\x80' + '\0' * 10, (11,))
+        self.assertRaises(InvalidAS2805, AS2805().setIsoContent, ('0200' + '80' + '00' * 10))
+
+
+
+"""
+            Field Plan Test Cases
+"""
+
+class Default_FieldPlanTestCase(unittest.TestCase):
+    def runTest(self):
+
+        print "Field Plan Test"
+
+        plan = AS2805._PLAN
+        self.assertEqual((plan[4].variable, plan[4].width), (False, 6), 'Fixed n12 is 6 octets')
+        self.assertEqual((plan[22].width, plan[28].width), (2, 5), 'Odd fixed fields are padded')
+        self.assertEqual((plan[2].prefixWidth, plan[2].prefixBCD), (1, True), 'LL n is a BCD octet')
+        self.assertEqual((plan[47].prefixWidth, plan[47].prefixBCD), (3, False), 'LLL ans is 3 ASCII digits')
+        self.assertEqual((plan[55].prefixWidth, plan[55].prefixBCD), (2, True), '0LLL b is 2 BCD octets')
+        self.assertEqual(plan[56], None, 'Undefined bits have no plan')
+
+        iso = AS2805()
+        iso.setMTI('0200')
+        iso.setBit(2, '4564456445644564567')
+        iso.setBit(22, '051')
+        iso.setBit(28, 'C00000150')
+        iso.setBit(47, 'TCC01\\')
+        iso.setBit(55, '9F02060000000020009F0306000000000000')
+
+        iso_resp = AS2805()
+        iso_resp.setNetworkISO(iso.getNetworkISO())
+        self.assertEqual(iso_resp.getBit(2), '4564456445644564567', 'Odd LL n is not a Match')
+        self.assertEqual(iso_resp.getBit(22), '051', 'Odd n is not a Match')
+        self.assertEqual(iso_resp.getBit(28), 'C00000150', 'x+n is not a Match')
+        self.assertEqual(iso_resp.getBit(47), 'TCC01\\', 'LLL ans is not a Match')
+        self.assertEqual(iso_resp.getBit(55), '9F02060000000020009F0306000000000000', '0LLL b is not a Match')
+
+        self.assertRaises(ValueToLarge, iso.setBit, 2, '1' * 20)
+        self.assertRaises(BitInexistent, iso.setBit, 56, '1')
+
+
+class Default_BitmapTestCase(unittest.TestCase):
+    def runTest(self):
+
+        print "Bitmap Test"
+
+        iso = AS2805()
+        iso.setMTI('0800')
+        iso.setBit(7, '0218070354')
+        iso.setBit(64, '29365A0400000000')
+        self.assertEqual(iso.getBitmap(), '0200000000000001', 'Primary bitmap is not a Match')
+
+        iso.setBit(70, '001')
+        iso.setBit(128, '027980E700000000')
+        self.assertEqual(iso.getBitmap(), '82000000000000010400000000000001', 'Secondary bitmap is not a Match')
+
+        iso_resp = AS2805()
+        iso_resp.setNetworkISO(iso.getNetworkISO())
+        self.assertEqual(iso_resp.getBitmap(), iso.getBitmap(), 'Bitmap is not a Match')
+        self.assertEqual([v['bit'] for v in iso_resp.getBitsAndValues()], ['7', '64', '70'], 'Bits are not a Match')
+
+
 
 """
 class Default_0200EMVPackTestCase(AS2805_0200_TestCases):
@@ -252,4 +538,1060 @@ class Default_0530UnPackTestCase(AS2805_0520_TestCases):
     def runTest(self):
         self.assertEqual(111, (100,150), 'wrong size after resize')
 
-"""
\ No newline at end of file
+"""
+
+
+class Default_ShapeCacheTestCase(unittest.TestCase):
+    def runTest(self):
+
+        print "Bitmap Shape Cache Test"
+
+        echo = HexToByte('0800' + '82200000000000000400000000000000' + '0218070354' + '000361' + '0001')
+        keyChange = HexToByte('08208220000080010800040000001000000001041021410084400861100016303332aa0dba804fa9f9032432e9e1239eeb4db2260b76f343ccdd90823af354f3f2a00000000000000002010106579944')
+
+        shapes = ShapePlanCache(AS2805._PLAN, maxsize=2)
+        self.assertEqual(shapes.get(echo[2:18]).spans, [(7, 18, 5), (11, 23, 3), (70, 26, 2)], 'Fixed shape is not precomputed')
+        self.assertEqual(shapes.get(keyChange[2:18]).spans, None, 'Variable shape is precomputed')
+        self.assertEqual(shapes.get(keyChange[2:18]).locate(keyChange)[2], (33, 26, 5), 'Bit 33 is not a Match')
+        self.assertEqual(shapes.stats(), {'hits': 1, 'misses': 2, 'size': 2, 'maxsize': 2}, 'Counters are not a Match')
+
+        shapes.get(echo[2:18])
+        shapes.get(HexToByte('0200000000000001'))
+        shapes.get(echo[2:18])
+        self.assertEqual(shapes.stats(), {'hits': 3, 'misses': 3, 'size': 2, 'maxsize': 2}, 'Least recently used shape is kept')
+
+        self.assertRaises(InvalidAS2805, shapes.get(echo[2:18]).locate, echo[:-1])
+
+        iso = AS2805()
+        iso.setNetworkISO(networkFrame(echo))
+        before = iso.getShapeCacheStats()
+        iso.setNetworkISO(networkFrame(echo))
+        self.assertEqual(iso.getShapeCacheStats()['hits'], before['hits'] + 1, 'Shape is not cached')
+        self.assertEqual(iso.getBit(70), '001', 'Bit 70 is not a Match')
+
+
+class Default_GeneratedShapeTestCase(unittest.TestCase):
+    def runTest(self):
+
+        print "Generated Shape Test"
+
+        keyChange = HexToByte('08208220000080010800040000001000000001041021410084400861100016303332aa0dba804fa9f9032432e9e1239eeb4db2260b76f343ccdd90823af354f3f2a00000000000000002010106579944')
+
+        shapes = ShapePlanCache(AS2805._PLAN, hot=2)
+        shape = shapes.get(keyChange[2:18])
+        self.assertEqual(shape.decoder, None, 'Cold shape is generated')
+        shapes.get(keyChange[2:18])
+        self.assertEqual(shape.decoder, None, 'Cold shape is generated')
+        shapes.get(keyChange[2:18])
+        self.assertNotEqual(shape.decoder, None, 'Hot shape is not generated')
+
+        generic = [0] * 129
+        generated = [0] * 129
+        for bit, offset, length in shape.locate(keyChange):
+            generic[bit] = keyChange[offset:offset + length]
+        shape.decode(keyChange, generated)
+        self.assertEqual(generated, generic, 'Generated decoder is not a Match')
+        self.assertEqual(shape.encode(keyChange[0:2], keyChange[2:18], generated), keyChange, 'Generated encoder is not a Match')
+
+        self.assertRaises(InvalidAS2805, shape.decode, keyChange[:-2], generated)
+
+
+class Default_MessagePoolTestCase(unittest.TestCase):
+    def runTest(self):
+
+        print "Message Pool Test"
+
+        pool = MessagePool(maxsize=1)
+        iso = pool.acquire()
+        iso.setMTI('0800')
+        iso.setBit(7, '0218070354')
+        iso.setBit(70, '301')
+        values = iso.getValuesArray()
+        pool.release(iso)
+
+        self.assertEqual(iso.getMTI(), '', 'MTI is not reset')
+        self.assertEqual(iso.getBitmap(), '0000000000000000', 'Bitmap is not reset')
+        self.assertEqual(iso.getValuesArray() is values, True, 'Bit slots are not reused')
+        self.assertEqual(iso.getValuesArray(), [0] * 129, 'Bits are not reset')
+
+        other = []
+        thread = threading.Thread(target=lambda: other.append(pool.acquire()))
+        thread.start()
+        thread.join()
+        self.assertEqual(other[0] is iso, False, 'Packages are shared between threads')
+
+        self.assertEqual(pool.acquire(lazy=True) is iso, True, 'Released package is not reused')
+        self.assertEqual(iso.LAZY, True, 'Options are not applied')
+        self.assertEqual(pool.acquire() is iso, False, 'Package is handed out twice')
+
+
+class Default_FramerTestCase(unittest.TestCase):
+    def runTest(self):
+
+        print "Framer Test"
+
+        iso = AS2805()
+        iso.setMTI('0800')
+        iso.setBit(7, '0218070354')
+        iso.setBit(11, '000361')
+        iso.setBit(70, '301')
+        echo = iso.getNetworkISO()
+        iso.setBit(48, '0F5E4728EDE11727AD5DF16ADD5074D820FE8223FD250762E55FAEBB715EF682')
+        keyChange = iso.getNetworkISO()
+
+        # coalesced and split frames, through a buffer that has to be compacted
+        local, remote = socket.socketpair()
+        framer = LengthPrefixFramer(capacity=len(keyChange) + 10)
+        stream = echo + keyChange + echo
+        frames = []
+        sent = 0
+        for cut in (5, len(echo) + 3, len(stream)):
+            remote.sendall(stream[sent:cut])
+            sent = cut
+            while sent - sum(map(len, frames)) - framer.pending():
+                framer.recvFrom(local)
+                frames.extend([frame.tobytes() for frame in framer.frames()])
+        self.assertEqual(frames, [echo, keyChange, echo], 'Frames are not a Match')
+        self.assertEqual(framer.pending(), 0, 'Bytes are left over')
+
+        remote.close()
+        self.assertEqual(framer.recvFrom(local), 0, 'Close is not seen')
+        local.close()
+
+        framer = LengthPrefixFramer(bigEndian=False, headerSize=2)
+        framer.feed(struct.pack('<H', 3) + 'abc' + struct.pack('<H', 2))
+        self.assertEqual([frame.tobytes() for frame in framer.frames()], [struct.pack('<H', 3) + 'abc'], 'Frame is not a Match')
+        framer.feed('de')
+        self.assertEqual(isinstance(framer.frames()[0], memoryview), True, 'Frame is copied')
+
+        framer = LengthPrefixFramer(capacity=64)
+        framer.feed(struct.pack('!I', 61))
+        self.assertRaises(FramingError, framer.frames)
+
+
+class Default_HostServerTestCase(unittest.TestCase):
+    def runTest(self):
+
+        print "Host Server Test"
+
+        iso = AS2805()
+        iso.setMTI('0800')
+        iso.setBit(7, '0218070354')
+        iso.setBit(11, '000361')
+        iso.setBit(70, '301')
+        echo = iso.getNetworkISO()
+        iso.setBit(11, '000362')
+        echo2 = iso.getNetworkISO()
+        iso.setMTI('0200')
+        unhandled = iso.getNetworkISO()
+
+        server = AS2805HostServer('127.0.0.1', 0)
+        thread = threading.Thread(target=server.serveForever, args=(0.05,))
+        thread.start()
+        try:
+            client = socket.create_connection(server.getAddress())
+            # two frames in one segment, then a frame nobody handles and one split in two
+            client.sendall(echo + echo2 + unhandled + echo[:7])
+            client.sendall(echo[7:])
+
+            framer = LengthPrefixFramer()
+            frames = []
+            while len(frames) < 3 and framer.recvFrom(client):
+                frames.extend([frame.tobytes() for frame in framer.frames()])
+            client.close()
+        finally:
+            server.stop()
+            thread.join()
+            server.close()
+
+        answers = [AS2805() for frame in frames]
+        for answer, frame in zip(answers, frames):
+            answer.setNetworkISO(frame)
+        self.assertEqual([answer.getMTI() for answer in answers], ['0810'] * 3, 'MTI is not a Match')
+        self.assertEqual([answer.getBit(11) for answer in answers], ['000361', '000362', '000361'], 'STAN is not a Match')
+        self.assertEqual(answers[0].getBit(39), '00', 'Response Code is not a Match')
+        self.assertEqual(server.METRICS['frames'], 4, 'Frames are not counted')
+        self.assertEqual(server.METRICS['unhandled'], 1, 'Unhandled MTI is not counted')
+
+
+class Default_HostServerHighWaterTestCase(unittest.TestCase):
+    def runTest(self):
+
+        print "Host Server High Water Test"
+
+        iso = AS2805()
+        iso.setMTI('0800')
+        iso.setBit(11, '000361')
+        iso.setBit(70, '301')
+        echo = iso.getNetworkISO()
+        # more than the socket buffers hold, the response stays in the send buffer of the link
+        response = struct.pack('!I', 8 * 1024 * 1024) + 'x' * 8 * 1024 * 1024
+
+        server = AS2805HostServer('127.0.0.1', 0, highWater=1024)
+        server.setHandler('0800', lambda server, frame: response)
+        thread = threading.Thread(target=server.serveForever, args=(0.05,))
+        thread.start()
+        try:
+            client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            client.connect(server.getAddress())
+            client.sendall(echo)
+            time.sleep(0.2)
+            # the link is not read while its responses are not
+            client.sendall(echo)
+            time.sleep(0.2)
+            self.assertEqual(server.METRICS['frames'], 1, 'Link is read past the high water mark')
+            self.assertEqual(server.METRICS['throttled'], 1, 'High water mark is not counted')
+
+            received = 0
+            while received < 2 * len(response):
+                data = client.recv(1024 * 1024)
+                self.assertTrue(data, 'Link is closed')
+                received += len(data)
+            client.close()
+        finally:
+            server.stop()
+            thread.join()
+            server.close()
+
+        self.assertEqual(server.METRICS['frames'], 2, 'Link is not read once drained')
+
+
+class Default_HostServerResetTestCase(unittest.TestCase):
+    def runTest(self):
+
+        print "Host Server Reset Test"
+
+        iso = AS2805()
+        iso.setMTI('0800')
+        iso.setBit(7, '0218070354')
+        iso.setBit(11, '000361')
+        iso.setBit(70, '301')
+        echo = iso.getNetworkISO()
+
+        # responses far bigger than the socket buffers, so the link is left with output pending
+        server = AS2805HostServer('127.0.0.1', 0)
+        server.setHandler('0800', lambda server, frame: '\0' * 1024 * 1024)
+        try:
+            peer = socket.create_connection(server.getAddress())
+            peer.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            peer.sendall(echo * 4)
+            for i in range(20):
+                server.serveOnce(0.01)
+            self.assertTrue([link for link in server._LINKS.values() if link.OUT], 'No output is pending')
+
+            # the peer resets the link instead of reading
+            peer.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            peer.close()
+            for i in range(20):
+                server.serveOnce(0.01)
+            self.assertEqual(server._LINKS, {}, 'Reset link is not closed')
+
+            # the other links are still served
+            server.setHandler('0800', answerNetworkManagement)
+            other = socket.create_connection(server.getAddress())
+            other.sendall(echo)
+            other.settimeout(0.01)
+            framer = LengthPrefixFramer()
+            frames = []
+            for i in range(100):
+                server.serveOnce(0.01)
+                try:
+                    framer.recvFrom(other)
+                except socket.timeout:
+                    continue
+                frames.extend(framer.frames())
+                if frames:
+                    break
+            other.close()
+            self.assertEqual(len(frames), 1, 'Other link is not served')
+        finally:
+            server.close()
+
+
+class Default_HostServerClusterTestCase(unittest.TestCase):
+    def runTest(self):
+
+        print "Host Server Cluster Test"
+
+        iso = AS2805()
+        iso.setMTI('0800')
+        iso.setBit(7, '0218070354')
+        iso.setBit(11, '000361')
+        iso.setBit(70, '301')
+        echo = iso.getNetworkISO()
+
+        cluster = HostServerCluster('127.0.0.1', 0, workers=2, interval=0.05)
+        cluster.start()
+        try:
+            def exchange():
+                client = socket.create_connection(cluster.getAddress())
+                client.sendall(echo)
+                framer = LengthPrefixFramer()
+                frames = []
+                while not frames and framer.recvFrom(client):
+                    frames = [frame.tobytes() for frame in framer.frames()]
+                client.close()
+                return frames
+
+            for i in range(4):
+                self.assertEqual(len(exchange()), 1, 'Echo is not answered')
+
+            first = cluster.getMetrics()[0]['pid']
+            os.kill(first, signal.SIGKILL)
+            while cluster.supervise() == 0:
+                time.sleep(0.01)
+            self.assertEqual(len(exchange()), 1, 'Echo is not answered after a restart')
+
+            time.sleep(0.2)
+            metrics = cluster.getMetrics()
+        finally:
+            cluster.stop()
+
+        self.assertEqual(len(metrics), 3, 'Metrics are not per worker')
+        self.assertNotEqual(metrics[0]['pid'], first, 'Worker is not restarted')
+        self.assertEqual(metrics[-1]['restarts'], 1, 'Restart is not counted')
+        self.assertEqual(metrics[-1]['responses'] >= 1, True, 'Responses are not counted')
+
+
+class Default_MultiplexClientTestCase(unittest.TestCase):
+    def runTest(self):
+
+        print "Multiplexed Client Test"
+
+        iso = AS2805()
+        iso.setMTI('0200')
+        iso.setBit(3, '000000')
+        iso.setBit(4, '000000002000')
+        iso.setBit(7, '0218070354')
+        iso.setBit(41, '61100016')
+        requests = []
+        for stan in ('000361', '000362', '000363'):
+            iso.setBit(11, stan)
+            requests.append(iso.getNetworkISO())
+        iso.setMTI('0800')
+        iso.setBit(70, '301')
+        iso.setBit(11, '000901')
+        hostEcho = iso.getNetworkISO()
+
+        host, local = socket.socketpair()
+        unsolicited = []
+        client = MultiplexedClient(sock=local, unsolicited=lambda client, frame: unsolicited.append(frame))
+        pending = [client.send(request) for request in requests]
+        self.assertEqual(client.outstanding(), 3, 'Requests are not in flight')
+
+        framer = LengthPrefixFramer()
+        received = []
+        while len(received) < 3:
+            framer.recvFrom(host)
+            received.extend([frame.tobytes() for frame in framer.frames()])
+        self.assertEqual(received, requests, 'Requests are not sent')
+
+        # a response with a bit the codec does not know, 56, and a short frame are dropped, the link goes on
+        malformed = bytearray(AS2805().deriveResponse(received[0], {39: '00'}))
+        malformed[12] |= 0x01
+        host.sendall(str(malformed) + '\0\0\0\1\x02')
+
+        # the host answers the second request first, starts an echo of its own, then answers the first
+        host.sendall(AS2805().deriveResponse(received[1], {39: '05'}) + hostEcho)
+        host.sendall(AS2805().deriveResponse(received[0], {39: '00'}))
+
+        answers = [AS2805() for i in range(2)]
+        answers[0].setNetworkISO(str(pending[0].wait(5)))
+        answers[1].setNetworkISO(str(pending[1].wait(5)))
+        self.assertEqual([answer.getBit(11) for answer in answers], ['000361', '000362'], 'Response is not matched')
+        self.assertEqual([answer.getBit(39) for answer in answers], ['00', '05'], 'Response is not matched')
+        self.assertEqual(unsolicited, [hostEcho], 'Unsolicited 0800 is not handed over')
+        self.assertEqual(pending[2].done(), False, 'Request is answered twice')
+        self.assertEqual(client.METRICS['malformed'], 2, 'Malformed frames are not counted')
+
+        host.close()
+        self.assertRaises(ConnectionClosed, pending[2].wait, 5)
+        self.assertRaises(ConnectionClosed, client.send, requests[2])
+        client.close()
+
+        # closed from the completion callback, on the reader thread
+        host, local = socket.socketpair()
+        client = MultiplexedClient(sock=local)
+        errors = []
+
+        def closing(pending):
+            try:
+                client.close()
+            except Exception, e:
+                errors.append(e)
+        client.send(requests[0], closing)
+        framer = LengthPrefixFramer()
+        while not framer.recvFrom(host) or not list(framer.frames()):
+            pass
+        host.sendall(AS2805().deriveResponse(requests[0], {39: '00'}))
+        client._READER.join(5)
+        self.assertFalse(client._READER.isAlive(), 'Reader is not stopped')
+        self.assertEqual(errors, [], 'Close from the reader thread failed')
+        host.close()
+
+        # the host stops reading and sends garbage, the writer is stuck in sendall
+        host, local = socket.socketpair()
+        client = MultiplexedClient(sock=local)
+        client.sendFrame('\0' * 4 * 1024 * 1024, NETWORK_MANAGEMENT)
+        time.sleep(0.1)
+        host.sendall('\xff' * 8)
+        client._READER.join(5)
+        self.assertFalse(client._READER.isAlive(), 'Reader is stuck behind the writer')
+        client.close()
+        host.close()
+
+
+class Default_HostPoolTestCase(unittest.TestCase):
+    def runTest(self):
+
+        print "Host Pool Test"
+
+        servers = [AS2805HostServer('127.0.0.1', 0) for i in range(2)]
+        threads = [threading.Thread(target=server.serveForever, args=(0.05,)) for server in servers]
+        for thread in threads:
+            thread.start()
+
+        # the second host declines the sign on
+        signOns = []
+        servers[1].setHandler('0800', lambda server, frame: signOns.append(frame) or
+                              server.CODEC.deriveResponse(frame, {39: '91'}))
+
+        iso = AS2805()
+        iso.setMTI('0800')
+        iso.setBit(7, '0218070354')
+        iso.setBit(70, '301')
+
+        pool = HostPool([server.getAddress() for server in servers], linksPerHost=2, timeout=5, interval=60)
+        try:
+            pool.start()
+            states = [(link['port'], link['state']) for link in pool.getLinks()]
+            self.assertEqual([state for port, state in states], [SIGNED_ON] * 2 + [DOWN] * 2, 'Sign on is not a Match')
+            self.assertEqual(len(signOns), 2, 'Sign on is not sent')
+
+            # a link with a request in flight is not picked
+            busy = pool.pick()
+            iso.setBit(11, '000001')
+            busy.CLIENT.send(iso.getNetworkISO())
+            servers[0].setHandler('0800', None)
+            iso.setBit(11, '000002')
+            inFlight = busy.CLIENT.send(iso.getNetworkISO())
+            self.assertNotEqual(pool.pick() is busy, True, 'Busiest link is picked')
+
+            servers[1].setHandler('0800', answerNetworkManagement)
+            self.assertEqual(pool.maintain(), 2, 'Links are not signed on')
+
+            # the first host goes away, its requests fail over to the second host
+            servers[0].stop()
+            threads[0].join()
+            servers[0].close()
+            self.assertRaises(ConnectionClosed, inFlight.wait, 5)
+            iso.setBit(11, '000003')
+            response = AS2805()
+            response.setNetworkISO(str(pool.request(iso.getNetworkISO(), timeout=5)))
+            self.assertEqual(response.getBit(39), '00', 'Request is not answered')
+            self.assertEqual([link['state'] for link in pool.getLinks()], [DOWN] * 2 + [SIGNED_ON] * 2,
+                             'Dropped links are not down')
+        finally:
+            pool.stop()
+            servers[1].stop()
+            threads[1].join()
+            servers[1].close()
+
+        self.assertRaises(NoLinkAvailable, pool.request, iso.getNetworkISO())
+
+        # a request the host got before its link dropped is not sent again on the other link
+        servers = [AS2805HostServer('127.0.0.1', 0) for i in range(2)]
+        threads = [threading.Thread(target=server.serveForever, args=(0.05,)) for server in servers]
+        for thread in threads:
+            thread.start()
+        pool = HostPool([server.getAddress() for server in servers], linksPerHost=1, timeout=5, interval=60)
+        received = [[], []]
+        arrived = threading.Event()
+        try:
+            pool.start()
+            servers[0].setHandler('0800', lambda server, frame: received[0].append(frame) or arrived.set())
+            servers[1].setHandler('0800', lambda server, frame: received[1].append(frame) or
+                                  answerNetworkManagement(server, frame))
+            errors = []
+
+            def send():
+                try:
+                    iso.setBit(11, '000004')
+                    pool.request(iso.getNetworkISO(), timeout=5)
+                except Exception, e:
+                    errors.append(e)
+            sender = threading.Thread(target=send)
+            sender.start()
+            self.assertTrue(arrived.wait(5), 'Request is not sent')
+            servers[0].stop()
+            threads[0].join()
+            servers[0].close()
+            sender.join(10)
+            self.assertEqual([type(error) for error in errors], [ConnectionClosed], 'Sent request is not failed')
+            self.assertEqual((len(received[0]), len(received[1])), (1, 0), 'Sent request is sent again')
+        finally:
+            pool.stop()
+            servers[1].stop()
+            threads[1].join()
+            servers[1].close()
+
+
+class Default_TimingWheelTestCase(unittest.TestCase):
+    def runTest(self):
+
+        print "Timing Wheel Test"
+
+        now = [1000.0]
+        wheel = TimingWheel(tick=0.01, slots=64, clock=lambda: now[0])
+        fired = []
+        wheel.schedule(0.05, fired.append, 'a')
+        late = wheel.schedule(0.05, fired.append, 'b')
+        wheel.schedule(2.0, fired.append, 'c')  # beyond one turn of the wheel
+        self.assertEqual(len(wheel), 3, 'Timers are not counted')
+        self.assertEqual(wheel.cancel(late), True, 'Timer is not cancelled')
+        self.assertEqual(wheel.cancel(late), False, 'Timer is cancelled twice')
+
+        now[0] += 0.04
+        self.assertEqual(wheel.advance(), 0, 'Timer fired early')
+        now[0] += 0.02
+        self.assertEqual(wheel.advance(), 1, 'Timer did not fire')
+        now[0] += 0.64
+        self.assertEqual(wheel.advance(), 0, 'Timer of a later turn fired')
+        now[0] += 5
+        self.assertEqual(wheel.advance(), 1, 'Late advance missed a timer')
+        self.assertEqual((fired, len(wheel)), (['a', 'c'], 0), 'Timers are not a Match')
+
+        # a delay is never cut short by the tick it falls in
+        now[0] = 2000.005
+        wheel.schedule(0.01, fired.append, 'd')
+        now[0] = 2000.012
+        self.assertEqual(wheel.advance(), 0, 'Timer fired before its delay')
+        now[0] = 2000.02
+        self.assertEqual(wheel.advance(), 1, 'Timer did not fire')
+
+        # a callback that raises does not stop the timers due with it
+        wheel.schedule(0.01, fired.pop, 10)
+        wheel.schedule(0.01, fired.append, 'e')
+        now[0] += 0.02
+        self.assertEqual(wheel.advance(), 2, 'Timers due with a failing one are lost')
+        self.assertEqual(fired, ['a', 'c', 'd', 'e'], 'Timers are not a Match')
+
+        for i in range(100000):
+            wheel.schedule(i % 300 * 0.01, fired.append, i)
+        now[0] += 3
+        self.assertEqual(wheel.advance(), 100000, 'Timers are lost')
+
+
+class Default_0420ReversalTestCase(unittest.TestCase):
+    def runTest(self):
+
+        print "Switch 0420 Reversal Test"
+
+        iso = AS2805()
+        iso.setMTI('0200')
+        iso.setBit(2, '5188680100002932')
+        iso.setBit(3, '011000')
+        iso.setBit(4, '000000002000')
+        iso.setBit(7, '0107234721')
+        iso.setBit(11, '000506')
+        iso.setBit(32, '560258')
+        iso.setBit(41, 'S9218163')
+        iso.setBit(52, 'A8FB4E47EACB0FA1')
+        request = iso.getNetworkISO()
+
+        advice = AS2805()
+        advice.setNetworkISO(str(iso.deriveReversal(request, '000507', '0107234821')))
+        self.assertEqual(advice.getMTI(), '0420', 'MTI is not a Match')
+        self.assertEqual(advice.getBit(90), '020000050601072347210000056025800000000000', 'Bit 90 is not a Match')
+        self.assertEqual([advice.getBit(bit) for bit in (4, 7, 11, 41)],
+                         ['000000002000', '0107234821', '000507', 'S9218163'], 'Bits are not a Match')
+        self.assertRaises(BitNotSet, advice.getBit, 52)
+        self.assertEqual(iso.getNetworkISO(), request, 'Request is modified')
+
+        now = [1000.0]
+        advices = []
+        reversals = ReversalTimer(lambda advice, request: advices.append(advice), timeout=30, stan=lambda: '000900',
+                                  wheel=TimingWheel(tick=0.01, slots=4096, clock=lambda: now[0]))
+        answered = reversals.track(request)
+        iso.setBit(11, '000508')
+        reversals.track(iso.getNetworkISO())
+        self.assertEqual(reversals.outstanding(), 2, 'Requests are not tracked')
+
+        response = AS2805()
+        response.setNetworkISO(str(response.deriveResponse(request, {39: '00'})))
+        self.assertEqual(reversals.answered(reversals.getKey(response.getNetworkISO())), True, 'Response is not matched')
+        now[0] += 31
+        reversals.WHEEL.advance()
+        self.assertEqual(len(advices), 1, 'Reversal is not built')
+        advice.setNetworkISO(str(advices[0]))
+        self.assertEqual((advice.getBit(11), advice.getBit(90)[4:10]), ('000900', '000508'), 'Reversal is not a Match')
+        self.assertEqual(reversals.answered(answered), False, 'Answered request is tracked')
+
+        # a request tracked again while its first timer is firing: the old timer leaves the new one alone
+        key = reversals.track(request)
+        old = reversals._TIMERS[key][0]
+        reversals.track(request, key, timeout=60)
+        old.CALLBACK(*old.ARGS)
+        self.assertEqual((len(advices), reversals.outstanding()), (1, 1), 'Replaced timer reversed the request')
+        now[0] += 61
+        reversals.WHEEL.advance()
+        self.assertEqual(len(advices), 2, 'Reversal is not built')
+
+
+class Default_NetworkManagerTestCase(unittest.TestCase):
+    def runTest(self):
+
+        print "Network Management Test"
+
+        def serve(port):
+            server = AS2805HostServer('127.0.0.1', port)
+            server.setHandler('0820', lambda server, frame: server.CODEC.deriveResponse(frame, {39: '00'}))
+            thread = threading.Thread(target=server.serveForever, args=(0.02,))
+            thread.start()
+            return server, thread
+
+        def waitFor(condition):
+            for i in range(500):
+                if condition():
+                    return True
+                time.sleep(0.01)
+            return False
+
+        server, thread = serve(0)
+        port = server.getAddress()[1]
+        pool = HostPool([('127.0.0.1', port)], linksPerHost=2, timeout=1)
+        keyChanges = []
+        threads = set()
+        manager = NetworkManager(pool, echoInterval=0.1, keyChangeInterval=0.15, timeout=1, backoff=(0.05, 0.2),
+                                 keyChange=lambda link: {48: '0F5E4728EDE11727AD5DF16ADD5074D820FE8223FD250762E55FAEBB715EF682'},
+                                 onKeyChange=lambda link, approved, response: keyChanges.append(approved) or
+                                 threads.add(threading.currentThread().name),
+                                 wheel=TimingWheel(tick=0.01, slots=256))
+        try:
+            manager.start()
+            self.assertEqual(waitFor(lambda: manager.METRICS['echoes'] >= 4 and len(keyChanges) >= 2), True,
+                             'Echoes and key changes are not sent')
+            self.assertEqual(keyChanges[:2], [True, True], 'Key change is not approved')
+            self.assertEqual(threads, set(['TimingWheel']), 'Responses are handled on the reader thread')
+            self.assertEqual([link['state'] for link in pool.getLinks()], [SIGNED_ON] * 2, 'Links are not signed on')
+
+            # the host goes away and comes back, the links are signed on again
+            server.stop()
+            thread.join()
+            server.close()
+            self.assertEqual(waitFor(lambda: manager.METRICS['signOnFailures'] >= 2), True, 'Lost links are not seen')
+            server, thread = serve(port)
+            self.assertEqual(waitFor(lambda: manager.METRICS['signOns'] >= 4), True, 'Links are not signed on again')
+        finally:
+            manager.stop()
+            server.stop()
+            thread.join()
+            server.close()
+
+        # the host declines the first echo, the response comes on the reader thread of the link
+        declined = []
+
+        def echo(server, frame):
+            if server.CODEC.decodeFields(frame[4:], (70,)).get(70) == '301' and not declined:
+                declined.append(frame)
+                return server.CODEC.deriveResponse(frame, {39: '91'})
+            return answerNetworkManagement(server, frame)
+
+        server, thread = serve(0)
+        server.setHandler('0800', echo)
+        pool = HostPool([server.getAddress()], linksPerHost=1, timeout=1)
+        manager = NetworkManager(pool, echoInterval=0.1, timeout=1, backoff=(0.05, 0.2),
+                                 wheel=TimingWheel(tick=0.01, slots=256))
+        try:
+            manager.start()
+            self.assertEqual(waitFor(lambda: manager.METRICS['signOns'] >= 2 and manager.METRICS['echoes'] >= 1), True,
+                             'Link is not signed on again after a declined echo')
+            self.assertEqual(manager.METRICS['echoFailures'], 1, 'Declined echo is not counted')
+            self.assertEqual(waitFor(lambda: pool.getLinks()[0]['state'] == SIGNED_ON), True, 'Link is not signed on')
+        finally:
+            manager.stop()
+            server.stop()
+            thread.join()
+            server.close()
+
+        # a key change callback that raises fails its exchange, the wheel goes on with the next ones
+        def failing(link, approved, response):
+            keyChanges.append(approved)
+            raise KeyCheckError('check values do not match')
+
+        keyChanges = []
+        server, thread = serve(0)
+        pool = HostPool([server.getAddress()], linksPerHost=1, timeout=1)
+        manager = NetworkManager(pool, echoInterval=0.1, keyChangeInterval=0.1, timeout=1, backoff=(0.05, 0.2),
+                                 keyChange=lambda link: {53: '0000000000000002'}, onKeyChange=failing,
+                                 wheel=TimingWheel(tick=0.01, slots=256))
+        try:
+            manager.start()
+            self.assertEqual(waitFor(lambda: len(keyChanges) >= 3 and manager.METRICS['echoes'] >= 3), True,
+                             'Wheel stopped after a failing key change callback')
+            self.assertEqual(manager.METRICS['keyChanges'], 0, 'Failed key change is counted as done')
+            self.assertTrue(manager.METRICS['keyChangeFailures'] >= 3, 'Failed key change is not counted')
+        finally:
+            manager.stop()
+            server.stop()
+            thread.join()
+            server.close()
+
+
+class Default_SheddingTestCase(unittest.TestCase):
+    def runTest(self):
+
+        print "Priority and Shedding Test"
+
+        iso = AS2805()
+        iso.setBit(7, '0218070354')
+        iso.setBit(11, '000361')
+        frames = {}
+        for mti in ('0800', '0820', '0420', '0220', '0200', '0100'):
+            iso.setMTI(mti)
+            frames[mti] = iso.getNetworkISO()
+        self.assertEqual([getPriority(frames[mti]) for mti in ('0800', '0820', '0420', '0220', '0200', '0100')],
+                         [NETWORK_MANAGEMENT] * 2 + [ADVICE] * 2 + [FINANCIAL] * 2, 'Priority is not a Match')
+
+        self.assertRaises(MultiplexError, MultiplexedClient, sock=socket.socketpair()[0], declineCode='X9')
+
+        host, local = socket.socketpair()
+        client = MultiplexedClient(sock=local, declineCode='91', target=0.01, interval=0.1)
+
+        # a request whose response cannot come back within its deadline is not sent
+        client._RTT = 1.0
+        pending = client.send(frames['0200'], deadline=0.5)
+        response = AS2805()
+        response.setNetworkISO(pending.wait(5))
+        self.assertEqual((pending.Declined, response.getMTI(), response.getBit(39)), (True, '0210', '91'),
+                         'Late request is not declined')
+        self.assertEqual((client.METRICS['late'], client.outstanding()), (1, 0), 'Late request is in flight')
+
+        # CoDel, the queue delay must stay above the target for an interval, then the drops get closer
+        shed = client._MultiplexedClient__shed
+        entry = (frames['0200'], pending, 100.0, None)
+        self.assertEqual(shed(entry, 100.005, True), False, 'Short delay is shed')
+        self.assertEqual([shed(entry, now, True) for now in (100.02, 100.1, 100.121, 100.122)],
+                         [False, False, True, False], 'First drop is not a Match')
+        self.assertEqual([shed(entry, now, True) for now in (100.221, 100.222, 100.292, 100.35)],
+                         [True, False, True, True], 'Control law is not a Match')
+        self.assertEqual(shed(entry, 100.36, False), False, 'Last request of the queue is shed')
+        self.assertEqual(client.METRICS['shed'], 4, 'Shed requests are not counted')
+
+        host.close()
+        client.close()
+
+
+class Default_MACTestCase(unittest.TestCase):
+    def runTest(self):
+
+        print "ISO 9797-1 MAC Test"
+
+        key = HexToByte('0123456789ABCDEFFEDCBA9876543210')
+        vectors = [('', 'F1FBCF2A56D19BA7', 'F1FBCF2A56D19BA7', '9A32E75BC4465B6E'),
+                   ('Now is the time for all ', 'E9086230CA3BE796', '805036D50BB76107', 'EE77FF082D6789F4'),
+                   ('Now is the time for it', '5A692CE64F404145', '083CC246761F3410', '66A0B7E33F269A40')]
+        for message, retail, full, counted in vectors:
+            self.assertEqual(ToHex(DESMAC(message, key, '')).upper(), retail, 'Retail MAC is not a Match')
+            self.assertEqual(ToHex(DES3MAC(message, key, '')).upper(), full, 'Full 3DES MAC is not a Match')
+            self.assertEqual(ToHex(DESMAC(message, key, '0000000000000001')).upper(), counted, 'MAC with SSC is not a Match')
+            self.assertEqual(RetailMAC(memoryview(bytearray(message)), key), DESMAC(message, key, ''), 'Slice MAC is not a Match')
+            self.assertEqual(FullMAC(bytearray(message), key), DES3MAC(message, key, ''), 'Slice MAC is not a Match')
+
+        # the output transform of a 24 bytes key uses its first key again, the third one is ignored
+        triple = key + HexToByte('89ABCDEF01234567')
+        self.assertEqual(ToHex(DESMAC('Now is the time for it', triple, '')).upper(), '5A692CE64F404145',
+                         '24 bytes key MAC is not a Match')
+        self.assertEqual(RetailMAC('Now is the time for it', Ciphers.register('test/triple', triple)),
+                         RetailMAC('Now is the time for it', triple), 'Cached 24 bytes key MAC is not a Match')
+
+        # the sample of Shared/MAC.py, a hex message and key taken as they are
+        message = "<STX>000000  td7W0       <FS>9VDD9002       <FS>11<FS>0056<FS>4902370000002348=121210111234123<FS>" \
+                  "00006000<FS>00000200<FS>4F50E157E8D544B1<FS><FS><FS>VA5.00.07WV02.70.10 V04.00.19 0  0T  00 000     " \
+                  "00000002K0047000000005K005500000000000000000000000000000000000000<FS><FS><ETX>"
+        self.assertEqual(ToHex(DESMAC(ToHex(message), 'F92260FA70A180E1B30D9E95DAD6B823', '')).upper(), '507029C7990BAE0F',
+                         'Sample MAC is not a Match')
+
+
+class Default_CipherCacheTestCase(unittest.TestCase):
+    def runTest(self):
+
+        print "Cipher Cache Test"
+
+        key = HexToByte('0123456789ABCDEFFEDCBA9876543210')
+        handle = Ciphers.register('test/ZAK', key)
+        self.assertTrue(Ciphers.register('test/ZAK', key) is handle, 'Same key is a new handle')
+        self.assertFalse(key in repr(handle), 'Key is printed')
+
+        # the kept CBC chains start over at each message, whatever came before
+        messages = ['', 'Now is the time for all ', 'Now is the time for it', 'x' * 1433, 'Now is the time for all ']
+        for iv in ('\0' * 8, HexToByte('9A32E75BC4465B6E')):
+            for message in messages * 2:
+                self.assertEqual(RetailMAC(message, handle, iv), RetailMAC(message, key, iv), 'Cached Retail MAC is not a Match')
+                self.assertEqual(FullMAC(bytearray(message), handle, iv), FullMAC(message, key, iv), 'Cached Full MAC is not a Match')
+        self.assertEqual(DESMAC(messages[1], handle, '0000000000000001'), DESMAC(messages[1], key, '0000000000000001'),
+                         'Cached MAC with SSC is not a Match')
+
+        # ciphers are given back when the MAC fails, and still give the right MAC
+        hits = Ciphers.stats()['hits']
+        self.assertRaises(Exception, RetailMAC, messages[1], handle, 'bad iv')
+        self.assertEqual(RetailMAC(messages[1], handle), RetailMAC(messages[1], key), 'Cached Retail MAC is not a Match')
+        self.assertEqual(Ciphers.stats()['hits'], hits + 2, 'Ciphers are not given back after a failure')
+
+        pin = HexToByte('041234FFFFFFFFFF')
+        encrypted = EncryptPINBlock(pin, handle)
+        self.assertEqual(encrypted, EncryptPINBlock(pin, key), 'Cached PIN block is not a Match')
+        self.assertEqual(DecryptPINBlock(encrypted, handle), pin, 'PIN block is not decrypted')
+
+        # rollover: the ciphers of the old key are dropped, a held handle of the old key still works
+        invalidated = []
+        cache = CipherCache(maxsize=2)
+        cache.onInvalidate(invalidated.append)
+        old = cache.register('link', key)
+        ciphers = cache.acquire(old, FULL)
+        cache.release(old, FULL, ciphers)
+        self.assertTrue(cache.acquire(old, FULL) is ciphers, 'Ciphers are not kept')
+        new = cache.register('link', key[8:] + key[:8])
+        self.assertEqual(invalidated, ['link'], 'Invalidation hook is not called')
+        cache.release(old, FULL, ciphers)
+        self.assertFalse(cache.acquire(new, FULL) is ciphers, 'Ciphers of the old key are served')
+        self.assertTrue(cache.lookup('link') is new, 'New key is not registered')
+
+        # the old handle gets ciphers of its own, it does not evict those of the new one
+        current = cache.acquire(new, RETAIL)
+        cache.release(new, RETAIL, current)
+        cache.release(old, RETAIL, cache.acquire(old, RETAIL))
+        self.assertTrue(cache.acquire(new, RETAIL) is current, 'Old handle evicts the ciphers of the new one')
+        cache.release(new, RETAIL, current)
+        self.assertTrue(cache.register('link', key) is not old, 'Old key is registered again under the same handle')
+        cache.register('link', key[8:] + key[:8])
+        cache.invalidate('link')
+        self.assertEqual(cache.lookup('link'), None, 'Invalidated key is still registered')
+
+        # least recently used pairs are evicted
+        hits = cache.stats()['hits']
+        handles = [cache.register(i, key) for i in range(3)]
+        for each in handles:
+            cache.release(each, RETAIL, cache.acquire(each, RETAIL))
+        self.assertEqual(cache.stats()['size'], 2, 'Cache is not bounded')
+        self.assertEqual(cache.stats()['hits'], hits, 'Evicted ciphers are served')
+
+
+class Default_CodecMACTestCase(unittest.TestCase):
+    def runTest(self):
+
+        print "Codec MAC Test"
+
+        key = HexToByte('0123456789ABCDEFFEDCBA9876543210')
+        handle = Ciphers.register('test/codec ZAK', key)
+
+        # no secondary bitmap, the MAC is bit 64
+        iso = AS2805()
+        iso.setMTI('0200')
+        iso.setBit(3, '011000')
+        iso.setBit(11, '000001')
+        iso.setBit(55, 'A5' * 40)
+        frame = iso.getNetworkISO(macKey=key)
+        self.assertEqual(frame[-8:], RetailMAC(frame[4:-8], key)[:4] + '\0' * 4, 'MAC is not the retail MAC')
+        self.assertEqual(iso.getBit(64), ToHex(frame[-8:]).upper(), 'Bit 64 is not the MAC')
+        self.assertEqual(iso.getNetworkISO(macKey=handle), frame, 'MAC with a key handle is not a Match')
+
+        received = AS2805()
+        received.setNetworkISO(frame, macKey=handle)
+        self.assertEqual(received.getBit(11), '000001', 'Bits are not parsed')
+        AS2805(lazy=True).setNetworkISO(frame, macKey=key)
+
+        # a secondary bitmap, the MAC is bit 128
+        iso.setBit(70, '301')
+        frame = iso.getNetworkISO(macKey=key)
+        self.assertEqual(iso.getBit(128), ToHex(frame[-8:]).upper(), 'Bit 128 is not the MAC')
+        AS2805().setNetworkISO(frame, macKey=key)
+
+        tampered = frame[:-12] + chr(ord(frame[-12]) ^ 1) + frame[-11:]
+        self.assertRaises(InvalidMAC, AS2805().setNetworkISO, tampered, True, key)
+        self.assertRaises(InvalidMAC, AS2805().setNetworkISO, frame, True, key[8:] + key[:8])
+
+        unsigned = AS2805()
+        unsigned.setMTI('0800')
+        unsigned.setBit(11, '000002')
+        unsigned.setBit(70, '301')
+        self.assertRaises(InvalidMAC, AS2805().setNetworkISO, unsigned.getNetworkISO(), True, key)
+
+        # the zero copy frames of the framer are verified as they are, and kept once the buffer is reused
+        framer = LengthPrefixFramer()
+        framer.feed(frame)
+        view = framer.frames()[0]
+        received = AS2805(lazy=True)
+        received.setNetworkISO(view, macKey=handle)
+        AS2805().setNetworkISO(bytearray(frame), macKey=handle)
+        view[:] = '\0' * len(view)
+        self.assertEqual(received.getBit(70), '301', 'Bits are kept in the reused buffer')
+        self.assertTrue(AS2805._SHAPES.get(memoryview(frame)[6:22]) is AS2805._SHAPES.get(frame[6:22]),
+                        'Shape of a memoryview bitmap is not cached')
+
+        # a MAC that can't be computed leaves the package as it was
+        before = unsigned.getNetworkISO()
+        self.assertRaises(ValueError, unsigned.getNetworkISO, True, 'short')
+        self.assertRaises(BitNotSet, unsigned.getBit, 128)
+        self.assertEqual(unsigned.getNetworkISO(), before, 'Failed MAC changes the package')
+
+
+class Default_MACVerifierPoolTestCase(unittest.TestCase):
+    def runTest(self):
+
+        print "MAC Verifier Pool Test"
+
+        key = HexToByte('0123456789ABCDEFFEDCBA9876543210')
+        handle = Ciphers.register('test/verifier ZAK', key)
+        other = Ciphers.register('test/verifier other ZAK', key[8:] + key[:8])
+
+        iso = AS2805()
+        iso.setMTI('0800')
+        iso.setBit(11, '000001')
+        iso.setBit(70, '301')
+        frame = iso.getNetworkISO(macKey=handle)
+        tampered = frame[:-9] + chr(ord(frame[-9]) ^ 1) + frame[-8:]
+
+        verifier = MACVerifierPool(processes=2, arena=len(frame) * 30, chunk=2)
+        try:
+            pairs = [(frame, handle), (tampered, handle), (frame, other), ('not a frame' * 3, handle), (bytearray(frame), handle)]
+            self.assertEqual(verifier.verify(pairs, 10), [True, False, False, False, True], 'MAC checks are not a Match')
+            self.assertEqual(verifier.verify([]), [], 'Empty batch is not verified')
+
+            # more frames in flight than the arena holds at once, the batches are queued for the space of the older ones
+            verified = []
+            batches = [verifier.submit([(frame, handle)] * 12, verified.append) for i in range(10)]
+            for batch in batches:
+                self.assertEqual(batch.wait(10), [True] * 12, 'Batch is not verified')
+            self.assertEqual(len(verified), 10, 'Callbacks are not called')
+            self.assertEqual(verifier.METRICS['frames'], 125, 'Frames are not counted')
+            self.assertEqual(verifier.METRICS['invalid'], 3, 'Invalid frames are not counted')
+            self.assertTrue(verifier.METRICS['queued'] > 0, 'Full arena is not queued')
+
+            # a callback may submit again, with the arena full, without waiting
+            resubmitted = []
+            first = verifier.submit([(frame, handle)] * 20, lambda batch: resubmitted.append(verifier.submit([(frame, handle)] * 20)))
+            second = verifier.submit([(frame, handle)] * 20)
+            self.assertEqual(first.wait(10), [True] * 20, 'Batch is not verified')
+            self.assertEqual(second.wait(10), [True] * 20, 'Queued batch is not verified')
+            self.assertEqual(resubmitted[0].wait(10), [True] * 20, 'Batch submitted from a callback is not verified')
+
+            self.assertRaises(ValueError, verifier.submit, [(frame, handle)] * 31)
+
+            # bad handles are refused before the arena is taken, bad keys only fail their frames
+            for i in range(40):
+                self.assertRaises(ValueError, verifier.submit, [(frame, handle), (frame, None)])
+            bad = KeyHandle('test/verifier bad ZAK', 'short')
+            for i in range(10):
+                self.assertEqual(verifier.verify([(frame, bad)] * 12 + [(frame, handle)], 10), [False] * 12 + [True],
+                                 'Bad key fails the batch')
+        finally:
+            verifier.close()
+
+        # more keys than the key table holds, the idle ones give their slot to the next
+        third = Ciphers.register('test/verifier third ZAK', HexToByte('89ABCDEF0123456776543210FEDCBA98'))
+        signed = dict([(key, iso.getNetworkISO(macKey=key)) for key in (handle, other, third)])
+        verifier = MACVerifierPool(processes=1, keys=2)
+        try:
+            self.assertRaises(ValueError, verifier.submit, [(frame, handle), (frame, other), (frame, third)])
+            batches = [verifier.submit([(signed[key], key), (signed[handle], key)]) for key in (handle, other, third) * 3]
+            for batch, key in zip(batches, (handle, other, third) * 3):
+                self.assertEqual(batch.wait(10), [True, key is handle], 'Keys from the key table are not a Match')
+        finally:
+            verifier.close()
+
+
+class Default_SessionKeysTestCase(unittest.TestCase):
+    def runTest(self):
+
+        print "Session Key Rollover Test"
+
+        first = HexToByte('0123456789ABCDEFFEDCBA9876543210')
+        second = HexToByte('FEDCBA98765432100123456789ABCDEF')
+        kek = HexToByte('89ABCDEF0123456776543210FEDCBA98')
+        self.assertEqual(getCheckValue(first), '08D7B4', 'Check value is not a Match')
+
+        now = [1000.0]
+        keys = SessionKeyStore('test/link', grace=30, keys={MAC: first}, clock=lambda: now[0])
+        sent = keys.current()
+        iso = AS2805()
+        iso.setMTI('0200')
+        iso.setBit(11, '000001')
+        late = iso.getNetworkISO(macKey=sent.getKey(MAC))
+
+        # wrong check values leave everything as it was
+        self.assertRaises(KeyCheckError, keys.stage, {MAC: second}, {MAC: getCheckValue(first)})
+        self.assertEqual(keys.getPending(), None, 'Keys failing their check are staged')
+        keys.stage({MAC: second})
+        self.assertRaises(KeyCheckError, keys.activate, {MAC: '000000'})
+        self.assertTrue(keys.current() is sent, 'Keys failing their check are active')
+        self.assertRaises(ValueError, keys.activate)
+
+        # keys encrypted under the KEK, checked on stage, swapped in one go
+        wrapped = DES3.new(kek, DES3.MODE_ECB).encrypt(second)
+        keys.stage({MAC: wrapped, PIN: wrapped}, {MAC: getCheckValue(second)}, kek)
+        active = keys.activate({PIN: getCheckValue(second)})
+        self.assertEqual(active.GENERATION, sent.GENERATION + 1, 'Generation is not the next one')
+        self.assertEqual(keys.getKey(MAC).KEY, second, 'New key is not current')
+        fresh = iso.getNetworkISO(macKey=keys.getKey(MAC))
+
+        # a late response MAC'd with the old key verifies while the grace lasts
+        self.assertEqual(keys.verifyMAC(late, sent), sent.GENERATION, 'Late response is not verified')
+        self.assertEqual(keys.verifyMAC(fresh, sent), active.GENERATION, 'Response is not verified')
+        self.assertTrue(keys.lookup(sent.GENERATION, MAC) is sent.getKey(MAC), 'Old key is not kept')
+        self.assertFalse(keys.expire(), 'Old key is dropped within its grace')
+
+        now[0] += 31
+        self.assertEqual(keys.lookup(sent.GENERATION, MAC), None, 'Old key is kept after its grace')
+        self.assertRaises(InvalidMAC, keys.verifyMAC, late, sent)
+        self.assertTrue(keys.expire(), 'Old key is not dropped')
+        self.assertEqual(Ciphers.lookup(sent.getKey(MAC).ID), None, 'Ciphers of the old key are kept')
+
+        keys.stage({MAC: first})
+        keys.discard()
+        self.assertEqual(keys.getPending(), None, 'Declined keys are kept')
+        self.assertEqual(keys.METRICS['rollovers'], 1, 'Rollovers are not counted')
+
+        # a wheel firing early, the previous keys are dropped once the grace is really over
+        class Wheel:
+            def __init__(self):
+                self.TIMERS = []
+
+            def schedule(self, delay, callback, *args):
+                self.TIMERS.append((delay, callback, args))
+
+        wheel = Wheel()
+        keys = SessionKeyStore('test/wheel link', grace=30, keys={MAC: first}, wheel=wheel, clock=lambda: now[0])
+        old = keys.getKey(MAC)
+        keys.stage({MAC: second})
+        keys.activate()
+        delay, callback, args = wheel.TIMERS.pop()
+        self.assertEqual(delay, 30, 'Grace is not scheduled')
+        now[0] += 29.5
+        callback(*args)
+        self.assertTrue(Ciphers.lookup(old.ID) is old, 'Old key is dropped within its grace')
+        delay, callback, args = wheel.TIMERS.pop()
+        self.assertEqual(delay, 0.5, 'Rest of the grace is not scheduled')
+        now[0] += 0.5
+        callback(*args)
+        self.assertEqual((Ciphers.lookup(old.ID), wheel.TIMERS), (None, []), 'Old key is not dropped')
+
+        # the host's 0820 carries the MAC and PIN keys under the KEK in bit 48, the 0830 returns their check values
+        change = AS2805()
+        change.setMTI('0820')
+        change.setBit(7, '0104105142')
+        change.setBit(11, '000360')
+        change.setBit(33, '579944')
+        change.setBit(48, ToHex(DES3.new(kek, DES3.MODE_ECB).encrypt(first + second)))
+        change.setBit(53, '0000000000000002')
+        change.setBit(70, '101')
+        frame = change.getNetworkISO()
+        codec = AS2805()
+        checks = keys.acceptKeyChange(HexToByte(codec.decodeFields(frame[4:], (48,))[48]), kek)
+        self.assertEqual(checks, getCheckValue(first) + getCheckValue(second), 'Check values are not a Match')
+        self.assertEqual((keys.getKey(MAC).KEY, keys.getKey(PIN).KEY), (first, second), 'Keys of the 0820 are not current')
+        answer = AS2805()
+        answer.setNetworkISO(str(codec.deriveResponse(frame, {39: '00', 48: checks})))
+        self.assertEqual((answer.getMTI(), answer.getBit(48)), ('0830', checks), '0830 is not a Match')
+        self.assertRaises(ValueError, keys.acceptKeyChange, first)
@@ -0,0 +1,185 @@
+__author__ = 'root'
+
+"""
+            Cache of initialised cipher objects, by key
+
+Building a DES or DES3 object runs the key schedule, which costs as much as the MAC of a short
+message. The cipher objects are kept instead, by key identifier and use, in a bounded LRU cache,
+and taken out by one thread at a time. The keys themselves are handed around as KeyHandle, so the
+MAC and PIN code never see or log raw key bytes; only register() compares them, in constant time.
+A handle replaced by a later register() of its identifier still works, with ciphers built for each
+call instead of cached ones.
+
+A CBC object cannot be restarted, so a kept one carries on from the last block of its previous
+message; _Chain cancels it by XORing it into the first block of the next message.
+
+Example:
+    handle = Ciphers.register('link-1/ZAK', zak)
+    mac = RetailMAC(message, handle)
+    Ciphers.invalidate('link-1/ZAK')       # key rollover, the ciphers of the old key are dropped
+"""
+
+import hmac
+import struct
+import threading
+from collections import OrderedDict
+
+from Crypto.Cipher import DES
+from Crypto.Cipher import DES3
+
+
+_BLOCK = struct.Struct('>Q')
+_ZERO = '\0' * 8
+
+# uses of a key, each needs its own cipher objects
+RETAIL = 'retail'
+FULL = 'full'
+PIN = 'pin'
+
+
+class KeyHandle(object):
+    """A key and its identifier, the key is never printed"""
+    __slots__ = ('ID', 'KEY')
+
+    def __init__(self, keyId, key):
+        self.ID = keyId
+        self.KEY = key
+
+    def __repr__(self):
+        return 'KeyHandle(%r)' % (self.ID,)
+
+
+class _Chain(object):
+    """A CBC object used for one MAC after the other, with a zero IV to start with"""
+    __slots__ = ('CBC', 'LAST')
+
+    def __init__(self, cbc):
+        self.CBC = cbc
+        self.LAST = _ZERO
+
+    def mac(self, view, iv, tail):
+        """Return the last block of the CBC encryption of view, whose last partial block, padded, is tail"""
+        full = len(view) - len(view) % 8
+        first = view[0:8].tobytes() if full else tail
+        # undo the chaining from the previous message, start from iv instead
+        first = _BLOCK.pack(_BLOCK.unpack(first)[0] ^ _BLOCK.unpack(self.LAST)[0] ^ _BLOCK.unpack(iv)[0])
+        last = self.CBC.encrypt(first)
+        if full:
+            if full > 8:
+                self.CBC.encrypt(view[8:full])
+            last = self.CBC.encrypt(tail)
+        self.LAST = last
+        return last
+
+
+def _build(kind, key):
+    """Return the cipher objects of a use of key"""
+    if kind == RETAIL:
+        left = key[0:8]
+        return (_Chain(DES.new(left, DES.MODE_CBC, _ZERO)), DES.new(key[8:16], DES.MODE_ECB), DES.new(left, DES.MODE_ECB))
+    if kind == FULL:
+        return _Chain(DES3.new(key, DES3.MODE_CBC, _ZERO))
+    if kind == PIN:
+        return DES3.new(key, DES3.MODE_ECB)
+    raise ValueError('Unknown use of a key: %s' % kind)
+
+
+class _Entry(object):
+    __slots__ = ('HANDLE', 'IDLE')
+
+    def __init__(self, handle):
+        self.HANDLE = handle
+        self.IDLE = []
+
+
+class CipherCache(object):
+    """LRU cache of cipher objects by key identifier and use, safe to share between threads.
+    @param: maxsize -> key identifier and use pairs kept
+    @param: idle -> cipher objects kept per pair, as many threads can use a key at once
+    """
+
+    def __init__(self, maxsize=256, idle=8):
+        self.MAXSIZE = maxsize
+        self.IDLE = idle
+        self.HITS = 0
+        self.MISSES = 0
+
+        self._KEYS = {}
+        self._ENTRIES = OrderedDict()
+        self._HOOKS = []
+        self._LOCK = threading.Lock()
+
+    def register(self, keyId, key):
+        """Return the handle of a key, the ciphers of a key registered before under keyId are dropped
+        @param: key -> 8, 16 or 24 bytes
+        """
+        if len(key) not in (8, 16, 24):
+            raise ValueError('A DES key is 8, 16 or 24 bytes, not %d' % len(key))
+
+        with self._LOCK:
+            previous = self._KEYS.get(keyId)
+            if previous is not None and hmac.compare_digest(previous.KEY, key):
+                return previous
+            handle = self._KEYS[keyId] = KeyHandle(keyId, key)
+        if previous is not None:
+            self.invalidate(keyId, forget=False)
+        return handle
+
+    def lookup(self, keyId):
+        """Return the handle registered under keyId, None if there is none"""
+        return self._KEYS.get(keyId)
+
+    def onInvalidate(self, hook):
+        """Call hook(keyId) each time the ciphers of a key are dropped"""
+        self._HOOKS.append(hook)
+
+    def invalidate(self, keyId, forget=True):
+        """Drop the ciphers of a key, on key rollover; the objects in use are not put back
+        @param: forget (True|False) -> drop the handle registered under keyId as well
+        """
+        with self._LOCK:
+            for kind in (RETAIL, FULL, PIN):
+                self._ENTRIES.pop((keyId, kind), None)
+            if forget:
+                self._KEYS.pop(keyId, None)
+        for hook in self._HOOKS:
+            hook(keyId)
+
+    def acquire(self, handle, kind):
+        """Take the cipher objects of a use of a key, for this thread only until release()"""
+        name = (handle.ID, kind)
+        with self._LOCK:
+            if self._KEYS.get(handle.ID) is not handle:
+                # replaced or never registered, its ciphers are not kept so they never evict the current ones
+                self.MISSES += 1
+                return _build(kind, handle.KEY)
+            entry = self._ENTRIES.pop(name, None)
+            if entry is not None and entry.HANDLE is handle:
+                self._ENTRIES[name] = entry
+                if entry.IDLE:
+                    self.HITS += 1
+                    return entry.IDLE.pop()
+            else:
+                self._ENTRIES[name] = _Entry(handle)
+                if len(self._ENTRIES) > self.MAXSIZE:
+                    self._ENTRIES.popitem(last=False)
+            self.MISSES += 1
+        return _build(kind, handle.KEY)
+
+    def release(self, handle, kind, ciphers):
+        """Give back what acquire() returned, dropped if the key was invalidated meanwhile"""
+        with self._LOCK:
+            entry = self._ENTRIES.get((handle.ID, kind))
+            if entry is not None and entry.HANDLE is handle and len(entry.IDLE) < self.IDLE:
+                entry.IDLE.append(ciphers)
+
+    def stats(self):
+        return {'hits': self.HITS, 'misses': self.MISSES, 'size': len(self._ENTRIES), 'maxsize': self.MAXSIZE}
+
+    def clear(self):
+        with self._LOCK:
+            self._ENTRIES.clear()
+
+
+# the cache the MAC and PIN functions use for the keys given as handles
+Ciphers = CipherCache()
@@ -0,0 +1,105 @@
+__author__ = 'root'
+
+"""
+            Length prefixed framing of a TCP stream
+
+TCP coalesces and splits what is sent, so one recv() can hold part of a message or several of them.
+LengthPrefixFramer reads the stream with recv_into() into one preallocated buffer and hands the
+complete frames out as memoryviews of that buffer, nothing is copied. Only the start of a frame that
+would not fit before the end of the buffer is moved back to its beginning, so the buffer is used as
+a ring without a frame ever wrapping around.
+
+Example:
+    framer = LengthPrefixFramer(bigEndian=True)
+    while framer.recvFrom(connection):
+        for frame in framer.frames():
+            handle(frame.tobytes())
+"""
+
+import struct
+
+
+class FramingError(Exception):
+    pass
+
+
+class LengthPrefixFramer(object):
+    """Splits a stream of frames, each a size header and then that many bytes, the header is not counted.
+    @param: capacity -> size of the buffer, the largest frame is capacity - headerSize
+    @param: bigEndian (True|False) -> how the size is represented
+    @param: headerSize -> 4 (the AS2805 getNetworkISO() form) or 2 bytes
+    """
+
+    def __init__(self, capacity=65536, bigEndian=True, headerSize=4):
+        if headerSize not in (2, 4):
+            raise FramingError('The header is 2 or 4 bytes, not %s' % headerSize)
+
+        self.HEADER_SIZE = headerSize
+        self.HEADER = struct.Struct(('!' if bigEndian else '<') + ('I' if headerSize == 4 else 'H'))
+        self.MAX_FRAME = capacity - headerSize
+
+        self._BUFFER = bytearray(capacity)
+        self._VIEW = memoryview(self._BUFFER)
+        self._START = 0  # first byte not handed out yet
+        self._END = 0  # first free byte
+
+    def __pendingSize(self):
+        """Return the size of the frame that starts at _START, header included, None if its header is incomplete"""
+        if self._END - self._START < self.HEADER_SIZE:
+            return None
+
+        length, = self.HEADER.unpack_from(self._BUFFER, self._START)
+        if length > self.MAX_FRAME:
+            raise FramingError('Frame of %d bytes, the largest is %d' % (length, self.MAX_FRAME))
+        return self.HEADER_SIZE + length
+
+    def __makeRoom(self):
+        """Move the incomplete frame at the end of the buffer to its beginning when the rest of it would not fit"""
+        start, end = self._START, self._END
+        if start == end:
+            self._START = self._END = 0
+            return
+
+        need = self.__pendingSize() or self.HEADER_SIZE
+        if start + need > len(self._BUFFER):
+            self._BUFFER[0:end - start] = self._BUFFER[start:end]
+            self._START, self._END = 0, end - start
+
+    def recvFrom(self, sock):
+        """Read what is available from sock into the buffer, the frames handed out before are no longer valid
+        @return: int -> number of bytes read, 0 when the connection is closed
+        @raise: FramingError, socket.error
+        """
+        self.__makeRoom()
+        count = sock.recv_into(self._VIEW[self._END:])
+        self._END += count
+        return count
+
+    def feed(self, data):
+        """Append data that was not read from a socket, the frames handed out before are no longer valid
+        @raise: FramingError
+        """
+        self.__makeRoom()
+        if self._END + len(data) > len(self._BUFFER):
+            raise FramingError('No room for %d bytes, hand the frames out first' % len(data))
+
+        self._BUFFER[self._END:self._END + len(data)] = data
+        self._END += len(data)
+
+    def frames(self):
+        """Return the complete frames received so far, each a memoryview of the buffer, header included.
+        They stay valid until the next recvFrom() or feed().
+        @raise: FramingError
+        """
+        frames = []
+        while True:
+            size = self.__pendingSize()
+            if size is None or self._END - self._START < size:
+                return frames
+
+            frames.append(self._VIEW[self._START:self._START + size])
+            self._START += size
+
+    def pending(self):
+        """Return the number of bytes received that are not part of a frame handed out yet"""
+        return self._END - self._START
@@ -1,8 +1,10 @@
-from operator import *
+import binascii
 
 from Crypto.Cipher import DES3
 from Crypto.Cipher import DES
 
+from Shared.CipherCache import Ciphers, KeyHandle, RETAIL, FULL, PIN
+
 
 DES_IV = '\0\0\0\0\0\0\0\0'
 DES_PAD = [chr(0x80), chr(0), chr(0), chr(0), chr(0), chr(0), chr(0), chr(0)]
@@ -13,84 +15,112 @@ DO87 = '870901'
 DO8E = '8E08'
 DO97 = '9701'
 DO99 = '99029000'
+_PAD = ''.join(DES_PAD)
 
 
 def ToBinary(string):
     """convert hex string to binary characters"""
-    output = ''
-    x = 0
-    while x < len(string):
-        output += chr(int(string[x:x + 2], 16))
-        x += 2
-    return output
+    return binascii.unhexlify(string)
+
+
+def _chain(cipher, message):
+    """CBC encrypt message, ISO 9797-1 padding method 2, and return the last block.
+    message is a str, bytearray or memoryview, only its last partial block is copied to be padded"""
+    view = memoryview(message)
+    full = len(view) - len(view) % 8
+    if full:
+        cipher.encrypt(view[:full])
+    return cipher.encrypt(PADBlock(view[full:].tobytes()))
+
+
+def RetailMAC(message, key, iv=DES_IV):
+    """iso 9797-1 Algorithm 3 (Retail MAC): single DES CBC over the message with the left key,
+    then decrypt with the right key and encrypt with the left one again. Only the first 16 bytes of a
+    24 bytes key are used, as DESMAC always did.
+    key is the key bytes or a KeyHandle, whose ciphers are taken from the cache"""
+    if isinstance(key, KeyHandle):
+        # what may fail is done before the kept CBC chain moves, so the chain always goes back intact
+        view = memoryview(message)
+        tail = PADBlock(view[len(view) - len(view) % 8:].tobytes())
+        ciphers = Ciphers.acquire(key, RETAIL)
+        try:
+            chain, right, out = ciphers
+            return out.encrypt(right.decrypt(chain.mac(view, iv, tail)))
+        finally:
+            Ciphers.release(key, RETAIL, ciphers)
+    left = key[0:8]
+    mac = _chain(DES.new(left, DES.MODE_CBC, iv), message)
+    mac = DES.new(key[8:16], DES.MODE_ECB).decrypt(mac)
+    return DES.new(left, DES.MODE_ECB).encrypt(mac)
+
+
+def FullMAC(message, key, iv=DES_IV):
+    """iso 9797-1 Algorithm 1 with triple DES: DES3 CBC over the message, key bytes or KeyHandle"""
+    if isinstance(key, KeyHandle):
+        view = memoryview(message)
+        tail = PADBlock(view[len(view) - len(view) % 8:].tobytes())
+        chain = Ciphers.acquire(key, FULL)
+        try:
+            return chain.mac(view, iv, tail)
+        finally:
+            Ciphers.release(key, FULL, chain)
+    return _chain(DES3.new(key, DES3.MODE_CBC, iv), message)
 
 
 def DES3MAC(message, key, ssc):
     "iso 9797-1 Algorithm 3 (Full DES3)"
-    tdes = DES3.new(key, DES3.MODE_ECB, DES_IV)
-    if ssc:
-        mac = tdes.encrypt(ToBinary(ssc))
-    else:
-        mac = DES_IV
-    message += PADBlock('')
-    for y in range(len(message) / 8):
-        current = message[y * 8:(y * 8) + 8]
-        left = ''
-        right = ''
-        for x in range(len(mac)):
-            left += '%02x' % ord(mac[x])
-            right += '%02x' % ord(current[x])
-        machex = '%016x' % xor(int(left, 16), int(right, 16))
-        mac = tdes.encrypt(ToBinary(machex))
+    iv = _ecb(key, DES3).encrypt(ToBinary(ssc)) if ssc else DES_IV
     # iso 9797-1 says we should do the next two steps for "Output Transform 3"
     # but they're obviously redundant for DES3 with only one key, so I don't bother!
-    # mac= tdes.decrypt(mac)
-    # mac= tdes.encrypt(mac)
-    return mac
+    return FullMAC(message, key, iv)
 
 
 def PADBlock(block):
     "add DES padding to data block"
     # call with null string to return an 8 byte padding block
     # call with an unknown sized block to return the block padded to a multiple of 8 bytes
-    for x in range(8 - (len(block) % 8)):
-        block += DES_PAD[x]
-    return block
+    return block + _PAD[:8 - len(block) % 8]
 
 
 def DESMAC(message, key, ssc):
     "iso 9797-1 Algorithm 3 (Retail MAC)"
     # DES for all blocks
     # DES3 for last block
+    iv = _ecb(key, DES).encrypt(ToBinary(ssc)) if ssc else DES_IV
+    return RetailMAC(message, key, iv)
+
+
+def _ecb(key, module):
+    """ECB cipher of the ssc, DES with the left key or DES3"""
+    if isinstance(key, KeyHandle):
+        key = key.KEY
+    return DES.new(key[0:8], DES.MODE_ECB) if module is DES else DES3.new(key, DES3.MODE_ECB)
+
+
+def EncryptPINBlock(block, key):
+    """DES3 ECB encrypt a clear 8 bytes PIN block (bit 52) under a PIN key, key bytes or KeyHandle"""
+    return _pin(block, key, True)
+
+
+def DecryptPINBlock(block, key):
+    """DES3 ECB decrypt the 8 bytes PIN block of bit 52 under a PIN key, key bytes or KeyHandle"""
+    return _pin(block, key, False)
+
 
-    tdesa = DES.new(key[0:8], DES.MODE_ECB, DES_IV)
-    tdesb = DES.new(key[8:16], DES.MODE_ECB, DES_IV)
-    if ssc:
-        mac = tdesa.encrypt(ToBinary(ssc))
-    else:
-        mac = DES_IV
-    message += PADBlock('')
-    for y in range(len(message) / 8):
-        current = message[y * 8:(y * 8) + 8]
-        left = right = ''
-        for x in range(len(mac)):
-            left += '%02x' % ord(mac[x])
-            right += '%02x' % ord(current[x])
-        machex = '%016x' % xor(int(left, 16), int(right, 16))
-        # print machex
-        mac = tdesa.encrypt(ToBinary(machex))
-        # print mac
-    mac = tdesb.decrypt(mac)
-
-    return tdesa.encrypt(mac)
+def _pin(block, key, encrypt):
+    if not isinstance(key, KeyHandle):
+        cipher = DES3.new(key, DES3.MODE_ECB)
+        return cipher.encrypt(block) if encrypt else cipher.decrypt(block)
+    cipher = Ciphers.acquire(key, PIN)
+    try:
+        return cipher.encrypt(block) if encrypt else cipher.decrypt(block)
+    finally:
+        Ciphers.release(key, PIN, cipher)
 
 
 def ToHex(data):
     "convert binary data to hex printable"
-    string = ''
-    for x in range(len(data)):
-        string += '%02x' % ord(data[x])
-    return string
+    return binascii.hexlify(data)
 
 
 def HexPrint(data):
@@ -109,10 +139,11 @@ def MACVerify(message, key):
     return True
 
 
-Message = "<STX>000000  td7W0       <FS>9VDD9002       <FS>11<FS>0056<FS>4902370000002348=121210111234123<FS>00006000<FS>00000200<FS>4F50E157E8D544B1<FS><FS><FS>VA5.00.07WV02.70.10 V04.00.19 0  0T  00 000     00000002K0047000000005K005500000000000000000000000000000000000000<FS><FS><ETX>"
-ResultMac = "^EB5E 8B9A"
-Message_Block = HexPrint(Message)
+if __name__ == '__main__':
+    Message = "<STX>000000  td7W0       <FS>9VDD9002       <FS>11<FS>0056<FS>4902370000002348=121210111234123<FS>00006000<FS>00000200<FS>4F50E157E8D544B1<FS><FS><FS>VA5.00.07WV02.70.10 V04.00.19 0  0T  00 000     00000002K0047000000005K005500000000000000000000000000000000000000<FS><FS><ETX>"
+    ResultMac = "^EB5E 8B9A"
+    Message_Block = HexPrint(Message)
 
-result = DESMAC(Message_Block, 'F92260FA70A180E1B30D9E95DAD6B823', '')
-print result
-print ToHex(result).upper()
\ No newline at end of file
+    result = DESMAC(Message_Block, 'F92260FA70A180E1B30D9E95DAD6B823', '')
+    print result
+    print ToHex(result).upper()
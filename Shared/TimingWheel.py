@@ -0,0 +1,133 @@
+__author__ = 'root'
+
+"""
+            Hashed timing wheel
+
+Timers are hashed by their expiry tick into one of a fixed number of slots, so scheduling and
+cancelling a timer cost the same whatever the number of timers, and each tick only looks at the
+one slot that is due. A timer further away than one turn of the wheel waits in its slot for the
+turns in between, so the wheel is best sized to cover the longest timeout: slots * tick seconds.
+
+Example:
+    wheel = TimingWheel(tick=0.01, slots=4096)
+    timer = wheel.schedule(30, expire, request)
+    wheel.cancel(timer)
+    wheel.start()
+"""
+
+import logging
+import math
+import threading
+import time
+
+
+Trace = logging.getLogger('AS2805.TimingWheel')
+
+
+class Timer(object):
+    """A timer of the wheel, handed back by schedule() to cancel it"""
+    __slots__ = ('TICK', 'CALLBACK', 'ARGS', 'SLOT')
+
+    def __init__(self, tick, callback, args, slot):
+        self.TICK = tick
+        self.CALLBACK = callback
+        self.ARGS = args
+        self.SLOT = slot
+
+
+class TimingWheel(object):
+    """Timers with a resolution of tick seconds, O(1) to schedule, cancel and expire.
+    @param: tick -> seconds between two turns of advance(), the timers fire up to one tick late, never early
+    @param: slots -> slots of the wheel, slots * tick is the longest timeout seen in one turn
+    @param: clock -> function returning the time in seconds
+    """
+
+    def __init__(self, tick=0.01, slots=4096, clock=time.time):
+        self.TICK = tick
+        self.SLOTS = slots
+        self.CLOCK = clock
+
+        self._WHEEL = [{} for i in range(slots)]  # each slot is a dict {Timer: None}, removal is O(1)
+        self._CURRENT = int(clock() / tick)  # last tick advance() handled
+        self._COUNT = 0
+        self._LOCK = threading.Lock()
+        self._THREAD = None
+        self._STOP = threading.Event()
+
+    def __len__(self):
+        return self._COUNT
+
+    def schedule(self, delay, callback, *args):
+        """Call callback(*args) in delay seconds, from advance()
+        @return: Timer -> to cancel()
+        """
+        with self._LOCK:
+            # the first tick at or after the expiry, a delay is never cut short
+            tick = max(int(math.ceil((self.CLOCK() + delay) / self.TICK)), self._CURRENT + 1)
+            slot = self._WHEEL[tick % self.SLOTS]
+            timer = Timer(tick, callback, args, slot)
+            slot[timer] = None
+            self._COUNT += 1
+        return timer
+
+    def cancel(self, timer):
+        """Stop a timer
+        @return: bool -> False when the timer fired or was cancelled already
+        """
+        with self._LOCK:
+            slot = timer.SLOT
+            if slot is None or timer not in slot:
+                return False
+            del slot[timer]
+            timer.SLOT = None
+            self._COUNT -= 1
+        return True
+
+    def advance(self, now=None):
+        """Fire the timers that are due, from this thread. A callback that raises is logged, the others still fire
+        @return: int -> number of timers fired
+        """
+        if now is None:
+            now = self.CLOCK()
+        target = int(now / self.TICK)
+
+        due = []
+        with self._LOCK:
+            # a late call visits each slot once at most, the timers of later turns stay where they are
+            first = max(self._CURRENT + 1, target - self.SLOTS + 1)
+            for tick in xrange(first, target + 1):
+                slot = self._WHEEL[tick % self.SLOTS]
+                if not slot:
+                    continue
+                for timer in slot.keys():
+                    if timer.TICK <= target:
+                        del slot[timer]
+                        timer.SLOT = None
+                        due.append(timer)
+            self._CURRENT = max(self._CURRENT, target)
+            self._COUNT -= len(due)
+
+        for timer in due:
+            try:
+                timer.CALLBACK(*timer.ARGS)
+            except Exception:
+                # the timers taken out of the slots with it are due as well, and the wheel thread must go on
+                Trace.exception('timer callback %r failed', timer.CALLBACK)
+        return len(due)
+
+    def start(self):
+        """Advance the wheel every tick from a thread, until stop()"""
+        self._STOP.clear()
+        self._THREAD = threading.Thread(target=self.__run, name='TimingWheel')
+        self._THREAD.daemon = True
+        self._THREAD.start()
+
+    def stop(self):
+        self._STOP.set()
+        if self._THREAD is not None:
+            self._THREAD.join()
+            self._THREAD = None
+
+    def __run(self):
+        while not self._STOP.wait(self.TICK):
+            self.advance()